@@ -0,0 +1,406 @@
+"""Нагрузочный прогон обработки апдейтов (record/replay) без Telegram.
+
+    python bench.py run --users 1000 --threads 8 --out bench.json
+    python bench.py run --users 200 --record updates.jsonl      # сохранить сгенерированные апдейты
+    python bench.py run --replay updates.jsonl --out bench.json  # прогнать записанные (в т.ч. с прода)
+    python bench.py run --users 50 --http-stub --api-latency-ms 40  # через OUTBOX и HTTP-заглушку
+    python bench.py compare old.json new.json
+
+Апдейты идут через bot.process_new_updates (с middleware и фильтрами, как из webhook),
+Telegram API подменяется заглушкой с настраиваемой задержкой: по умолчанию в процессе
+(apihelper.CUSTOM_REQUEST_SENDER, без лимитов OUTBOX — меряем сам бот), с --http-stub —
+через настоящий транспорт OUTBOX (keep-alive, token buckets) и tg_stub.py.
+Сценарии нажимают кнопки по подписи из последней клавиатуры, присланной пользователю,
+поэтому не зависят от формата callback_data. После каждого апдейта ждём, пока очередь
+OUTBOX отправит ответы этого чата (outbox_wait).
+База — временный файл, рабочая issues.db не затрагивается.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _summary(samples: list, columns: tuple = ("db", "api")) -> dict:
+    """samples — кортежи (время, *columns) в секундах."""
+    total = [s[0] for s in samples]
+    result = {
+        "count": len(samples),
+        "p50_ms": round(_percentile(total, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(total, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(total, 0.99) * 1000, 3),
+        "mean_ms": round(sum(total) / len(total) * 1000, 3) if total else 0.0,
+    }
+    for i, name in enumerate(columns, 1):
+        result[f"{name}_mean_ms"] = round(sum(s[i] for s in samples) / len(samples) * 1000, 3) if samples else 0.0
+    return result
+
+
+class StubTelegram:
+    """Заглушка Bot API: отвечает как Telegram, запоминает последнюю клавиатуру по чату.
+    С forward запрос уходит дальше (в OUTBOX.request -> tg_stub), здесь только запоминаем."""
+
+    def __init__(self, latency: float = 0.0, forward=None):
+        self.latency = latency
+        self.forward = forward
+        self.calls = 0
+        self.markups: dict[int, list] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    class _Response:
+        status_code = 200
+        reason = "OK"
+
+        def __init__(self, payload):
+            self._payload = payload
+            self.text = json.dumps(payload)
+
+        def json(self):
+            return self._payload
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        started = time.perf_counter()
+        if self.latency and self.forward is None:
+            time.sleep(self.latency)
+        name = url.rsplit("/", 1)[1]
+        params = params or {}
+        if self.forward is not None:
+            response = self.forward(method, url, params=params, files=files, **kwargs)
+        chat_id = int(params.get("chat_id", 0) or 0)
+        markup = params.get("reply_markup")
+        if markup and chat_id:
+            data = json.loads(markup) if isinstance(markup, str) else markup
+            if "inline_keyboard" in data:
+                with self._lock:
+                    self.markups[chat_id] = [b for row in data["inline_keyboard"] for b in row]
+        with self._lock:
+            self.calls += 1
+            message_id = next(self._ids)
+        if name in ("answerCallbackQuery", "editMessageReplyMarkup", "setWebhook", "deleteWebhook"):
+            result = True
+        else:
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            if name == "sendDocument":
+                result["document"] = {"file_id": f"stub-{message_id}", "file_unique_id": f"u{message_id}"}
+        if self.forward is None:
+            response = self._Response({"ok": True, "result": result})
+        # время API на потоке, который ждал ответа (inline-вызовы; отправки через OUTBOX — в его потоках)
+        _acc().api += time.perf_counter() - started
+        return response
+
+    def button(self, chat_id: int, label: str):
+        """callback_data кнопки с подписью label или начинающейся с label (None — нет такой)."""
+        buttons = [b for b in self.markups.get(chat_id, []) if b.get("callback_data")]
+        for b in buttons:
+            if b.get("text") == label:
+                return b["callback_data"]
+        for b in buttons:
+            if b.get("text", "").startswith(label):
+                return b["callback_data"]
+        return None
+
+
+_tl = threading.local()
+
+
+def _acc():
+    if not hasattr(_tl, "db"):
+        _tl.db = 0.0
+        _tl.api = 0.0
+    return _tl
+
+
+class Bench:
+    def __init__(self, bot_app, stub: StubTelegram):
+        self.app = bot_app
+        self.stub = stub
+        self.samples: dict[str, list] = {}
+        self.update_samples: list = []
+        self.broken_steps = 0
+        self.recorded: list = []
+        self._lock = threading.Lock()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._instrument()
+
+    # --- инструментирование ---
+    def _instrument(self):
+        app = self.app
+        pool_connection = app.DB_POOL.connection
+
+        @contextmanager
+        def timed_connection():
+            started = time.perf_counter()
+            try:
+                with pool_connection() as conn:
+                    yield conn
+            finally:
+                _acc().db += time.perf_counter() - started
+        app.DB_POOL.connection = timed_connection
+
+        db_write = app.db_write
+
+        def timed_db_write(op, timeout: float = 30.0):
+            started = time.perf_counter()
+            try:
+                return db_write(op, timeout)
+            finally:
+                _acc().db += time.perf_counter() - started
+        app.db_write = timed_db_write
+
+        for handler in app.bot.message_handlers + app.bot.callback_query_handlers:
+            handler["function"] = self._timed_handler(handler["function"])
+        app.wrap_routes(self._timed_handler)
+
+    def _timed_handler(self, fn):
+        name = fn.__name__
+
+        def wrapper(*args, **kwargs):
+            acc = _acc()
+            db, api = acc.db, acc.api
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                sample = (time.perf_counter() - started, acc.db - db, acc.api - api)
+                with self._lock:
+                    self.samples.setdefault(name, []).append(sample)
+        wrapper.__name__ = name
+        wrapper.__wrapped__ = fn  # telebot смотрит сигнатуру обработчика
+        return wrapper
+
+    # --- апдейты ---
+    def feed(self, payload: dict) -> None:
+        if self.recorded is not None:
+            self.recorded.append(payload)
+        update = self.app.telebot.types.Update.de_json(payload)
+        acc = _acc()
+        acc.db = acc.api = 0.0
+        started = time.perf_counter()
+        self.app.bot.process_new_updates([update])
+        handled = time.perf_counter()
+        # следующий шаг сценария смотрит на ответ бота — ждём, пока очередь чата его отправит
+        self.app.OUTBOX.flush(self.app.update_chat_id(update))
+        with self._lock:
+            self.update_samples.append((handled - started, acc.db, acc.api, time.perf_counter() - handled))
+
+    def text(self, uid: int, text: str) -> None:
+        self.feed({
+            "update_id": next(self._update_ids),
+            "message": {"message_id": next(self._message_ids), "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"},
+                        "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"},
+                        "text": text},
+        })
+
+    def click(self, uid: int, label: str, optional: bool = False) -> bool:
+        """Нажать кнопку; отсутствие обязательной кнопки считается сломанным шагом сценария."""
+        data = self.stub.button(uid, label)
+        if data is None:
+            if not optional:
+                with self._lock:
+                    self.broken_steps += 1
+            return False
+        self.feed({
+            "update_id": next(self._update_ids),
+            "callback_query": {"id": str(next(self._message_ids)), "chat_instance": str(uid), "data": data,
+                               "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                               "message": {"message_id": 1, "date": int(time.time()),
+                                           "chat": {"id": uid, "type": "private"}, "text": "…"}},
+        })
+        return True
+
+    # --- сценарии ---
+    def scenario(self, uid: int, rnd: random.Random, is_admin: bool, reports: int) -> None:
+        self.text(uid, "/start")
+        self.text(uid, "Иванов И.И.")
+        if not self.click(uid, "Механик"):
+            return
+        for _ in range(reports):
+            self.report_wizard(uid, rnd)
+        self.text(uid, "📜 История (мои)")
+        self.click(uid, "Старше", optional=True)
+        self.text(uid, "📚 История (все)")
+        self.click(uid, "Старше", optional=True)
+        self.fix_flow(uid)
+        if is_admin:
+            self.text(uid, "📤 Экспорт Excel")
+            self.click(uid, rnd.choice(["Все заявки", "С прошлой выгрузки", "За 7 дней"]))
+
+    def report_wizard(self, uid: int, rnd: random.Random) -> None:
+        app = self.app
+        self.text(uid, "📣 Сообщить о проблеме")
+        index = app.catalog()
+        node_id = app.CATALOG_ROOT
+        while index.node(node_id).children:  # случайный путь по каталогу до листа
+            node = rnd.choice(index.children(node_id))
+            if not self.click(uid, node.name):
+                return
+            node_id = node.id
+        self.text(uid, rnd.choice(["течёт ванна", "нож затупился", "не включается", "шум в приводе"]))
+
+    def fix_flow(self, uid: int) -> None:
+        self.text(uid, "✅ Сообщить о решении")
+        self.click(uid, "Обновить")
+        self.click(uid, "#", optional=True)  # открытых заявок может не остаться
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return "unknown"
+
+
+def cmd_run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["EXPORT_CACHE_DIR"] = os.path.join(workdir, "exports")
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    admins = list(range(1, args.admins + 1))
+    os.environ["ADMINS"] = ",".join(map(str, admins))
+    import main as bot_app
+
+    server = None
+    if args.http_stub:
+        import tg_stub
+        server = tg_stub.StubTelegramServer(latency=args.api_latency_ms / 1000).start()
+        bot_app.telebot.apihelper.API_URL = server.api_url
+        stub = StubTelegram(forward=bot_app.OUTBOX.request)
+    else:
+        stub = StubTelegram(latency=args.api_latency_ms / 1000)
+    bot_app.telebot.apihelper.CUSTOM_REQUEST_SENDER = stub
+    bench = Bench(bot_app, stub)
+    if not args.record:
+        bench.recorded = None
+
+    started = time.perf_counter()
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            payloads = [json.loads(line) for line in f if line.strip()]
+        # порядок внутри чата сохраняется: чат целиком обрабатывает один поток
+        lanes: dict[int, list] = {}
+        for p in payloads:
+            chat = (p.get("message") or p.get("callback_query", {}).get("message") or {}).get("chat", {}).get("id", 0)
+            lanes.setdefault(chat % args.threads, []).append(p)
+        threads = [threading.Thread(target=lambda ps=ps: [bench.feed(p) for p in ps]) for ps in lanes.values()]
+    else:
+        def worker(idx: int):
+            rnd = random.Random(args.seed + idx)
+            for uid in range(1 + idx, args.users + 1, args.threads):
+                bench.scenario(uid, rnd, uid in admins, args.reports)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for p in bench.recorded:
+                f.write(json.dumps(p, ensure_ascii=False) + "\n")
+
+    result = {
+        "meta": {
+            "commit": _git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "users": args.users, "threads": args.threads, "reports": args.reports,
+            "api_latency_ms": args.api_latency_ms, "replay": args.replay, "http_stub": args.http_stub,
+            "python": sys.version.split()[0], "sqlite": bot_app.sqlite3.sqlite_version,
+        },
+        "totals": {
+            "updates": len(bench.update_samples),
+            "elapsed_s": round(elapsed, 3),
+            "updates_per_s": round(len(bench.update_samples) / elapsed, 1) if elapsed else 0.0,
+            "api_calls": stub.calls,
+            "broken_steps": bench.broken_steps,
+            "update": _summary(bench.update_samples, ("db", "api", "outbox_wait")),
+        },
+        "telegram": {"outbox": bot_app.OUTBOX.stats(), "server": server.stats() if server else None},
+        "handlers": {name: _summary(s) for name, s in sorted(bench.samples.items())},
+        "db": {
+            "busy_retries": bot_app.WRITER.stats()["busy_retries"],
+            "pool": bot_app.db_pool_stats(),
+            "read_pool": bot_app.READ_POOL.stats(),
+            "writer": bot_app.WRITER.stats(),
+            "wal": bot_app.db_wal_stats(),
+            "report_snapshot": bot_app.REPORT_SNAPSHOT.stats(),
+        },
+    }
+    bot_app.OUTBOX.stop()
+    bot_app.WRITER.stop()
+    if server is not None:
+        server.stop()
+    return result
+
+
+def cmd_compare(old: dict, new: dict) -> None:
+    print(f"{'handler':<28}{'count':>8}{'p50 ms':>24}{'p95 ms':>24}{'p99 ms':>24}")
+    rows = [("<update>", old["totals"]["update"], new["totals"]["update"])]
+    rows += [(n, old["handlers"].get(n), s) for n, s in new["handlers"].items()]
+    for name, a, b in rows:
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if a and a[key]:
+                cells.append(f"{a[key]:.2f}→{b[key]:.2f} ({(b[key] / a[key] - 1) * 100:+.0f}%)")
+            else:
+                cells.append(f"{b[key]:.2f}")
+        print(f"{name:<28}{b['count']:>8}" + "".join(f"{c:>24}" for c in cells))
+    print(f"updates/s: {old['totals']['updates_per_s']} → {new['totals']['updates_per_s']}, "
+          f"busy retries: {old['db']['busy_retries']} → {new['db']['busy_retries']}")
+
+
+def run(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки апдейтов бота")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run", help="прогнать сценарии или запись")
+    p_run.add_argument("--users", type=int, default=1000)
+    p_run.add_argument("--threads", type=int, default=8, help="параллельных обработчиков (как воркеры очереди)")
+    p_run.add_argument("--reports", type=int, default=2, help="заявок на пользователя")
+    p_run.add_argument("--admins", type=int, default=3, help="первые N пользователей — админы (экспорт)")
+    p_run.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка заглушки Telegram API")
+    p_run.add_argument("--http-stub", action="store_true",
+                       help="слать через транспорт OUTBOX в tg_stub.py (с лимитами Telegram)")
+    p_run.add_argument("--seed", type=int, default=1)
+    p_run.add_argument("--record", help="сохранить апдейты в JSONL")
+    p_run.add_argument("--replay", help="прогнать апдейты из JSONL вместо сценариев")
+    p_run.add_argument("--out", help="записать результат в JSON")
+    p_cmp = sub.add_parser("compare", help="сравнить два JSON-результата")
+    p_cmp.add_argument("old")
+    p_cmp.add_argument("new")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "compare":
+        with open(args.old, encoding="utf-8") as f_old, open(args.new, encoding="utf-8") as f_new:
+            cmd_compare(json.load(f_old), json.load(f_new))
+        return
+    result = cmd_run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    run()
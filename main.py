@@ -1,92 +1,727 @@
+import atexit
+import bisect
+import csv
+import functools
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import logging
 import os
+import queue
+import re
 import sqlite3
+import struct
+import tempfile
+import threading
 import time
-from datetime import datetime
-from typing import Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple, Optional
 
 from dotenv import load_dotenv
+import requests
 import telebot
-from telebot import types
+from telebot import apihelper, types
 from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import BaseMiddleware
 from flask import Flask, request
+from requests.adapters import HTTPAdapter
 
 # ---- грузим .env ----
 load_dotenv()
 
 TOKEN = os.getenv("BOT_TOKEN", "")
-DB_PATH = os.path.join(os.path.dirname(__file__), "issues.db")
+DB_PATH = os.getenv("DB_PATH") or os.path.join(os.path.dirname(__file__), "issues.db")
 ADMINS = set(map(int, filter(None, os.getenv("ADMINS", "").split(","))))
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
+log = logging.getLogger("bot")
+
+# handlers выполняются синхронно в воркерах UpdateQueue (порядок внутри чата)
+bot = telebot.TeleBot(TOKEN, parse_mode="HTML", use_class_middlewares=True, threaded=False,
+                      validate_token=bool(TOKEN))  # maintenance-скрипты импортируют main без токена
 
 app = Flask(__name__)
 
-# === Webhook endpoint ===
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    if request.headers.get('content-type') == 'application/json':
-        json_str = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
-        return "OK", 200
-    return "Unsupported Media Type", 415
+# === Метрики (текстовый формат Prometheus, GET /metrics) ===
+# Без prometheus_client: гистограмма — список счётчиков по корзинам под одним локом,
+# observe()/inc() стоят единицы микросекунд. Метрики — на процесс (воркер gunicorn).
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-@app.route("/")
-def health():
-    return "OK", 200
+class Metrics:
+    def __init__(self, buckets: tuple = METRIC_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta: dict[str, tuple[str, str]] = {}  # name -> (type, help)
+        self._hist: dict[tuple, list] = {}  # (name, labels) -> [по корзинам..., +Inf, sum, count]
+        self._counters: dict[tuple, float] = {}
+        self._gauges: dict[str, callable] = {}
 
-# --- DB helpers ---
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("PRAGMA journal_mode=WAL;")
-    c.execute("PRAGMA busy_timeout=5000;")
-    c.close()
-    return conn
-
-# --- безопасное редактирование ---
-def safe_edit_text(chat_id: int, message_id: int, text: str, reply_markup=None):
-    try:
-        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
-    except ApiTelegramException as e:
-        if "message is not modified" in str(e).lower():
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()) -> None:
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, help_text: str, fn) -> None:
+        """fn() -> число или {labels: число}; вызывается при каждом scrape."""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = fn
+
+    def timed(self, name: str, label: str):
+        """Декоратор: время вызова в гистограмму name с {label="<qualname функции>"}."""
+        def deco(fn):
+            labels = ((label, fn.__qualname__),)
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, labels)
+            return wrapper
+        return deco
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for k, v in labels:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            hist = {k: list(v) for k, v in self._hist.items()}
+            counters = dict(self._counters)
+        series: dict[str, list[str]] = {}
+        for (name, labels), h in sorted(hist.items()):
+            out = series.setdefault(name, [])
+            cumulative = 0
+            for le, n in zip([repr(b) for b in self.buckets] + ["+Inf"], h):
+                cumulative += n
+                out.append(f"{name}_bucket{self._labels(labels + (('le', le),))} {cumulative}")
+            out.append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            out.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value:g}")
+        for name, fn in self._gauges.items():
             try:
-                bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
-            except ApiTelegramException:
-                pass
+                value = fn()
+            except Exception:
+                log.exception("Gauge %s failed", name)
+                continue
+            values = value.items() if isinstance(value, dict) else [((), value)]
+            series[name] = [f"{name}{self._labels(labels)} {v:g}" for labels, v in values]
+        lines = []
+        for name, out in series.items():
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(out)
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("bot_handler_seconds", "histogram", "Время обработчика апдейта")
+METRICS.describe("bot_db_seconds", "histogram", "Время DB-хелпера")
+METRICS.describe("bot_telegram_api_seconds", "histogram", "Время запроса к Telegram Bot API")
+METRICS.describe("bot_webhook_updates_total", "counter", "Апдейты, пришедшие в /webhook, по результату")
+METRICS.describe("bot_db_retries_total", "counter", "Повторы транзакции писателя после sqlite3.OperationalError")
+METRICS.describe("bot_telegram_errors_total", "counter", "ApiTelegramException по методу и коду ошибки")
+
+def _timed_api_request(make_request):
+    @functools.wraps(make_request)
+    def wrapper(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except ApiTelegramException as e:
+            METRICS.inc("bot_telegram_errors_total", (("method", method_name), ("code", e.error_code)))
+            raise
+        finally:
+            METRICS.observe("bot_telegram_api_seconds", time.perf_counter() - started, (("method", method_name),))
+    return wrapper
+
+# все bot.* идут через apihelper._make_request — единственная точка для исходящих вызовов
+apihelper._make_request = _timed_api_request(apihelper._make_request)
+
+def instrument_handlers(tb: telebot.TeleBot) -> None:
+    """Оборачивает зарегистрированные обработчики гистограммой bot_handler_seconds."""
+    def metered(fn):
+        if getattr(fn, "_metered", False):
+            return fn
+        # functools.wraps сохраняет сигнатуру — telebot по ней решает, как звать обработчик
+        wrapper = METRICS.timed("bot_handler_seconds", "handler")(fn)
+        wrapper._metered = True
+        return wrapper
+    for handlers in (tb.message_handlers, tb.callback_query_handlers):
+        for handler in handlers:
+            handler["function"] = metered(handler["function"])
+    # route_message и callback_dispatch — только вход, меряем и сами обработчики за ними
+    wrap_routes(metered)
+
+# === Исходящие запросы к Telegram ===
+# Все bot.* идут через OUTBOX.request (apihelper.CUSTOM_REQUEST_SENDER): одна keep-alive
+# сессия на процесс, token bucket на бота и на чат, 429 -> пауза на retry_after и повтор.
+# Хендлеры отправляют через tg.* — вызов уходит в очередь чата и не ждёт Telegram.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))  # сообщений в секунду в один чат
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRY_AFTER = float(os.getenv("TG_MAX_RETRY_AFTER", "60"))
+TG_OUTBOX_PUT_TIMEOUT = float(os.getenv("TG_OUTBOX_PUT_TIMEOUT", "30"))  # ожидание места в полной очереди
+# лимиты Telegram считают только сообщения; answerCallbackQuery, getMe и т.п. не ждут
+TG_LIMITED_PREFIXES = ("send", "edit", "copyMessage", "forwardMessage")
+
+class TokenBucket:
+    """rate токенов в секунду, в запасе не больше burst. reserve() занимает токен
+    и возвращает, сколько ждать до его появления (0 — можно сразу)."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до свободного токена — не занимая его."""
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """После 429: следующий токен появится ровно через seconds."""
+        self.reserve(now)
+        self.tokens = min(self.tokens + 1, 1 - seconds * self.rate)
+
+class _Deferred(Exception):
+    """Вызов в потоке шарда не может уйти сейчас (лимит чата, 429): задание вернётся
+    в очередь своего чата через delay секунд, а шард тем временем обслужит другие чаты."""
+
+    def __init__(self, delay: float, flood: bool = False):
+        super().__init__(delay)
+        self.delay = delay
+        self.flood = flood
+
+class TelegramDispatcher:
+    """Транспорт Bot API и очередь исходящих вызовов. Очередь шардирована по чату
+    (hash(key) % workers, один поток на шард), внутри шарда у каждого чата своя очередь —
+    сообщения одного чата уходят по порядку, а чат, упёршийся в лимит или 429, откладывается
+    и не задерживает остальные чаты шарда."""
+
+    def __init__(self, workers: int = 4, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 chat_burst: float = TG_CHAT_BURST, max_retries: int = 3, max_depth: int = 5000,
+                 max_chats: int = 10000, put_timeout: float = TG_OUTBOX_PUT_TIMEOUT):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_depth = max_depth
+        self.put_timeout = put_timeout
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # depth уменьшился
+        self._local = threading.local()  # worker — поток шарда; deferrable — вызов можно отложить
+        self._session: Optional[requests.Session] = None
+        self._session_pid = None
+        self._queues: list[queue.Queue] = []
+        self._threads: list[threading.Thread] = []
+        self._pid = None
+        self._depth = 0
+        self._stats = {"requests": 0, "throttled": 0, "deferred": 0, "retry_after": 0, "submitted": 0,
+                       "blocked": 0, "rejected": 0, "failed": 0}
+
+    # --- транспорт ---
+    def _http(self) -> requests.Session:
+        # соединения requests не переживают fork — своя сессия в каждом воркере gunicorn
+        if self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers + 8)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session, self._session_pid = session, os.getpid()
+        return self._session
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
         else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _wait_turn(self, chat_id, deferrable: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            # поток шарда не спит за один чат: задание отложится, шард займётся другими
+            chat_delay = self._chat_bucket(chat_id).delay(now) if deferrable and chat_id is not None else 0.0
+            if chat_delay > 0:
+                self._stats["deferred"] += 1
+            else:
+                delay = self._global.reserve(now)
+                if chat_id is not None:
+                    delay = max(delay, self._chat_bucket(chat_id).reserve(now))
+                if delay > 0:
+                    self._stats["throttled"] += 1
+        if chat_delay > 0:
+            METRICS.inc("bot_telegram_throttled_total")
+            raise _Deferred(chat_delay)
+        if delay > 0:
+            METRICS.inc("bot_telegram_throttled_total")
+            time.sleep(delay)  # общий лимит бота: ждут все чаты одинаково
+
+    def request(self, method, url, params=None, files=None, **kwargs):
+        """Подменяет requests.request в apihelper (сигнатура CUSTOM_REQUEST_SENDER)."""
+        api_method = url.rsplit("/", 1)[-1]
+        limited = api_method.startswith(TG_LIMITED_PREFIXES)
+        chat_id = (params or {}).get("chat_id")
+        if isinstance(chat_id, str):
+            chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else None
+        for attempt in range(self.max_retries + 1):
+            # отложить можно только первый запрос задания: после ответа повтор задания
+            # целиком задвоил бы уже ушедшее; файлы при повторе перечитываются здесь же
+            deferrable = getattr(self._local, "deferrable", False) and not files
+            self._local.deferrable = False
+            if limited:
+                self._wait_turn(chat_id, deferrable)
+            if attempt and files:
+                for value in files.values():
+                    f = value[1] if isinstance(value, tuple) else value
+                    if hasattr(f, "seek"):
+                        f.seek(0)
+            resp = self._http().request(method, url, params=params, files=files, **kwargs)
+            with self._lock:
+                self._stats["requests"] += 1
+            if resp.status_code != 429 or attempt == self.max_retries:
+                return resp
+            try:
+                retry_after = float(resp.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1.0
+            if retry_after > TG_MAX_RETRY_AFTER:
+                return resp
+            METRICS.inc("bot_telegram_retry_after_total", (("method", api_method),))
+            with self._lock:
+                self._stats["retry_after"] += 1
+                if limited:
+                    now = time.monotonic()
+                    # flood control чата тормозит только этот чат, остальное — всего бота
+                    (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(now, retry_after)
+            if limited and chat_id is not None and deferrable:
+                raise _Deferred(retry_after, flood=True)
+            if not limited:
+                time.sleep(retry_after)  # лимитированные переждут паузу корзины в _wait_turn
+        return resp
+
+    # --- очередь ---
+    def _ensure_started(self) -> None:
+        # как UpdateQueue: потоки стартуют лениво в каждом воркере gunicorn
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue() for _ in range(self.workers)]
+            self._threads = []
+            self._depth = 0
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"outbox-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def submit(self, key, fn, *args, **kwargs) -> Future:
+        """Выполнить fn(*args, **kwargs) в потоке шарда key (обычно chat_id).
+        Очередь переполнена — ждём места до put_timeout: вызов мимо очереди обогнал бы
+        уже поставленные сообщения чата. Не дождались (или зовёт сам поток шарда, которому
+        ждать себя же нельзя) — Future с queue.Full."""
+        self._ensure_started()
+        fut = Future()
+        with self._cond:
+            if self._depth >= self.max_depth:
+                self._stats["blocked"] += 1
+                if getattr(self._local, "worker", False) or not self._cond.wait_for(
+                        lambda: self._depth < self.max_depth, self.put_timeout):
+                    self._stats["rejected"] += 1
+                    log.warning("Outbox full, %s dropped", getattr(fn, "__name__", fn))
+                    fut.set_exception(queue.Full("очередь исходящих переполнена"))
+                    return fut
+            self._depth += 1
+            self._stats["submitted"] += 1
+        # [key, future, fn, args, kwargs, ответов 429 подряд]
+        self._queues[hash(key) % self.workers].put([key, fut, fn, args, kwargs, 0])
+        return fut
+
+    def flush(self, key, timeout: Optional[float] = None) -> None:
+        """Ждёт, пока уйдут все вызовы, поставленные для key до этого момента."""
+        self.submit(key, lambda: None).result(timeout)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """Ждёт, пока очередь не опустеет целиком."""
+        self._ensure_started()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._depth == 0, timeout):
+                raise TimeoutError("OUTBOX не опустел за отведённое время")
+
+    def _execute(self, job: list, deferrable: bool) -> None:
+        _, fut, fn, args, kwargs, _ = job
+        self._local.deferrable = deferrable
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except _Deferred:
             raise
+        except Exception as e:
+            with self._lock:
+                self._stats["failed"] += 1
+            log.warning("Outgoing %s failed: %s", getattr(fn, "__name__", fn), e)
+            fut.set_exception(e)
+        finally:
+            self._local.deferrable = False
 
-# Пример простого меню
-def main_menu():
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("📣 Сообщить о проблеме", callback_data="report|start"))
-    kb.add(types.InlineKeyboardButton("👤 Профиль", callback_data="profile|view"))
-    return kb
+    def _run(self, q: queue.Queue) -> None:
+        # pending: очередь заданий каждого ключа шарда; ready — ключи, которым можно слать
+        # (по кругу); waiting — куча (когда, n, ключ) отложенных до освобождения лимита
+        self._local.worker = True
+        pending: dict = {}
+        ready: deque = deque()
+        waiting: list = []
+        order = itertools.count()
+        stopping = False
+        while True:
+            now = time.monotonic()
+            while waiting and waiting[0][0] <= now:
+                ready.append(heapq.heappop(waiting)[2])
+            if stopping and not pending:
+                return
+            timeout = None if not waiting else max(waiting[0][0] - now, 0.0)
+            try:
+                item = q.get_nowait() if ready else q.get(timeout=timeout)
+                while True:
+                    if item is None:
+                        stopping = True
+                    else:
+                        if item[0] not in pending:
+                            pending[item[0]] = deque()
+                            ready.append(item[0])
+                        pending[item[0]].append(item)
+                    item = q.get_nowait()
+            except queue.Empty:
+                pass
+            if not ready:
+                continue
+            key = ready.popleft()
+            jobs = pending[key]
+            job = jobs[0]
+            try:
+                # после max_retries ответов 429 подряд задание ждёт паузу прямо в потоке
+                self._execute(job, deferrable=job[5] <= self.max_retries)
+            except _Deferred as e:
+                job[5] += e.flood
+                heapq.heappush(waiting, (time.monotonic() + e.delay, next(order), key))
+                continue
+            jobs.popleft()
+            if jobs:
+                ready.append(key)
+            else:
+                del pending[key]
+            with self._cond:
+                self._depth -= 1
+                self._cond.notify_all()
 
-@bot.message_handler(commands=["start"])
-def cmd_start(message: types.Message):
-    bot.send_message(message.chat.id, "Добро пожаловать! Выберите действие:", reply_markup=main_menu())
+    def stop(self, timeout: float = 10.0) -> None:
+        """Отправляет уже поставленное и останавливает потоки."""
+        if self._pid != os.getpid():
+            return
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._pid = None
 
-@bot.callback_query_handler(func=lambda cq: cq.data.startswith("report|"))
-def report_callbacks(cq: types.CallbackQuery):
-    safe_edit_text(cq.message.chat.id, cq.message.message_id, "Форма для заявки пока в разработке…", reply_markup=main_menu())
-    bot.answer_callback_query(cq.id)
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "depth": self._depth, "chats": len(self._chats), **self._stats}
 
-@bot.callback_query_handler(func=lambda cq: cq.data.startswith("profile|"))
-def profile_callbacks(cq: types.CallbackQuery):
-    safe_edit_text(cq.message.chat.id, cq.message.message_id, "Раздел профиля пока в разработке…", reply_markup=main_menu())
-    bot.answer_callback_query(cq.id)
+class QueuedBot:
+    """tg.send_message(...) и т.д.: тот же вызов bot.*, но через очередь чата; возвращает Future.
+    Кому нужен ответ (file_id и т.п.) — .result(), порядок в чате при этом сохраняется."""
 
-if __name__ == "__main__":
-    # Для локального теста можно включить polling, если TELEGRAM_MODE=polling
-    mode = os.getenv("TELEGRAM_MODE", "webhook")
-    if mode == "polling":
-        print("🤖 Бот запущен (polling)")
-        bot.infinity_polling(timeout=60, long_polling_timeout=60, skip_pending=True)
-    else:
-        print("🌐 Webhook режим. Flask-приложение запущено.")
-        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+    def __init__(self, tb: telebot.TeleBot, dispatcher: TelegramDispatcher):
+        self._bot = tb
+        self._dispatcher = dispatcher
+
+    @staticmethod
+    def _key(args: tuple, kwargs: dict):
+        if "chat_id" in kwargs:
+            return kwargs["chat_id"]
+        if args:
+            first = args[0]
+            if isinstance(first, types.Message):
+                return first.chat.id
+            return first  # chat_id или id callback-запроса
+        return None
+
+    def __getattr__(self, name: str):
+        fn = getattr(self._bot, name)
+
+        def call(*args, **kwargs) -> Future:
+            return self._dispatcher.submit(self._key(args, kwargs), fn, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+OUTBOX = TelegramDispatcher(
+    workers=int(os.getenv("TG_OUTBOX_WORKERS", "8")),
+    max_depth=int(os.getenv("TG_OUTBOX_MAX", "5000")),
+)
+apihelper.CUSTOM_REQUEST_SENDER = OUTBOX.request
+# свой Bot API server или tg_stub.py: http://127.0.0.1:8081/bot{0}/{1}
+apihelper.API_URL = os.getenv("BOT_API_URL") or None
+tg = QueuedBot(bot, OUTBOX)
+METRICS.describe("bot_telegram_retry_after_total", "counter", "Ответы 429, переждённые по retry_after")
+METRICS.describe("bot_telegram_throttled_total", "counter", "Запросы, придержанные token bucket")
+METRICS.gauge("bot_outbox_depth", "Исходящие вызовы в очереди OUTBOX", lambda: OUTBOX.stats()["depth"])
+
+# === Очередь входящих апдейтов ===
+def update_chat_id(update: types.Update) -> int:
+    for msg in (update.message, update.edited_message):
+        if msg is not None:
+            return msg.chat.id
+    cq = update.callback_query
+    if cq is not None:
+        return cq.message.chat.id if cq.message is not None else cq.from_user.id
+    return update.update_id
+
+class UpdateQueue:
+    """Пул воркеров для апдейтов из webhook. Апдейт попадает в шард chat_id % workers,
+    у каждого шарда один поток — шаги одного пользователя не перемешиваются."""
+
+    def __init__(self, process, workers: int = 4, max_depth: int = 1000):
+        self.process = process
+        self.workers = workers
+        self.max_depth = max_depth
+        self._queues: list[queue.Queue] = []
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._depth = 0
+        self._stats = {"enqueued": 0, "processed": 0, "rejected": 0, "errors": 0, "max_depth_seen": 0}
+
+    def _ensure_started(self) -> None:
+        # потоки не переживают fork: стартуем лениво в каждом воркере gunicorn
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue() for _ in range(self.workers)]
+            self._threads = []
+            self._depth = 0
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"updates-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def submit(self, update: types.Update) -> bool:
+        """Ставит апдейт в очередь; False — очередь переполнена (backpressure)."""
+        self._ensure_started()
+        with self._lock:
+            if self._depth >= self.max_depth:
+                self._stats["rejected"] += 1
+                return False
+            self._depth += 1
+            self._stats["enqueued"] += 1
+            self._stats["max_depth_seen"] = max(self._stats["max_depth_seen"], self._depth)
+        self._queues[update_chat_id(update) % self.workers].put(update)
+        return True
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            try:
+                self.process([update])
+                key = "processed"
+            except Exception:
+                log.exception("Update %s failed", update.update_id)
+                key = "errors"
+            with self._lock:
+                self._depth -= 1
+                self._stats[key] += 1
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Дорабатывает уже принятые апдейты и останавливает потоки."""
+        if self._pid != os.getpid():
+            return
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._pid = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_depth": self.max_depth,
+                "depth": self._depth,
+                "shard_depth": [q.qsize() for q in self._queues],
+                **self._stats,
+            }
+
+UPDATES = UpdateQueue(
+    bot.process_new_updates,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+    max_depth=int(os.getenv("WEBHOOK_QUEUE_MAX", "1000")),
+)
+METRICS.gauge("bot_update_queue_depth", "Принятые, но ещё не обработанные апдейты UpdateQueue",
+              lambda: UPDATES.stats()["depth"])
+
+# === Повторные доставки ===
+# Не ответили вовремя — Telegram присылает тот же апдейт ещё раз, и без защиты описание
+# поломки превращается во вторую заявку. Апдейт принимается один раз на update_id: сначала
+# окно последних id в памяти воркера (O(1)), при промахе — захват строки в processed_updates
+# (INSERT OR IGNORE по первичному ключу), так что дубль, попавший в соседний воркер gunicorn,
+# тоже отсекается. Дубль получает 200 OK без разбора в Update и без обработчиков. Строки
+# старше UPDATE_DEDUP_TTL удаляются не чаще раза в UPDATE_DEDUP_PRUNE_EVERY.
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "4096"))
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "86400"))  # Telegram хранит апдейт до суток
+UPDATE_DEDUP_PRUNE_EVERY = float(os.getenv("UPDATE_DEDUP_PRUNE_EVERY", "600"))
+
+class UpdateDeduper:
+    def __init__(self, window: int = 4096, ttl: float = 86400, prune_every: float = 600):
+        self.window = window
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._recent: OrderedDict[int, None] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        self._stats = {"claimed": 0, "duplicate_memory": 0, "duplicate_db": 0, "released": 0,
+                       "pruned": 0, "db_errors": 0}
+
+    def claim(self, update_id: int) -> bool:
+        """True — апдейт новый и теперь наш; False — его уже принял этот или другой воркер."""
+        with self._lock:
+            if update_id in self._recent:
+                self._stats["duplicate_memory"] += 1
+                return False
+            # в окно — до захвата в базе: параллельный дубль в этом воркере отсечётся здесь
+            self._recent[update_id] = None
+            if len(self._recent) > self.window:
+                self._recent.popitem(last=False)
+        def _do(c: sqlite3.Cursor):
+            c.execute("INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+                      (update_id, int(time.time())))
+            return c.rowcount > 0
+        try:
+            claimed = db_write(_do)
+        except sqlite3.Error:
+            # без базы защищает только окно воркера — лучше, чем терять апдейты
+            log.exception("Update %s: dedupe claim failed", update_id)
+            with self._lock:
+                self._stats["db_errors"] += 1
+            return True
+        with self._lock:
+            self._stats["claimed" if claimed else "duplicate_db"] += 1
+        self._maybe_prune()
+        return claimed
+
+    def release(self, update_id: int) -> None:
+        """Отказ от апдейта (не взяли в очередь): повторная доставка должна пройти."""
+        with self._lock:
+            self._recent.pop(update_id, None)
+            self._stats["released"] += 1
+        def _do(c: sqlite3.Cursor):
+            c.execute("DELETE FROM processed_updates WHERE update_id=?", (update_id,))
+        try:
+            db_write(_do)
+        except sqlite3.Error:
+            log.exception("Update %s: dedupe release failed", update_id)
+
+    def _maybe_prune(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._pruned_at < self.prune_every:
+                return
+            self._pruned_at = time.monotonic()
+        def _do(c: sqlite3.Cursor):
+            c.execute("DELETE FROM processed_updates WHERE received_at < ?", (int(time.time() - self.ttl),))
+            return c.rowcount
+        WRITER.submit(_do).add_done_callback(self._pruned)
+
+    def _pruned(self, fut: Future) -> None:
+        if fut.exception() is None:
+            with self._lock:
+                self._stats["pruned"] += fut.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"window": len(self._recent), **self._stats}
+
+UPDATE_DEDUP = UpdateDeduper(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_TTL, UPDATE_DEDUP_PRUNE_EVERY)
+
+# === Webhook endpoint ===
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    if request.headers.get('content-type') != 'application/json':
+        METRICS.inc("bot_webhook_updates_total", (("status", "unsupported"),))
+        return "Unsupported Media Type", 415
+    # разбираем до claim: битый апдейт не должен занимать update_id
+    try:
+        payload = json.loads(request.get_data())
+        update_id = int(payload["update_id"])
+        update = telebot.types.Update.de_json(payload)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        update = None
+    if update is None:
+        METRICS.inc("bot_webhook_updates_total", (("status", "bad_request"),))
+        return "Bad Request", 400
+    if not UPDATE_DEDUP.claim(update_id):
+        METRICS.inc("bot_webhook_updates_total", (("status", "duplicate"),))
+        return "OK", 200
+    if not UPDATES.submit(update):
+        UPDATE_DEDUP.release(update_id)
+        METRICS.inc("bot_webhook_updates_total", (("status", "rejected"),))
+        # Telegram повторит доставку позже
+        return "Service Unavailable", 503, {"Retry-After": "1"}
+    METRICS.inc("bot_webhook_updates_total", (("status", "accepted"),))
+    return "OK", 200
+
+@app.route("/")
+def health():
+    return "OK", 200
+
+@app.route("/metrics")
+def metrics():
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 # =====================
 # 📚 СПРАВОЧНИКИ
@@ -100,235 +735,1323 @@ ROLES = [
     "технолог",
 ]
 
-PRODUCTION_MACHINES = ["Станок №1", "Станок №12", "Станок №8", "Станок №9", "Станок №11", "Станок №11А"]
-PACKING_LINES = ["0.3Н", "0.3Б", "0.8", "2.5", "Элита"]
+# =====================
+# 🧠 СЕССИИ (подключаемое хранилище: memory / sqlite)
+# =====================
+# Сессия в хранилище — компактная пара (step, data в JSON). Пустые сессии
+# не хранятся. В рамках одного апдейта сессии живут в session-scope потока
+# и сохраняются одним вызовом в конце (SessionMiddleware).
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
+SESSION_SWEEP_EVERY = float(os.getenv("SESSION_SWEEP_EVERY", "300"))
 
-# Фасовка: после выбора линии (кроме "2.5") — выбираем узел
-PACKING_COMPONENTS_DEFAULT = [
-    "бункер", "конвейер. лента", "корзина", "принтер", "фото-метка",
-    "формовка пакета", "встряхиватель", "замена трубы", "другое",
-]
+class MemorySessionStore:
+    """Сессии в памяти процесса — для polling и одного воркера."""
 
-# Производство: узлы по станкам
-PRODUCTION_COMPONENTS = {
-    "Станок №1": ["ванна", "просеиватель", "пружина", "дозатор", "замес",
-                  "питатель", "пресс", "нож", "трабатта", "лоткоподача", "штабелер", "другое"],
-    "Станок №12": ["ванна", "просеиватель", "пружина", "дозатор", "замес",
-                   "питатель", "пресс", "нож", "трабатта", "лоткоподача", "штабелер", "другое"],
-    "Станок №8": ["ванна", "просеиватель", "пружина", "дозатор", "замес",
-                  "питатель", "пресс", "нож", "трабатта", "группорезка", "другое"],
-    "Станок №9": ["ванна", "просеиватель", "пружина", "дозатор", "замес",
-                  "питатель", "пресс", "нож", "трабатта"],
-    "Станок №11": ["ванна", "просеиватель", "бункер замеса", "раскатка",
-                   "калибратор", "нож", "лоткоподача", "другое"],
-    "Станок №11А": ["ванна", "просеиватель", "бункер замеса", "раскатка",
-                    "калибратор", "нож", "лоткоподача", "штабелер", "другое"],
-}
+    def __init__(self, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self._data: dict[int, tuple[float, Optional[str], str]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + SESSION_SWEEP_EVERY
 
-# Станок №8 → группорезка → подузлы
-PROD_GROUP_CUT_SUB = ["лоткоподача", "другое"]
+    def load(self, user_id: int) -> Optional[tuple[Optional[str], str]]:
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] < time.time() - self.ttl:
+            return None
+        return entry[1], entry[2]
 
-# Транспорт
-TRANSPORT_TYPES = ["Грузовой транспорт", "Погрузчики"]
+    def save(self, user_id: int, step: Optional[str], data: str) -> None:
+        with self._lock:
+            self._data[user_id] = (time.time(), step, data)
 
-# Техническое оборудование
-TECH_EQUIPMENT = ["компрессор", "котельная", "приточ. вентиляция", "другое"]
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._data.pop(user_id, None)
 
-# =====================
-# 🧠 СЕССИИ (in-memory)
-# =====================
-SESSION: dict[int, dict] = {}
+    def sweep(self) -> int:
+        border = time.time() - self.ttl
+        with self._lock:
+            expired = [uid for uid, entry in self._data.items() if entry[0] < border]
+            for uid in expired:
+                del self._data[uid]
+        return len(expired)
+
+    def maybe_sweep(self) -> None:
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + SESSION_SWEEP_EVERY
+            self.sweep()
+
+    def count(self) -> int:
+        return len(self._data)
+
+class SQLiteSessionStore(MemorySessionStore):
+    """Сессии в таблице sessions той же БД — общие для всех воркеров gunicorn."""
+
+    def __init__(self, ttl: float = SESSION_TTL, sweep_batch: int = 500):
+        super().__init__(ttl)
+        self.sweep_batch = sweep_batch
+
+    @METRICS.timed("bot_db_seconds", "helper")
+    def load(self, user_id: int) -> Optional[tuple[Optional[str], str]]:
+        with get_conn() as conn:
+            return conn.execute(
+                "SELECT step, data FROM sessions WHERE user_id=? AND updated_at>=?",
+                (user_id, int(time.time() - self.ttl)),
+            ).fetchone()
+
+    @METRICS.timed("bot_db_seconds", "helper")
+    def save(self, user_id: int, step: Optional[str], data: str) -> None:
+        def _do(c: sqlite3.Cursor):
+            c.execute(
+                """
+                INSERT INTO sessions (user_id, step, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE
+                SET step=excluded.step, data=excluded.data, updated_at=excluded.updated_at
+                """,
+                (user_id, step, data, int(time.time())),
+            )
+        db_write(_do)
+
+    @METRICS.timed("bot_db_seconds", "helper")
+    def delete(self, user_id: int) -> None:
+        def _do(c: sqlite3.Cursor):
+            c.execute("DELETE FROM sessions WHERE user_id=?", (user_id,))
+        db_write(_do)
+
+    @METRICS.timed("bot_db_seconds", "helper")
+    def sweep(self) -> int:
+        """Удаляет просроченные сессии пачками по sweep_batch (короткие транзакции)."""
+        border = int(time.time() - self.ttl)
+        total = 0
+
+        def _do(c: sqlite3.Cursor) -> int:
+            return c.execute(
+                """
+                DELETE FROM sessions WHERE user_id IN (
+                    SELECT user_id FROM sessions WHERE updated_at < ? LIMIT ?
+                )
+                """,
+                (border, self.sweep_batch),
+            ).rowcount
+
+        while True:
+            n = db_write(_do)
+            total += n
+            if n < self.sweep_batch:
+                return total
+
+    @METRICS.timed("bot_db_seconds", "helper")
+    def count(self) -> int:
+        with get_conn() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+SESSION_BACKENDS = {"memory": MemorySessionStore, "sqlite": SQLiteSessionStore}
+SESSIONS = SESSION_BACKENDS[os.getenv("SESSION_BACKEND", "sqlite")]()
+METRICS.gauge("bot_sessions", "Незавершённые сессии пользователей", lambda: SESSIONS.count())
+
+_session_local = threading.local()
+_UNKNOWN = object()
+
+def session_begin() -> None:
+    _session_local.sessions = {}
+
+def session_flush() -> None:
+    """Сохраняет изменённые за апдейт сессии и закрывает scope потока."""
+    sessions = getattr(_session_local, "sessions", None)
+    _session_local.sessions = None
+    if not sessions:
+        return
+    for user_id, (s, original) in sessions.items():
+        step = s.get("step")
+        data = s.get("data") or {}
+        if step is None and not data:
+            if original is not None:
+                SESSIONS.delete(user_id)
+            continue
+        packed = (step, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        if original is None or original is _UNKNOWN or packed != tuple(original):
+            SESSIONS.save(user_id, *packed)
+    SESSIONS.maybe_sweep()
+
+@contextmanager
+def session_scope():
+    if getattr(_session_local, "sessions", None) is not None:
+        yield
+        return
+    session_begin()
+    try:
+        yield
+    finally:
+        session_flush()
 
 def ensure_session(user_id: int) -> dict:
-    if user_id not in SESSION:
-        SESSION[user_id] = {"step": None, "data": {}}
-    return SESSION[user_id]
+    """Сессия пользователя. Изменения сохраняются только внутри session_scope
+    (для апдейтов бота его открывает SessionMiddleware)."""
+    scope = getattr(_session_local, "sessions", None)
+    if scope is not None and user_id in scope:
+        return scope[user_id][0]
+    row = SESSIONS.load(user_id)
+    s = {"step": row[0], "data": json.loads(row[1])} if row else {"step": None, "data": {}}
+    if scope is not None:
+        scope[user_id] = (s, row)
+    return s
+
+def session_step(user_id: int) -> Optional[str]:
+    return ensure_session(user_id).get("step")
 
 def reset_session(user_id: int) -> None:
-    SESSION[user_id] = {"step": None, "data": {}}
+    scope = getattr(_session_local, "sessions", None)
+    if scope is None:
+        SESSIONS.delete(user_id)
+        return
+    original = scope[user_id][1] if user_id in scope else _UNKNOWN
+    scope[user_id] = ({"step": None, "data": {}}, original)
+
+class SessionMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, message, data):
+        session_begin()
+
+    def post_process(self, message, data, exception):
+        session_flush()
+
+bot.setup_middleware(SessionMiddleware())
 
 # =====================
 # 🗄️ БАЗА ДАННЫХ + устойчивость к конкуренции
 # =====================
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("PRAGMA journal_mode=WAL;")
-    c.execute("PRAGMA busy_timeout=5000;")
-    c.close()
-    return conn
-
-def with_retry(fn, retries=3, pause=0.2):
-    last = None
-    for i in range(retries):
+# --- трассировка SQL (opt-in: DB_TRACE=1) ---
+# Соединения пула и писателя создаются с factory=TracingConnection: время execute и fetch*
+# копится по нормализованному тексту запроса; запрос дольше DB_SLOW_QUERY_MS пишется в лог
+# с формой параметров (только типы — в значениях ФИО) и EXPLAIN QUERY PLAN.
+# set_trace_callback видит и то, что SQLite выполняет сам: тела триггеров (счётчик
+# statements у запроса) и неявные BEGIN модуля sqlite3.
+DB_TRACE = os.getenv("DB_TRACE", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))
+
+_SQL_SPACES_RE = re.compile(r"\s+")
+_SQL_LITERALS_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_SQL_PLACEHOLDERS_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+
+def sql_normalize(sql: str) -> str:
+    """Ключ агрегата: без лишних пробелов, литералы -> ?, списки ?, ?, ? -> ?, …"""
+    sql = _SQL_LITERALS_RE.sub("?", _SQL_SPACES_RE.sub(" ", sql).strip())
+    return _SQL_PLACEHOLDERS_RE.sub("?, …", sql)
+
+def sql_params_shape(params) -> str:
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    return "(" + ", ".join(type(v).__name__ for v in params) + ")"
+
+class QueryStats:
+    """Агрегаты по запросам и кольцо последних медленных запросов."""
+
+    FIELDS = ("count", "total", "max", "rows", "statements")
+
+    def __init__(self, slow_after: float = DB_SLOW_QUERY_MS / 1000, keep_slow: int = 50):
+        self.slow_after = slow_after
+        self._lock = threading.Lock()
+        self._stats: dict[str, list] = {}  # sql -> [count, total, max, rows, statements]
+        self.implicit_begins = 0
+        self.slow: deque = deque(maxlen=keep_slow)
+
+    def _entry(self, key: str) -> list:
+        entry = self._stats.get(key)
+        if entry is None:
+            entry = self._stats[key] = [0, 0.0, 0.0, 0, 0]
+        return entry
+
+    def started(self, key: str, statements: int = 0) -> None:
+        with self._lock:
+            entry = self._entry(key)
+            entry[0] += 1
+            entry[4] += statements
+
+    def add(self, key: str, elapsed: float, total: float, rows: int = 0) -> None:
+        """elapsed — очередной кусок времени запроса, total — его время с начала выполнения."""
+        with self._lock:
+            entry = self._entry(key)
+            entry[1] += elapsed
+            entry[2] = max(entry[2], total)
+            entry[3] += rows
+
+    def top(self, n: int = 10, by: str = "total") -> list[dict]:
+        col = self.FIELDS.index(by)
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda kv: -kv[1][col])[:n]
+        return [{"sql": sql, "count": count, "total_ms": round(total * 1000, 2),
+                 "avg_ms": round(total / count * 1000, 3) if count else 0.0,
+                 "max_ms": round(mx * 1000, 2), "rows": rows, "statements": statements}
+                for sql, (count, total, mx, rows, statements) in items]
+
+    def implicit_begin(self) -> None:
+        with self._lock:
+            self.implicit_begins += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self.implicit_begins = 0
+            self.slow.clear()
+
+QUERY_STATS = QueryStats()
+
+class TracingCursor(sqlite3.Cursor):
+    """Время execute и последующих fetch* относится к последнему выполненному запросу курсора."""
+    _key = None
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        if self._key is not None:
+            if result is self:
+                rows = max(self.rowcount, 0)  # DML; для SELECT rowcount = -1
+            elif isinstance(result, list):
+                rows = len(result)
+            else:
+                rows = result is not None
+            self._total += elapsed
+            QUERY_STATS.add(self._key, elapsed, self._total, rows)
+            if self._total >= QUERY_STATS.slow_after and not self._slow_logged:
+                self._slow_logged = True
+                self.connection.log_slow(self._sql, self._params, self._total)
+        return result
+
+    def _begin(self, sql: str, params, run, *args):
+        self._key, self._sql, self._params = sql_normalize(sql), sql, params
+        self._total, self._slow_logged = 0.0, False
+        conn = self.connection
+        before = conn.statements
         try:
-            return fn()
-        except sqlite3.OperationalError as e:
-            last = e
-            time.sleep(pause * (i + 1))
-    raise last
+            return self._timed(run, *args)
+        finally:
+            QUERY_STATS.started(self._key, conn.statements - before)
 
-def db_init() -> None:
-    with get_conn() as conn:
-        c = conn.cursor()
+    def execute(self, sql, params=()):
+        return self._begin(sql, params, super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        first = seq_of_params[0] if seq_of_params else ()
+        return self._begin(sql, first, super().executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+class TracingConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        self.set_trace_callback(self._on_trace)
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() и др. создают курсор внутри C-кода, мимо cursor(): без этих
+    # обёрток запросы conn.execute(...) не попадали бы в QUERY_STATS
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def _on_trace(self, statement: str) -> None:
+        if statement == "BEGIN ":
+            QUERY_STATS.implicit_begin()  # неявная транзакция модуля sqlite3 перед DML
+            return
+        self.statements += 1
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_STATS.started("COMMIT")
+            QUERY_STATS.add("COMMIT", elapsed, elapsed)
+
+    def log_slow(self, sql: str, params, elapsed: float) -> None:
+        plan = []
+        if sql.lstrip()[:6].upper() in ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT"):
+            try:
+                # обычный курсор: план не попадает в статистику
+                c = sqlite3.Connection.cursor(self)
+                plan = [row[3] for row in c.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            except sqlite3.Error as e:
+                plan = [f"EXPLAIN failed: {e}"]
+        entry = {"at": datetime.now().isoformat(timespec="seconds"), "ms": round(elapsed * 1000, 1),
+                 "sql": sql_normalize(sql), "params": sql_params_shape(params), "plan": plan}
+        QUERY_STATS.slow.append(entry)
+        log.warning("Slow query %.1f ms: %s params=%s plan=%s",
+                    entry["ms"], entry["sql"], entry["params"], " | ".join(plan))
+
+class ConnectionPool:
+    """Пул соединений SQLite: PRAGMA выполняются один раз на соединение,
+    соединения переиспользуются между потоками, общее число ограничено max_size.
+    readonly=True — соединения только для чтения (mode=ro + query_only) для отчётов."""
+
+    def __init__(self, path: str, max_size: int = 8, acquire_timeout: float = 10.0,
+                 health_check_after: float = 30.0, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._idle: list[tuple[sqlite3.Connection, float]] = []
+        self._size = 0
+        self._pid = os.getpid()
+        self._stats = {"created": 0, "reused": 0, "discarded": 0, "waits": 0,
+                       "timeouts": 0, "health_failures": 0}
+
+    def new_connection(self) -> sqlite3.Connection:
+        """Новое соединение с теми же PRAGMA (используется и вне пула — для писателя)."""
+        factory = TracingConnection if DB_TRACE else sqlite3.Connection
+        if self.readonly:
+            # WAL уже включён писателем; mode=ro не даст его переключить, query_only — записать
+            conn = sqlite3.connect(Path(self.path).resolve().as_uri() + "?mode=ro", uri=True,
+                                   timeout=30, check_same_thread=False, factory=factory)
+            c = conn.cursor()
+            c.execute("PRAGMA query_only=ON;")
+        else:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, factory=factory)
+            c = conn.cursor()
+            c.execute("PRAGMA journal_mode=WAL;")
+        c.execute("PRAGMA busy_timeout=5000;")
+        c.close()
+        return conn
+
+    def _check_fork(self) -> None:
+        # после fork (gunicorn) соединения родителя использовать нельзя
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    if time.monotonic() - last_used > self.health_check_after and not self._healthy(conn):
+                        self._stats["health_failures"] += 1
+                        self._discard_locked(conn)
+                        continue
+                    self._stats["reused"] += 1
+                    return conn
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    # OperationalError — вызывающий видит то же, что и при занятой БД
+                    raise sqlite3.OperationalError("connection pool exhausted")
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+        try:
+            conn = self.new_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._lock:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard_locked(self, conn: sqlite3.Connection) -> None:
+        self._size -= 1
+        self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._cond.notify()
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False) -> None:
+        if not broken and conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            if broken:
+                self._discard_locked(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока: commit при успехе, rollback при ошибке."""
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException as e:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+            if isinstance(e, sqlite3.DatabaseError) and not isinstance(e, sqlite3.OperationalError):
+                broken = broken or not self._healthy(conn)
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._stats,
+            }
+
+    def close_all(self) -> None:
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard_locked(conn)
+
+DB_POOL = ConnectionPool(
+    DB_PATH,
+    max_size=int(os.getenv("DB_POOL_SIZE", "8")),
+    acquire_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+)
+METRICS.gauge("bot_db_pool_in_use", "Соединения пула, выданные потокам", lambda: DB_POOL.stats()["in_use"])
+
+# отчёты (история, поиск, статистика, выгрузки) читают через отдельный пул: им не
+# нужна запись, и они не отнимают соединения у хендлеров, которые пишут
+READ_POOL = ConnectionPool(
+    DB_PATH,
+    max_size=int(os.getenv("DB_READ_POOL_SIZE", "4")),
+    acquire_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    readonly=True,
+)
+
+def get_conn():
+    return DB_POOL.connection()
+
+def get_read_conn():
+    return READ_POOL.connection()
+
+def db_pool_stats() -> dict:
+    return DB_POOL.stats()
+
+# =====================
+# ✍️ ГРУППОВАЯ ЗАПИСЬ (один писатель на процесс)
+# =====================
+class GroupCommitWriter:
+    """Единственный писатель процесса. Хендлеры ставят операцию op(cursor) в очередь
+    и получают Future с её результатом; поток-писатель собирает накопившиеся операции
+    (до batch_max, ожидая не дольше max_latency) и коммитит их одной транзакцией
+    BEGIN IMMEDIATE. Каждая операция — в своём SAVEPOINT: ошибка одной не откатывает
+    остальные."""
+
+    def __init__(self, connect, batch_max: int = 64, max_latency: float = 0.002, retries: int = 5):
+        self.connect = connect
+        self.batch_max = batch_max
+        self.max_latency = max_latency
+        self.retries = retries
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"ops": 0, "batches": 0, "max_batch": 0, "busy_retries": 0, "failed_ops": 0}
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, op) -> Future:
+        self._ensure_started()
+        fut: Future = Future()
+        self._queue.put((op, fut))
+        return fut
+
+    def _run(self) -> None:
+        conn = self.connect()
+        conn.isolation_level = None  # транзакциями управляем сами
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.batch_max:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._commit(conn, batch)
+            except Exception as e:
+                try:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                finally:
+                    # упасть мог и сам SAVEPOINT/ROLLBACK TO — тогда транзакция осталась
+                    # открытой, и следующий батч вложился бы в неё или упал на BEGIN
+                    try:
+                        conn.rollback()
+                    except sqlite3.Error:
+                        log.exception("Writer rollback failed")
+            if stop:
+                break
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: list) -> None:
+        last = None
+        for attempt in range(self.retries):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                # другой процесс держит запись дольше busy_timeout
+                last = e
+                with self._lock:
+                    self._stats["busy_retries"] += 1
+                METRICS.inc("bot_db_retries_total")
+                time.sleep(0.05 * (attempt + 1))
+                continue
+            outcomes = []
+            for op, _ in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    outcomes.append((op(conn.cursor()), None))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    outcomes.append((None, e))
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                last = e
+                conn.execute("ROLLBACK")
+                with self._lock:
+                    self._stats["busy_retries"] += 1
+                METRICS.inc("bot_db_retries_total")
+                continue
+            failed = 0
+            for (_, fut), (result, error) in zip(batch, outcomes):
+                if error is None:
+                    fut.set_result(result)
+                else:
+                    failed += 1
+                    fut.set_exception(error)
+            with self._lock:
+                self._stats["ops"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+                self._stats["failed_ops"] += failed
+            return
+        raise last
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queue_depth": self._queue.qsize(), "batch_max": self.batch_max,
+                    "max_latency": self.max_latency, **self._stats}
+
+WRITER = GroupCommitWriter(
+    lambda: DB_POOL.new_connection(),
+    batch_max=int(os.getenv("WRITE_BATCH_MAX", "64")),
+    max_latency=float(os.getenv("WRITE_BATCH_LATENCY_MS", "2")) / 1000,
+)
+METRICS.gauge("bot_db_write_queue_depth", "Операции в очереди GroupCommitWriter",
+              lambda: WRITER.stats()["queue_depth"])
+
+def db_write(op, timeout: float = 30.0):
+    """Выполняет op(cursor) в писателе и ждёт результат (lastrowid, rowcount и т.п.)."""
+    return WRITER.submit(op).result(timeout)
+
+# =====================
+# 🧱 МИГРАЦИИ СХЕМЫ (версия в PRAGMA user_version)
+# =====================
+def _migration_001_issues(c: sqlite3.Cursor) -> None:
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            area TEXT,
+            subarea TEXT,
+            equipment TEXT,
+            description TEXT NOT NULL,
+            status TEXT NOT NULL,
+            resolved_at TEXT,
+            resolver_id INTEGER,
+            resolver_name TEXT,
+            user_fio_snapshot TEXT,
+            user_role_snapshot TEXT
+        )
+        """
+    )
+
+def _migration_002_users(c: sqlite3.Cursor) -> None:
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            fio TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    # старые базы: колонок-снимков могло не быть
+    c.execute("PRAGMA table_info(issues)")
+    cols = {row[1] for row in c.fetchall()}
+    if "user_role_snapshot" not in cols:
+        c.execute("ALTER TABLE issues ADD COLUMN user_role_snapshot TEXT")
+    if "user_fio_snapshot" not in cols:
+        c.execute("ALTER TABLE issues ADD COLUMN user_fio_snapshot TEXT")
+
+def _migration_003_issue_indexes(c: sqlite3.Cursor) -> None:
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_status_id ON issues(status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_user_id ON issues(user_id, id)")
+
+def _migration_004_sessions(c: sqlite3.Cursor) -> None:
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            step TEXT,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at)")
+
+def _migration_005_export_versioning(c: sqlite3.Cursor) -> None:
+    c.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('issues', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
         c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS issues (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                user_name TEXT,
-                area TEXT,
-                subarea TEXT,
-                equipment TEXT,
-                description TEXT NOT NULL,
-                status TEXT NOT NULL,
-                resolved_at TEXT,
-                resolver_id INTEGER,
-                resolver_name TEXT,
-                user_fio_snapshot TEXT,
-                user_role_snapshot TEXT
-            )
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_issues_version_{event.lower()} AFTER {event} ON issues
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'issues';
+            END
             """
         )
-        conn.commit()
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            user_id INTEGER PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            last_resolved_at TEXT,
+            exported_at TEXT NOT NULL
+        )
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_resolved_at ON issues(resolved_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_created_at ON issues(created_at)")
 
-def db_init_users_and_migration() -> None:
-    with get_conn() as conn:
-        c = conn.cursor()
+def _fold_yo(expr: str) -> str:
+    # unicode61 не приравнивает «ё» к «е» — нормализуем текст до индексации
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+FTS_COLUMNS = ("description", "equipment", "area", "subarea")
+
+def _migration_006_issues_fts(c: sqlite3.Cursor) -> None:
+    cols = ", ".join(FTS_COLUMNS)
+    c.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts USING fts5({cols}, "
+        "tokenize='unicode61 remove_diacritics 2')"
+    )
+    new_values = ", ".join(_fold_yo(f"new.{col}") for col in FTS_COLUMNS)
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_issues_fts_insert AFTER INSERT ON issues
+        BEGIN
+            INSERT INTO issues_fts (rowid, {cols}) VALUES (new.id, {new_values});
+        END
+        """
+    )
+    # закрытие меняет только status/resolved_* — индекс переписывается лишь при правке текста
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_issues_fts_update AFTER UPDATE OF {cols} ON issues
+        BEGIN
+            DELETE FROM issues_fts WHERE rowid = old.id;
+            INSERT INTO issues_fts (rowid, {cols}) VALUES (new.id, {new_values});
+        END
+        """
+    )
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_issues_fts_delete AFTER DELETE ON issues
+        BEGIN
+            DELETE FROM issues_fts WHERE rowid = old.id;
+        END
+        """
+    )
+    c.execute("DELETE FROM issues_fts")
+    c.execute(
+        f"INSERT INTO issues_fts (rowid, {cols}) SELECT id, "
+        + ", ".join(_fold_yo(col) for col in FTS_COLUMNS) + " FROM issues"
+    )
+
+ROLLUP_PATH_SQL = "COALESCE(NULLIF({p}.equipment, ''), NULLIF({p}.subarea, ''), NULLIF({p}.area, ''), '—')"
+ROLLUP_REPAIR_SQL = "MAX(0, CAST((julianday({p}.resolved_at) - julianday({p}.created_at)) * 86400 AS INTEGER))"
+
+def _migration_007_rollups(c: sqlite3.Cursor) -> None:
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS issue_rollups (
+            equipment_path TEXT NOT NULL,
+            day TEXT NOT NULL,
+            failures INTEGER NOT NULL DEFAULT 0,
+            closed INTEGER NOT NULL DEFAULT 0,
+            repair_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (equipment_path, day)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issue_rollups_day ON issue_rollups(day)")
+    path, repair = ROLLUP_PATH_SQL.format(p="new"), ROLLUP_REPAIR_SQL.format(p="new")
+    closed_upsert = f"""
+        INSERT INTO issue_rollups (equipment_path, day, closed, repair_seconds)
+        SELECT {path}, substr(new.resolved_at, 1, 10), 1, {repair}
+        WHERE new.status = 'closed' AND new.resolved_at IS NOT NULL
+        ON CONFLICT (equipment_path, day) DO UPDATE
+        SET closed = closed + 1, repair_seconds = repair_seconds + excluded.repair_seconds;
+    """
+    # отказ — в день создания, ремонт — в день закрытия; удаление (архив) статистику не трогает
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_issues_rollup_insert AFTER INSERT ON issues
+        BEGIN
+            INSERT INTO issue_rollups (equipment_path, day, failures)
+            VALUES ({path}, substr(new.created_at, 1, 10), 1)
+            ON CONFLICT (equipment_path, day) DO UPDATE SET failures = failures + 1;
+            {closed_upsert}
+        END
+        """
+    )
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_issues_rollup_close AFTER UPDATE OF status ON issues
+        WHEN old.status = 'open' AND new.status = 'closed'
+        BEGIN
+            {closed_upsert}
+        END
+        """
+    )
+    rollups_rebuild_sql(c)
+
+def rollups_rebuild_sql(c: sqlite3.Cursor) -> None:
+    """Пересчёт issue_rollups с нуля по заявкам и архиву."""
+    path, repair = ROLLUP_PATH_SQL.format(p="i"), ROLLUP_REPAIR_SQL.format(p="i")
+    cols = "created_at, resolved_at, status, area, subarea, equipment"
+    table = f"(SELECT {cols} FROM issues"
+    if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='issues_archive'").fetchone():
+        table += f" UNION ALL SELECT {cols} FROM issues_archive"
+    table += ")"
+    c.execute("DELETE FROM issue_rollups")
+    c.execute(
+        f"""
+        INSERT INTO issue_rollups (equipment_path, day, failures, closed, repair_seconds)
+        SELECT path, day, SUM(failures), SUM(closed), SUM(repair_seconds) FROM (
+            SELECT {path} AS path, substr(i.created_at, 1, 10) AS day,
+                   1 AS failures, 0 AS closed, 0 AS repair_seconds
+            FROM {table} i
+            UNION ALL
+            SELECT {path}, substr(i.resolved_at, 1, 10), 0, 1, {repair}
+            FROM {table} i
+            WHERE i.status = 'closed' AND i.resolved_at IS NOT NULL
+        )
+        GROUP BY path, day
+        """
+    )
+
+def _migration_008_archive(c: sqlite3.Cursor) -> None:
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS issues_archive (
+            id INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            area TEXT,
+            subarea TEXT,
+            equipment TEXT,
+            description TEXT NOT NULL,
+            status TEXT NOT NULL,
+            resolved_at TEXT,
+            resolver_id INTEGER,
+            resolver_name TEXT,
+            user_fio_snapshot TEXT,
+            user_role_snapshot TEXT,
+            archived_at TEXT NOT NULL
+        )
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_archive_user_id ON issues_archive(user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_archive_resolved_at ON issues_archive(resolved_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_issues_archive_created_at ON issues_archive(created_at)")
+
+def _migration_009_subscriptions(c: sqlite3.Cursor) -> None:
+    # kind: all | area (область или подразделение) | equipment (станок/линия/оборудование)
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, value, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id)")
+
+def _migration_010_catalog(c: sqlite3.Cursor) -> None:
+    # дерево оборудования: глубина 1 — область, 2 — подразделение, глубже — путь equipment
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_nodes (
+            id INTEGER PRIMARY KEY,
+            parent_id INTEGER REFERENCES catalog_nodes(id),
+            name TEXT NOT NULL,
+            prompt TEXT,
+            position INTEGER NOT NULL DEFAULT 0,
+            hidden INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_catalog_nodes_name ON catalog_nodes(ifnull(parent_id, 0), name)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('catalog', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
         c.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_catalog_version_{event.lower()} AFTER {event} ON catalog_nodes
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'catalog';
+            END
             """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                fio TEXT NOT NULL,
-                role TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-            """
         )
-        c.execute("PRAGMA table_info(issues)")
-        cols = {row[1] for row in c.fetchall()}
-        if "user_role_snapshot" not in cols:
-            c.execute("ALTER TABLE issues ADD COLUMN user_role_snapshot TEXT")
-        if "user_fio_snapshot" not in cols:
-            c.execute("ALTER TABLE issues ADD COLUMN user_fio_snapshot TEXT")
+    if c.execute("SELECT 1 FROM catalog_nodes LIMIT 1").fetchone():
+        return
+    # начальное наполнение — то, что раньше было зашито в константы и report_callbacks
+    machine = ["ванна", "просеиватель", "пружина", "дозатор", "замес", "питатель", "пресс", "нож", "трабатта"]
+    line = ["ванна", "просеиватель", "бункер замеса", "раскатка", "калибратор", "нож", "лоткоподача"]
+    packing = ["бункер", "конвейер. лента", "корзина", "принтер", "фото-метка",
+               "формовка пакета", "встряхиватель", "замена трубы", "другое"]
+    seed = [
+        ("Цех", "выберите подразделение:", [
+            ("Производство", "выберите станок:", [
+                ("Станок №1", "выберите узел:", machine + ["лоткоподача", "штабелер", "другое"]),
+                ("Станок №12", "выберите узел:", machine + ["лоткоподача", "штабелер", "другое"]),
+                ("Станок №8", "выберите узел:", machine + [
+                    ("группорезка", "выберите подузел:", ["лоткоподача", "другое"]), "другое"]),
+                ("Станок №9", "выберите узел:", machine),
+                ("Станок №11", "выберите узел:", line + ["другое"]),
+                ("Станок №11А", "выберите узел:", line + ["штабелер", "другое"]),
+            ]),
+            ("Фасовка", "выберите линию:", [
+                ("0.3Н", "выберите узел:", packing),
+                ("0.3Б", "выберите узел:", packing),
+                ("0.8", "выберите узел:", packing),
+                "2.5",
+                ("Элита", "выберите узел:", packing),
+            ]),
+            ("Техническое оборудование", "выберите:", ["компрессор", "котельная", "приточ. вентиляция", "другое"]),
+        ]),
+        ("Транспорт", "выберите тип:", ["Грузовой транспорт", "Погрузчики"]),
+    ]
+
+    def insert(parent_id, items):
+        for position, item in enumerate(items):
+            name, prompt, children = (item, None, []) if isinstance(item, str) else item
+            c.execute("INSERT INTO catalog_nodes (parent_id, name, prompt, position) VALUES (?, ?, ?, ?)",
+                      (parent_id, name, prompt, position))
+            insert(c.lastrowid, children)
+    insert(None, seed)
+
+def _migration_011_processed_updates(c: sqlite3.Cursor) -> None:
+    # update_id уже принятых апдейтов: INTEGER PRIMARY KEY — это rowid, строка в пару десятков байт
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at INTEGER NOT NULL
+        )
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_received_at ON processed_updates(received_at)")
+
+def _migration_012_subscriptions_by_node(c: sqlite3.Cursor) -> None:
+    # подписка — на узел каталога по id (0 — на всё), а не по названию: переименование узла
+    # через /catalog её больше не теряет. Старые подписки по названию переносятся на все узлы
+    # с этим названием на своей глубине (1–2 — area, 3 — equipment), как они и срабатывали.
+    c.execute(
+        """
+        CREATE TABLE subscriptions_by_node (
+            node_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (node_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute(
+        """
+        WITH RECURSIVE tree (id, name, depth) AS (
+            SELECT id, name, 1 FROM catalog_nodes WHERE parent_id IS NULL
+            UNION ALL
+            SELECT n.id, n.name, t.depth + 1 FROM catalog_nodes n JOIN tree t ON n.parent_id = t.id
+        )
+        INSERT OR IGNORE INTO subscriptions_by_node (node_id, user_id)
+        SELECT 0, user_id FROM subscriptions WHERE kind = 'all'
+        UNION ALL
+        SELECT t.id, s.user_id FROM subscriptions s JOIN tree t ON t.name = s.value
+        WHERE (s.kind = 'area' AND t.depth IN (1, 2)) OR (s.kind = 'equipment' AND t.depth = 3)
+        """
+    )
+    c.execute("DROP TABLE subscriptions")
+    c.execute("ALTER TABLE subscriptions_by_node RENAME TO subscriptions")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id)")
+
+def _migration_013_archive_fts(c: sqlite3.Cursor) -> None:
+    # перенос в архив (DELETE из issues) больше не выбрасывает заявку из issues_fts — поиск
+    # находит и архивные; id не переиспользуются (AUTOINCREMENT), так что rowid индекса
+    # однозначно указывает на строку в issues или в issues_archive
+    c.execute("DROP TRIGGER IF EXISTS trg_issues_fts_delete")
+    c.execute(
+        """
+        CREATE TRIGGER trg_issues_fts_delete AFTER DELETE ON issues
+        WHEN NOT EXISTS (SELECT 1 FROM issues_archive WHERE id = old.id)
+        BEGIN
+            DELETE FROM issues_fts WHERE rowid = old.id;
+        END
+        """
+    )
+    c.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_issues_archive_fts_delete AFTER DELETE ON issues_archive
+        BEGIN
+            DELETE FROM issues_fts WHERE rowid = old.id;
+        END
+        """
+    )
+    cols = ", ".join(FTS_COLUMNS)
+    c.execute(
+        f"INSERT INTO issues_fts (rowid, {cols}) SELECT id, "
+        + ", ".join(_fold_yo(col) for col in FTS_COLUMNS)
+        + " FROM issues_archive WHERE id NOT IN (SELECT rowid FROM issues_fts)"
+    )
+
+# (версия, название, функция) — только добавлять в конец, номера не менять
+MIGRATIONS = [
+    (1, "issues table", _migration_001_issues),
+    (2, "users table + snapshot columns", _migration_002_users),
+    (3, "issues hot-path indexes", _migration_003_issue_indexes),
+    (4, "sessions table", _migration_004_sessions),
+    (5, "issues data version, export watermarks", _migration_005_export_versioning),
+    (6, "issues full-text index", _migration_006_issues_fts),
+    (7, "reliability rollups", _migration_007_rollups),
+    (8, "issues archive", _migration_008_archive),
+    (9, "notification subscriptions", _migration_009_subscriptions),
+    (10, "equipment catalog", _migration_010_catalog),
+    (11, "processed update ids", _migration_011_processed_updates),
+    (12, "subscriptions by catalog node id", _migration_012_subscriptions_by_node),
+    (13, "archived issues stay in full-text index", _migration_013_archive_fts),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def db_schema_version() -> int:
+    with get_conn() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def db_migrate() -> int:
+    """Применяет недостающие миграции. Безопасно при одновременном старте
+    нескольких воркеров: версия перечитывается под BEGIN IMMEDIATE."""
+    with get_conn() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return SCHEMA_VERSION
+        conn.execute("BEGIN IMMEDIATE")
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        c = conn.cursor()
+        for version, name, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            fn(c)
+            c.execute(f"PRAGMA user_version={int(version)}")
+            log.info("DB migration %s applied: %s", version, name)
         conn.commit()
+        return max(current, SCHEMA_VERSION)
+
+def db_init() -> None:
+    db_migrate()
+    for name, details in db_check_query_plans().items():
+        log.warning("Hot query %s does not use an index: %s", name, "; ".join(details))
 
 # users
-def user_get(user_id: int) -> Optional[tuple]:
+class ProfileCache:
+    """LRU-кэш профилей с TTL: user_id -> (строка users или None, уровень доступа).
+    Попадание не трогает SQLite. Запись через user_upsert инвалидирует ключ;
+    изменения из других воркеров видны не позже чем через ttl секунд."""
+
+    def __init__(self, max_size: int = 4096, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[int, tuple[float, Optional[tuple], int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int) -> Optional[tuple[Optional[tuple], int]]:
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, user_id: int, row: Optional[tuple], level: int, generation: int) -> None:
+        with self._lock:
+            # пока читали из БД, профиль успели изменить — не кладём устаревшее
+            if generation != self._generation:
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl, row, level)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._generation += 1
+            self._data.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses}
+
+PROFILE_CACHE = ProfileCache(
+    max_size=int(os.getenv("PROFILE_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "300")),
+)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def _user_get_db(user_id: int) -> Optional[tuple]:
     with get_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT user_id, fio, role, created_at FROM users WHERE user_id=?", (user_id,))
         return c.fetchone()
 
+def _user_profile(user_id: int) -> tuple[Optional[tuple], int]:
+    cached = PROFILE_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    generation = PROFILE_CACHE.generation()
+    row = _user_get_db(user_id)
+    level = _level_for(user_id, row)
+    PROFILE_CACHE.put(user_id, row, level, generation)
+    return row, level
+
+def user_get(user_id: int) -> Optional[tuple]:
+    return _user_profile(user_id)[0]
+
+@METRICS.timed("bot_db_seconds", "helper")
 def user_upsert(user_id: int, fio: str, role: str) -> None:
-    def _do():
-        with get_conn() as conn:
-            c = conn.cursor()
-            c.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,))
-            exists = c.fetchone() is not None
-            if exists:
-                c.execute("UPDATE users SET fio=?, role=? WHERE user_id=?", (fio, role, user_id))
-            else:
-                c.execute(
-                    "INSERT INTO users (user_id, fio, role, created_at) VALUES (?, ?, ?, ?)",
-                    (user_id, fio, role, datetime.now().isoformat(timespec="seconds")),
-                )
-            conn.commit()
-    return with_retry(_do)
+    def _do(c: sqlite3.Cursor):
+        c.execute(
+            """
+            INSERT INTO users (user_id, fio, role, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET fio=excluded.fio, role=excluded.role
+            """,
+            (user_id, fio, role, datetime.now().isoformat(timespec="seconds")),
+        )
+    try:
+        db_write(_do)
+    finally:
+        PROFILE_CACHE.invalidate(user_id)
+
+def profile_cache_stats() -> dict:
+    return PROFILE_CACHE.stats()
+
+METRICS.gauge("bot_profile_cache_hits_total", "Попадания в кэш профилей пользователей",
+              lambda: profile_cache_stats()["hits"])
+METRICS.gauge("bot_profile_cache_misses_total", "Промахи кэша профилей пользователей",
+              lambda: profile_cache_stats()["misses"])
 
 # access levels
 def is_admin(user_id: int) -> bool:
     return user_id in ADMINS
 
-def user_level(user_id: int) -> int:
+def _level_for(user_id: int, row: Optional[tuple]) -> int:
     if is_admin(user_id):
         return 3
-    u = user_get(user_id)
-    role = (u[2] if u else "").lower()
+    role = (row[2] if row else "").lower()
     if role == "технолог":
         return 1
     return 2
 
+def user_level(user_id: int) -> int:
+    if is_admin(user_id):
+        return 3
+    return _user_profile(user_id)[1]
+
 # issues
+@METRICS.timed("bot_db_seconds", "helper")
 def issue_create(user_id: int, user_name: str, area: Optional[str], subarea: Optional[str],
                  equipment: Optional[str], description: str) -> int:
     u = user_get(user_id)
     fio_snapshot = u[1] if u else (user_name or "")
     role_snapshot = u[2] if u else ""
-    def _do():
-        with get_conn() as conn:
-            c = conn.cursor()
-            c.execute(
-                """
-                INSERT INTO issues (
-                    created_at, user_id, user_name,
-                    area, subarea, equipment, description,
-                    status,
-                    user_fio_snapshot, user_role_snapshot
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?, ?)
-                """,
-                (
-                    datetime.now().isoformat(timespec="seconds"), user_id, user_name,
-                    area, subarea, equipment, description,
-                    fio_snapshot, role_snapshot,
-                ),
-            )
-            conn.commit()
-            return c.lastrowid
-    return with_retry(_do)
-
-def issues_open(limit: int = 20):
-    with get_conn() as conn:
-        c = conn.cursor()
+    def _do(c: sqlite3.Cursor):
         c.execute(
             """
-            SELECT id, created_at, user_name, area, subarea, equipment, description
-            FROM issues
-            WHERE status='open'
-            ORDER BY id DESC
-            LIMIT ?
+            INSERT INTO issues (
+                created_at, user_id, user_name,
+                area, subarea, equipment, description,
+                status,
+                user_fio_snapshot, user_role_snapshot
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?, ?)
             """,
-            (limit,),
+            (
+                datetime.now().isoformat(timespec="seconds"), user_id, user_name,
+                area, subarea, equipment, description,
+                fio_snapshot, role_snapshot,
+            ),
         )
-        return c.fetchall()
+        return c.lastrowid
+    issue_id = db_write(_do)
+    NOTIFIER.publish({"kind": "created", "id": issue_id, "user_id": user_id, "area": area,
+                      "subarea": subarea, "equipment": equipment, "description": description})
+    return issue_id
+
+SQL_ISSUES_OPEN = """
+    SELECT id, created_at, user_name, area, subarea, equipment, description
+    FROM issues
+    WHERE status='open'
+    ORDER BY id DESC
+    LIMIT ?
+"""
 
-def issues_by_user(user_id: int, limit: int = 20):
+SQL_ISSUES_OPEN_BEFORE = SQL_ISSUES_OPEN.replace("WHERE status='open'", "WHERE status='open' AND id < ?")
+SQL_ISSUES_OPEN_AFTER = (SQL_ISSUES_OPEN.replace("WHERE status='open'", "WHERE status='open' AND id > ?")
+                         .replace("ORDER BY id DESC", "ORDER BY id ASC"))
+
+@METRICS.timed("bot_db_seconds", "helper")
+def issues_open(limit: int = 20, before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Открытые заявки от новых к старым; before_id/after_id — keyset-курсор страницы."""
     with get_conn() as conn:
         c = conn.cursor()
+        if after_id is not None:
+            c.execute(SQL_ISSUES_OPEN_AFTER, (after_id, limit))
+            return c.fetchall()[::-1]
+        if before_id is not None:
+            c.execute(SQL_ISSUES_OPEN_BEFORE, (before_id, limit))
+        else:
+            c.execute(SQL_ISSUES_OPEN, (limit,))
+        return c.fetchall()
+
+@METRICS.timed("bot_db_seconds", "helper")
+def issue_close(issue_id: int, resolver_id: int, resolver_name: str) -> bool:
+    def _do(c: sqlite3.Cursor):
         c.execute(
             """
-            SELECT id, created_at, status, area, subarea, equipment, description, resolved_at,
-                   user_fio_snapshot, user_role_snapshot
-            FROM issues
-            WHERE user_id=?
-            ORDER BY id DESC
-            LIMIT ?
+            UPDATE issues
+            SET status='closed', resolved_at=?, resolver_id=?, resolver_name=?
+            WHERE id=? AND status='open'
             """,
-            (user_id, limit),
+            (datetime.now().isoformat(timespec="seconds"), resolver_id, resolver_name, issue_id),
         )
-        return c.fetchall()
+        if c.rowcount == 0:
+            return None
+        return c.execute("SELECT user_id, area, subarea, equipment, description FROM issues WHERE id=?",
+                         (issue_id,)).fetchone()
+    row = db_write(_do)
+    if row is None:
+        return False
+    # user_id 0 — импортированная заявка без автора (см. import_issues): уведомлять некого
+    if row[0] and row[0] != resolver_id:
+        NOTIFIER.publish({"kind": "closed", "id": issue_id, "user_id": row[0], "area": row[1],
+                          "subarea": row[2], "equipment": row[3], "description": row[4],
+                          "resolver_name": resolver_name})
+    return True
 
-def issue_close(issue_id: int, resolver_id: int, resolver_name: str) -> bool:
-    def _do():
-        with get_conn() as conn:
-            c = conn.cursor()
-            c.execute(
-                """
-                UPDATE issues
-                SET status='closed', resolved_at=?, resolver_id=?, resolver_name=?
-                WHERE id=? AND status='open'
-                """,
-                (datetime.now().isoformat(timespec="seconds"), resolver_id, resolver_name, issue_id),
-            )
-            conn.commit()
-            return c.rowcount > 0
-    return with_retry(_do)
+SQL_ISSUES_SELECT = ("SELECT id, created_at, user_name, area, subarea, equipment, description, status, "
+                     "resolved_at, resolver_name, user_fio_snapshot, user_role_snapshot")
+ISSUE_TABLES = ("issues", "issues_archive")
 
-def issues_all(status: Optional[str] = None, by_user_id: Optional[int] = None, limit: Optional[int] = None):
-    q = ("SELECT id, created_at, user_name, area, subarea, equipment, description, status, "
-         "resolved_at, resolver_name, user_fio_snapshot, user_role_snapshot FROM issues")
+def _issues_all_query(status: Optional[str] = None, by_user_id: Optional[int] = None,
+                      limit: Optional[int] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None,
+                      changed_since: Optional[tuple[int, Optional[str]]] = None,
+                      table: str = "issues") -> tuple[str, tuple]:
+    q = f"{SQL_ISSUES_SELECT} FROM {table}"
     conds, params = [], []
     if status in ("open", "closed"):
         conds.append("status = ?")
@@ -336,37 +2059,873 @@ def issues_all(status: Optional[str] = None, by_user_id: Optional[int] = None, l
     if by_user_id is not None:
         conds.append("user_id = ?")
         params.append(by_user_id)
+    if date_from:
+        conds.append("created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        conds.append("created_at < ?")
+        params.append(date_to)
+    if changed_since is not None:
+        # новые заявки (id выше водяной метки) и закрытые после неё
+        conds.append("(id > ? OR resolved_at > ?)")
+        params.extend([changed_since[0], changed_since[1] or ""])
     if conds:
         q += " WHERE " + " AND ".join(conds)
     q += " ORDER BY id DESC"
     if limit:
         q += f" LIMIT {int(limit)}"
+    return q, tuple(params)
+
+def _issues_page_query(by_user_id: Optional[int] = None, before_id: Optional[int] = None,
+                       after_id: Optional[int] = None, limit: int = 10,
+                       table: str = "issues") -> tuple[str, tuple]:
+    conds, params = [], []
+    if by_user_id is not None:
+        conds.append("user_id = ?")
+        params.append(by_user_id)
+    if after_id is not None:
+        conds.append("id > ?")
+        params.append(after_id)
+    elif before_id is not None:
+        conds.append("id < ?")
+        params.append(before_id)
+    q = f"{SQL_ISSUES_SELECT} FROM {table}"
+    if conds:
+        q += " WHERE " + " AND ".join(conds)
+    q += " ORDER BY id " + ("ASC" if after_id is not None else "DESC") + " LIMIT ?"
+    params.append(int(limit))
+    return q, tuple(params)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def issues_page(by_user_id: Optional[int] = None, before_id: Optional[int] = None,
+                after_id: Optional[int] = None, limit: int = 10) -> list:
+    """Keyset-страница (WHERE id < / > курсора) — любая страница стоит как первая.
+    Строки всегда от новых к старым, колонки SQL_ISSUES_SELECT. Архив читается тем же
+    запросом с тем же LIMIT, страницы сливаются по id."""
+    rows = []
+    with get_read_conn() as conn:
+        for table in ISSUE_TABLES:
+            q, params = _issues_page_query(by_user_id, before_id, after_id, limit, table=table)
+            rows += conn.execute(q, params).fetchall()
+    rows.sort(key=lambda r: r[0], reverse=after_id is None)
+    rows = rows[:limit]
+    if after_id is not None:
+        rows.reverse()
+    return rows
+
+# --- полнотекстовый поиск ---
+_RU_ENDINGS = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ете", "ишь", "ите",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ом", "ем", "ам", "ям", "ах", "ях",
+    "ов", "ев", "ет", "ит", "ут", "ют", "ат", "ят", "ть", "ся", "сь",
+    "ы", "и", "а", "я", "о", "е", "у", "ю", "ь",
+], key=len, reverse=True)
+
+def _ru_stem(word: str) -> str:
+    """Грубое отсечение окончания: «ванна»/«ванны» -> «ванн», «течёт»/«течь» -> «теч»."""
+    if len(word) < 4 or not re.search("[а-я]", word):
+        return word
+    for end in _RU_ENDINGS:
+        if word.endswith(end) and len(word) - len(end) >= 3:
+            return word[:-len(end)]
+    return word
+
+def fts_match_query(text: str) -> Optional[str]:
+    """Запрос пользователя -> выражение MATCH: все слова, каждое как префикс основы."""
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    return " ".join(f'"{_ru_stem(w)}"*' for w in words) or None
+
+@METRICS.timed("bot_db_seconds", "helper")
+def issues_search(query: str, limit: int = 10, offset: int = 0, by_user_id: Optional[int] = None) -> list:
+    """Ранжированный (bm25) поиск по описанию и месту поломки — и в журнале, и в архиве.
+    Колонки SQL_ISSUES_SELECT плюс сниппет описания с маркерами \x02…\x03."""
+    match = fts_match_query(query)
+    if not match:
+        return []
+    # строка индекса — заявка либо в issues, либо в issues_archive (миграция 13)
+    q = (
+        "SELECT " + ", ".join(f"COALESCE(i.{col}, a.{col})" for col in EXPORT_COLUMNS) + ", "
+        "snippet(issues_fts, 0, char(2), char(3), '…', 12) "
+        "FROM issues_fts "
+        "LEFT JOIN issues i ON i.id = issues_fts.rowid "
+        "LEFT JOIN issues_archive a ON a.id = issues_fts.rowid "
+        "WHERE issues_fts MATCH ? AND (i.id IS NOT NULL OR a.id IS NOT NULL)"
+    )
+    params = [match]
+    if by_user_id is not None:
+        q += " AND COALESCE(i.user_id, a.user_id) = ?"
+        params.append(by_user_id)
+    # оборудование весит больше описания, область/подразделение — меньше
+    q += " ORDER BY bm25(issues_fts, 1.0, 2.0, 0.5, 0.5) LIMIT ? OFFSET ?"
+    params += [int(limit), int(offset)]
+    with get_read_conn() as conn:
+        return conn.execute(q, params).fetchall()
+
+# --- надёжность: отказы и MTTR по оборудованию ---
+@METRICS.timed("bot_db_seconds", "helper")
+def rollups_rebuild() -> None:
+    db_write(rollups_rebuild_sql)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def reliability_stats(days: int = 30) -> list:
+    """[(путь оборудования, отказов, закрыто, секунд ремонта)] за последние days дней —
+    читает только issue_rollups (число групп × дней), таблицу issues не трогает."""
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    with get_read_conn() as conn:
+        return conn.execute(
+            """
+            SELECT equipment_path, SUM(failures), SUM(closed), SUM(repair_seconds)
+            FROM issue_rollups
+            WHERE day >= ?
+            GROUP BY equipment_path
+            ORDER BY SUM(failures) DESC, equipment_path
+            """,
+            (since,),
+        ).fetchall()
+
+# --- архив и обслуживание файла БД ---
+# Архивные заявки остаются в полнотекстовом индексе (миграция 13): поиск их находит.
+ARCHIVE_COLUMNS = ("id, created_at, user_id, user_name, area, subarea, equipment, description, status, "
+                   "resolved_at, resolver_id, resolver_name, user_fio_snapshot, user_role_snapshot")
+
+@METRICS.timed("bot_db_seconds", "helper")
+def archive_closed_issues(older_than_days: int, batch: int = 500) -> int:
+    """Переносит закрытые больше older_than_days дней назад заявки в issues_archive
+    пачками по batch — каждая пачка отдельной короткой транзакцией писателя.
+    Возвращает число перенесённых заявок."""
+    border = (datetime.now() - timedelta(days=older_than_days)).isoformat(timespec="seconds")
+
+    def _move(c: sqlite3.Cursor) -> int:
+        ids = [row[0] for row in c.execute(
+            "SELECT id FROM issues WHERE status='closed' AND resolved_at < ? ORDER BY id LIMIT ?",
+            (border, batch),
+        )]
+        if not ids:
+            return 0
+        marks = ",".join("?" * len(ids))
+        c.execute(
+            f"INSERT OR REPLACE INTO issues_archive ({ARCHIVE_COLUMNS}, archived_at) "
+            f"SELECT {ARCHIVE_COLUMNS}, ? FROM issues WHERE id IN ({marks})",
+            (datetime.now().isoformat(timespec="seconds"), *ids),
+        )
+        c.execute(f"DELETE FROM issues WHERE id IN ({marks})", ids)
+        return len(ids)
+
+    total = 0
+    while True:
+        moved = db_write(_move)
+        total += moved
+        if moved < batch:
+            return total
+
+@METRICS.timed("bot_db_seconds", "helper")
+def db_compact(vacuum_pages: int = 0) -> dict:
+    """wal_checkpoint(TRUNCATE) и incremental_vacuum (0 — освободить все свободные страницы).
+    incremental_vacuum работает только при auto_vacuum=INCREMENTAL — см. db_enable_incremental_vacuum."""
+    with get_conn() as conn:
+        freelist_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum == 2:
+            conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+        busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        with _wal_lock:
+            _wal_state["at"] = 0.0  # следующий сбор метрик увидит усечённый WAL
+        return {
+            "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, auto_vacuum),
+            "freelist_before": freelist_before,
+            "freelist_after": conn.execute("PRAGMA freelist_count").fetchone()[0],
+            "checkpoint_busy": busy,
+            "wal_pages": wal_pages,
+            "checkpointed_pages": checkpointed,
+        }
+
+def db_enable_incremental_vacuum() -> None:
+    """Однократно переводит файл в auto_vacuum=INCREMENTAL (полный VACUUM, файл блокируется)."""
+    with get_conn() as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+# --- размер WAL и отставание checkpoint ---
+# Долгий читатель держит старую версию базы, и checkpoint не может перенести кадры WAL
+# за его снимок: файл -wal растёт, чтение замедляется. Сами checkpoint'ы — дело
+# автоcheckpoint'а и db_compact; метрики базу не трогают: размер берём у файла -wal, а
+# число кадров в WAL (mxFrame) и перенесённых в базу (nBackfill) — из заголовка индекса
+# WAL в файле -shm (https://sqlite.org/walformat.html), те же числа, что вернул бы
+# PRAGMA wal_checkpoint. Между автоcheckpoint'ами отставание до wal_autocheckpoint (1000)
+# кадров — норма; тревожно, когда оно больше и lag_seconds растёт. Кэш — DB_WAL_STATS_TTL.
+DB_WAL_STATS_TTL = float(os.getenv("DB_WAL_STATS_TTL", "5"))
+_WAL_INDEX_HEADER = struct.Struct("=16xI76xI")  # WalIndexHdr.mxFrame, WalCkptInfo.nBackfill
+_wal_state = {"at": 0.0, "stats": None, "caught_up_at": time.time()}
+_wal_lock = threading.Lock()
+
+def _wal_index_frames(path: str) -> tuple[int, int]:
+    """(mxFrame, nBackfill) из -shm; (0, 0), если WAL ещё не открыт."""
+    try:
+        with open(path + "-shm", "rb") as f:
+            header = f.read(_WAL_INDEX_HEADER.size)
+    except OSError:
+        return 0, 0
+    if len(header) < _WAL_INDEX_HEADER.size:
+        return 0, 0
+    return _WAL_INDEX_HEADER.unpack(header)
+
+def db_wal_stats() -> dict:
+    """{"wal_bytes", "log_frames", "checkpointed_frames", "lag_frames", "lag_seconds"};
+    lag_seconds — сколько прошло с момента, когда checkpoint последний раз догонял WAL."""
+    with _wal_lock:
+        now = time.time()
+        if _wal_state["stats"] is not None and now - _wal_state["at"] < DB_WAL_STATS_TTL:
+            return _wal_state["stats"]
+        try:
+            wal_bytes = os.path.getsize(DB_POOL.path + "-wal")
+        except OSError:
+            wal_bytes = 0
+        log_frames, checkpointed = _wal_index_frames(DB_POOL.path)
+        lag = max(log_frames - checkpointed, 0)
+        if lag == 0:
+            _wal_state["caught_up_at"] = now
+        stats = {
+            "wal_bytes": wal_bytes,
+            "log_frames": log_frames,
+            "checkpointed_frames": checkpointed,
+            "lag_frames": lag,
+            "lag_seconds": round(now - _wal_state["caught_up_at"], 1),
+        }
+        _wal_state.update(at=now, stats=stats)
+        return stats
+
+METRICS.gauge("bot_db_wal_bytes", "Размер файла -wal", lambda: db_wal_stats()["wal_bytes"])
+METRICS.gauge("bot_db_checkpoint_lag_frames", "Кадры WAL, ещё не перенесённые в базу",
+              lambda: db_wal_stats()["lag_frames"])
+METRICS.gauge("bot_db_checkpoint_lag_seconds", "Сколько checkpoint не догоняет WAL",
+              lambda: db_wal_stats()["lag_seconds"])
+
+# Горячие запросы: каждый обязан идти по индексу (проверка в db_check_query_plans)
+HOT_QUERIES = {
+    "user_get": lambda: ("SELECT user_id, fio, role, created_at FROM users WHERE user_id=?", (0,)),
+    "issues_open": lambda: (SQL_ISSUES_OPEN, (20,)),
+    "issues_open[older]": lambda: (SQL_ISSUES_OPEN_BEFORE, (100, 20)),
+    "issues_open[newer]": lambda: (SQL_ISSUES_OPEN_AFTER, (100, 20)),
+    "issues_iter[status]": lambda: _issues_all_query(status="open", limit=30),
+    "issues_iter[user]": lambda: _issues_all_query(by_user_id=0, limit=30),
+    "issues_iter[status,user]": lambda: _issues_all_query(status="closed", by_user_id=0),
+    "issues_page[all,older]": lambda: _issues_page_query(before_id=100),
+    "issues_page[all,newer]": lambda: _issues_page_query(after_id=100),
+    "issues_page[user,older]": lambda: _issues_page_query(by_user_id=0, before_id=100),
+    "issues_page[user,newer]": lambda: _issues_page_query(by_user_id=0, after_id=100),
+    "archive_page[user,older]": lambda: _issues_page_query(by_user_id=0, before_id=100, table="issues_archive"),
+    "archive_page[user,newer]": lambda: _issues_page_query(by_user_id=0, after_id=100, table="issues_archive"),
+}
+
+def _plan_uses_index(details: list[str]) -> bool:
+    for d in details:
+        if "TEMP B-TREE" in d:
+            return False
+        if d.startswith("SCAN") and "INDEX" not in d:
+            return False
+    return True
+
+def db_check_query_plans() -> dict[str, list[str]]:
+    """EXPLAIN QUERY PLAN для HOT_QUERIES; возвращает {имя: план} для запросов без индекса."""
+    bad = {}
     with get_conn() as conn:
+        for name, build in HOT_QUERIES.items():
+            q, params = build()
+            details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + q, params)]
+            if not _plan_uses_index(details):
+                bad[name] = details
+    return bad
+
+EXPORT_COLUMNS = [
+    "id", "created_at", "user_name", "area", "subarea", "equipment", "description",
+    "status", "resolved_at", "resolver_name", "user_fio_snapshot", "user_role_snapshot",
+]
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+EXPORT_SPOOL_MAX = 8 * 1024 * 1024
+
+def issues_iter(chunk: int = EXPORT_CHUNK, conn: Optional[sqlite3.Connection] = None, **filters):
+    """Заявки от новых к старым, курсор читается порциями по chunk строк — память не зависит от размера таблицы.
+    Включает архив: два курсора (issues и issues_archive) сливаются по id на лету.
+    conn — готовое соединение (снимок REPORT_SNAPSHOT), иначе пул чтения.
+    filters — аргументы _issues_all_query."""
+    limit = filters.pop("limit", None)
+
+    def _cursor_rows(conn, table):
+        q, params = _issues_all_query(table=table, **filters)
         c = conn.cursor()
-        c.execute(q, tuple(params))
-        return c.fetchall()
+        c.execute(q, params)
+        while True:
+            rows = c.fetchmany(chunk)
+            if not rows:
+                return
+            yield from rows
+
+    if conn is not None:
+        merged = heapq.merge(*(_cursor_rows(conn, t) for t in ISSUE_TABLES), key=lambda r: -r[0])
+        yield from itertools.islice(merged, limit or None)
+        return
+    with get_read_conn() as conn:
+        yield from issues_iter(chunk, conn, limit=limit, **filters)
+
+def _parse_dt(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+@METRICS.timed("bot_db_seconds", "helper")
+def export_to_excel(path, status: Optional[str] = None, by_user_id: Optional[int] = None,
+                    limit: Optional[int] = None, conn: Optional[sqlite3.Connection] = None,
+                    as_of: Optional[str] = None, **filters) -> dict:
+    """Потоковый экспорт в .xlsx (openpyxl write-only). path — имя файла или файловый объект.
+    conn — откуда читать (по умолчанию пул чтения; боту — снимок REPORT_SNAPSHOT),
+    as_of — момент, на который данные conn согласованы (для снимка — время его снятия).
+    Возвращает {"rows", "max_id", "max_resolved_at", "as_of"} — по ним двигается водяная метка."""
+    try:
+        from openpyxl import Workbook  # pip install openpyxl
+    except Exception as e:
+        raise RuntimeError("Для экспорта установите пакет: openpyxl") from e
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("issues")
+    ws.append(EXPORT_COLUMNS)
+    i_created, i_resolved = EXPORT_COLUMNS.index("created_at"), EXPORT_COLUMNS.index("resolved_at")
+    as_of = as_of or datetime.now().isoformat(timespec="seconds")
+    n, max_id, max_resolved = 0, 0, ""
+    for row in issues_iter(conn=conn, status=status, by_user_id=by_user_id, limit=limit, **filters):
+        row = list(row)
+        max_id = max(max_id, row[0])
+        if row[i_resolved]:
+            max_resolved = max(max_resolved, row[i_resolved])
+        row[i_created] = _parse_dt(row[i_created])
+        row[i_resolved] = _parse_dt(row[i_resolved])
+        ws.append(row)
+        n += 1
+    wb.save(path)
+    return {"rows": n, "max_id": max_id, "max_resolved_at": max_resolved or None, "as_of": as_of}
+
+# --- версия данных, водяные метки и кэш полного экспорта ---
+@METRICS.timed("bot_db_seconds", "helper")
+def issues_version() -> int:
+    """Счётчик изменений issues (двигают триггеры миграции 5 — в любом процессе)."""
+    with get_conn() as conn:
+        row = conn.execute("SELECT value FROM counters WHERE name='issues'").fetchone()
+        return row[0] if row else 0
+
+@METRICS.timed("bot_db_seconds", "helper")
+def export_watermark_get(user_id: int) -> Optional[tuple[int, Optional[str]]]:
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT last_id, last_resolved_at FROM export_watermarks WHERE user_id=?", (user_id,)
+        ).fetchone()
+
+@METRICS.timed("bot_db_seconds", "helper")
+def export_watermark_advance(user_id: int, stats: dict) -> None:
+    """Двигает метку вперёд (никогда назад). resolved_at хранится с точностью до секунды,
+    поэтому метка не заходит за секунду, на которую согласованы данные выгрузки (снятие
+    снимка): закрытые в эту секунду попадут и в следующую дельту, но не потеряются."""
+    cap = (datetime.fromisoformat(stats["as_of"]) - timedelta(seconds=1)).isoformat(timespec="seconds")
+    resolved = min(stats["max_resolved_at"], cap) if stats["max_resolved_at"] else None
+    def _do(c: sqlite3.Cursor):
+        c.execute(
+            """
+            INSERT INTO export_watermarks (user_id, last_id, last_resolved_at, exported_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_id=MAX(last_id, excluded.last_id),
+                last_resolved_at=MAX(COALESCE(last_resolved_at, ''), COALESCE(excluded.last_resolved_at, '')),
+                exported_at=excluded.exported_at
+            """,
+            (user_id, stats["max_id"], resolved, datetime.now().isoformat(timespec="seconds")),
+        )
+    db_write(_do)
+
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bot-exports"))
+# каталог общий для всех ботов на машине — файлы в нём привязаны к конкретной базе
+DB_KEY = hashlib.sha1(str(Path(DB_PATH).resolve()).encode("utf-8")).hexdigest()[:12]
+_export_file_ids: dict[int, str] = {}  # версия данных -> file_id уже отправленного файла
+
+# --- снимок базы для выгрузок ---
+# Выгрузка в .xlsx идёт секунды, и всё это время читатель держит в WAL старую версию:
+# checkpoint не может дойти до конца, -wal растёт. Поэтому выгрузки читают копию базы,
+# снятую online backup API (копирование — доли секунды), а не живой файл. Копия общая для
+# воркеров (рядом с кэшем выгрузок) и заменяется атомарно; пересоздаётся, если ей больше
+# REPORT_SNAPSHOT_MAX_AGE и данные с тех пор менялись (issues_version).
+REPORT_SNAPSHOT_PATH = os.getenv("REPORT_SNAPSHOT_PATH",
+                                 os.path.join(EXPORT_CACHE_DIR, f"issues_snapshot_{DB_KEY}.db"))
+REPORT_SNAPSHOT_MAX_AGE = float(os.getenv("REPORT_SNAPSHOT_MAX_AGE", "60"))
+# страниц за шаг backup: -1 — за один шаг; >0 — лок чтения отпускается между шагами,
+# но каждая запись в базу во время копирования начинает копию заново
+REPORT_SNAPSHOT_PAGES = int(os.getenv("REPORT_SNAPSHOT_PAGES", "-1"))
+
+class ReportSnapshot:
+    def __init__(self, path: str, max_age: float = 60.0, pages: int = -1):
+        self.path = path
+        self.max_age = max_age
+        self.pages = pages
+        self._lock = threading.Lock()
+        self._stats = {"refreshes": 0, "reused": 0, "last_refresh_seconds": 0.0}
+
+    def _open(self) -> sqlite3.Connection:
+        # immutable: файл после os.replace не меняется — без блокировок и -shm
+        conn = sqlite3.connect(Path(self.path).resolve().as_uri() + "?mode=ro&immutable=1", uri=True,
+                               check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def age(self) -> Optional[float]:
+        try:
+            return max(time.time() - os.path.getmtime(self.path), 0.0)
+        except OSError:
+            return None
+
+    def version(self) -> Optional[int]:
+        conn = self._open()
+        try:
+            row = conn.execute("SELECT value FROM counters WHERE name='issues'").fetchone()
+            return row[0] if row else 0
+        finally:
+            conn.close()
+
+    @staticmethod
+    def taken_at(conn: sqlite3.Connection) -> str:
+        """Момент снятия снимка: всё, что закоммичено раньше, в нём есть."""
+        return conn.execute("SELECT taken_at FROM snapshot_info").fetchone()[0]
+
+    def refresh(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        started = time.perf_counter()
+        # время берём до начала копирования: транзакция чтения backup начнётся позже
+        taken_at = datetime.now().isoformat(timespec="seconds")
+        dst = sqlite3.connect(tmp)
+        try:
+            with get_read_conn() as src:
+                src.backup(dst, pages=self.pages)
+            dst.execute("PRAGMA journal_mode=DELETE")  # копии WAL не нужен
+            dst.execute("CREATE TABLE snapshot_info (taken_at TEXT NOT NULL)")
+            dst.execute("INSERT INTO snapshot_info VALUES (?)", (taken_at,))
+            dst.commit()
+        finally:
+            dst.close()
+        os.replace(tmp, self.path)
+        elapsed = time.perf_counter() - started
+        METRICS.observe("bot_report_snapshot_seconds", elapsed)
+        self._stats["refreshes"] += 1
+        self._stats["last_refresh_seconds"] = round(elapsed, 3)
+
+    def ensure_fresh(self) -> None:
+        with self._lock:
+            age = self.age()
+            if age is not None and age < self.max_age:
+                self._stats["reused"] += 1
+                return
+            if age is not None and self.version() == issues_version():
+                os.utime(self.path)  # данные не менялись — копия снова свежая
+                self._stats["reused"] += 1
+                return
+            self.refresh()
+
+    @contextmanager
+    def connection(self):
+        """Соединение только для чтения к свежему снимку (старше max_age не бывает)."""
+        self.ensure_fresh()
+        conn = self._open()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"path": self.path, "age": self.age(), **self._stats}
+
+REPORT_SNAPSHOT = ReportSnapshot(REPORT_SNAPSHOT_PATH, REPORT_SNAPSHOT_MAX_AGE, REPORT_SNAPSHOT_PAGES)
+METRICS.describe("bot_report_snapshot_seconds", "histogram", "Время снятия снимка базы для выгрузок")
+METRICS.gauge("bot_report_snapshot_age_seconds", "Возраст снимка базы для выгрузок",
+              lambda: REPORT_SNAPSHOT.age() or 0)
+
+def export_full_cached() -> tuple[int, str, dict]:
+    """Полный экспорт из кэша по версии данных: (версия, путь к .xlsx, статистика).
+    Файлы лежат на диске и общие для всех воркеров; старые версии удаляются."""
+    with REPORT_SNAPSHOT.connection() as snap:
+        # версия — самого снимка: файл кэша соответствует ровно тем данным, что в нём
+        version = snap.execute("SELECT value FROM counters WHERE name='issues'").fetchone()[0]
+        # версия — маленький счётчик, у другой базы он может совпасть: в имени ещё и DB_KEY
+        path = os.path.join(EXPORT_CACHE_DIR, f"issues_full_{DB_KEY}_v{version}.xlsx")
+        meta_path = path[:-len(".xlsx")] + ".json"
+        if os.path.exists(path) and os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                return version, path, json.load(f)
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        stats = export_to_excel(tmp, conn=snap, as_of=REPORT_SNAPSHOT.taken_at(snap))
+    with open(tmp + ".json", "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+    os.replace(tmp + ".json", meta_path)
+    os.replace(tmp, path)
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        if name.startswith(f"issues_full_{DB_KEY}_v") and not name.startswith(f"issues_full_{DB_KEY}_v{version}."):
+            try:
+                os.remove(os.path.join(EXPORT_CACHE_DIR, name))
+            except OSError:
+                pass
+    return version, path, stats
+
+# --- импорт истории из .xlsx/.csv ---
+# Файл в раскладке export_to_excel: первая строка — заголовки из EXPORT_COLUMNS (порядок любой,
+# лишние столбцы игнорируются). Строки читаются потоком, проверяются по каталогу и уходят
+# писателю пачками по IMPORT_BATCH одним executemany: пока пишется одна пачка, разбирается
+# следующая. id из файла сохраняется, уже существующие (в issues или архиве) пропускаются —
+# повторный импорт выгрузки ничего не дублирует; строки без id получают новые номера.
+# Автора (Telegram id) выгрузка не содержит: его можно дать необязательным столбцом user_id,
+# иначе заявка записывается с user_id = 0 — «автор неизвестен»: её нет в «История (мои)»,
+# а при закрытии уведомлять некого (issue_close такие заявки не публикует).
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "2000"))
+IMPORT_REQUIRED = ("created_at", "area", "description")
+IMPORT_COLUMNS = (*EXPORT_COLUMNS, "user_id")
+IMPORT_ERRORS_SHOWN = 20
+
+SQL_IMPORT_ISSUE = """
+    INSERT OR IGNORE INTO issues (
+        id, created_at, user_id, user_name, area, subarea, equipment, description,
+        status, resolved_at, resolver_name, user_fio_snapshot, user_role_snapshot
+    )
+    SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11, ?12, ?13
+    WHERE ?1 IS NULL OR NOT EXISTS (SELECT 1 FROM issues_archive WHERE id = ?1)
+"""
+
+def _import_sheet_rows(path: str):
+    """Строки файла как кортежи значений; .xlsx — openpyxl read-only, остальное — CSV."""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook  # pip install openpyxl
+        except Exception as e:
+            raise RuntimeError("Для импорта .xlsx установите пакет: openpyxl") from e
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from wb.worksheets[0].iter_rows(values_only=True)
+        finally:
+            wb.close()
+        return
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def _import_dt(value) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="seconds")
+    return datetime.fromisoformat(str(value).strip()).isoformat(timespec="seconds")
+
+def _import_text(value) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _import_row(values: dict, paths: "CatalogIndex") -> tuple:
+    """Строка файла -> параметры SQL_IMPORT_ISSUE; ValueError с причиной, если строка не годится."""
+    raw_id = values.get("id")
+    try:
+        issue_id = int(raw_id) if raw_id not in (None, "") else None
+    except (TypeError, ValueError):
+        raise ValueError(f"id не число: {raw_id!r}")
+    raw_user_id = values.get("user_id")
+    try:
+        user_id = int(raw_user_id) if raw_user_id not in (None, "") else 0
+    except (TypeError, ValueError):
+        raise ValueError(f"user_id не число: {raw_user_id!r}")
+    try:
+        created_at = _import_dt(values.get("created_at"))
+        resolved_at = _import_dt(values.get("resolved_at"))
+    except (TypeError, ValueError):
+        raise ValueError("дата не в формате ISO")
+    if not created_at:
+        raise ValueError("нет created_at")
+    description = _import_text(values.get("description"))
+    if not description:
+        raise ValueError("пустое описание")
+    status = _import_text(values.get("status")) or ("closed" if resolved_at else "open")
+    if status not in ("open", "closed"):
+        raise ValueError(f"неизвестный статус {status!r}")
+    area, subarea, equipment = (_import_text(values.get(k)) for k in ("area", "subarea", "equipment"))
+    path = tuple(p for p in (area, subarea, *(equipment or "").split(" > ")) if p)
+    # без области — заявка по QR-коду: оборудование из ссылки, в каталоге его может не быть
+    if area is not None and paths.find(path) is None:
+        raise ValueError(f"нет в каталоге: {' / '.join(path) or '—'}")
+    return (issue_id, created_at, user_id, _import_text(values.get("user_name")), area, subarea, equipment,
+            description, status, resolved_at if status == "closed" else None,
+            _import_text(values.get("resolver_name")), _import_text(values.get("user_fio_snapshot")),
+            _import_text(values.get("user_role_snapshot")))
+
+@METRICS.timed("bot_db_seconds", "helper")
+def import_issues(path: str, batch: int = IMPORT_BATCH, dry_run: bool = False) -> dict:
+    """Импорт заявок из .xlsx/.csv. Уведомления не рассылаются; статистику /stats ведут
+    триггеры на вставке (отказ — в день создания, ремонт закрытой — в день закрытия).
+    Возвращает {"read", "inserted", "skipped", "rejected", "errors", "seconds", "read_per_second",
+    "inserted_per_second"}, errors — первые IMPORT_ERRORS_SHOWN пар (номер строки файла, причина)."""
+    started = time.perf_counter()
+    paths = catalog_load(include_hidden=True)
+    rows = iter(_import_sheet_rows(path))
+    header = [str(h).strip() if h is not None else "" for h in next(rows, ())]
+    missing = [c for c in IMPORT_REQUIRED if c not in header]
+    if missing:
+        raise ValueError(f"В заголовке нет столбцов: {', '.join(missing)} (ожидаются {', '.join(EXPORT_COLUMNS)})")
+    columns = [(i, name) for i, name in enumerate(header) if name in IMPORT_COLUMNS]
+    stats = {"read": 0, "inserted": 0, "skipped": 0, "rejected": 0, "errors": []}
+
+    def _insert(params: list):
+        def _do(c: sqlite3.Cursor) -> int:
+            c.executemany(SQL_IMPORT_ISSUE, params)
+            return c.rowcount
+        return WRITER.submit(_do)
+
+    def _collect(pending: Optional[tuple]) -> None:
+        if pending:
+            fut, size = pending
+            inserted = fut.result(60)
+            stats["inserted"] += inserted
+            stats["skipped"] += size - inserted
+
+    pending, chunk = None, []
+    for line, values in enumerate(rows, start=2):
+        if not any(v not in (None, "") for v in values):
+            continue
+        stats["read"] += 1
+        try:
+            chunk.append(_import_row({name: values[i] for i, name in columns if i < len(values)}, paths))
+        except ValueError as e:
+            stats["rejected"] += 1
+            if len(stats["errors"]) < IMPORT_ERRORS_SHOWN:
+                stats["errors"].append((line, str(e)))
+            continue
+        if len(chunk) >= batch:
+            if not dry_run:
+                _collect(pending)
+                pending = (_insert(chunk), len(chunk))
+            chunk = []
+    if chunk and not dry_run:
+        _collect(pending)
+        pending = (_insert(chunk), len(chunk))
+    _collect(pending)
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    seconds = max(stats["seconds"], 1e-6)
+    stats["read_per_second"] = round(stats["read"] / seconds)
+    stats["inserted_per_second"] = round(stats["inserted"] / seconds)
+    return stats
+
+# gunicorn импортирует main:app и не выполняет __main__ — схему готовим при импорте
+if os.getenv("DB_AUTO_MIGRATE", "1") == "1":
+    db_init()
+
+# =====================
+# 🔔 УВЕДОМЛЕНИЯ
+# =====================
+# issue_create/issue_close только кладут событие в очередь NOTIFIER. Его поток собирает
+# события за NOTIFY_BATCH_WINDOW, находит получателей одним запросом на событие и
+# отправляет через OUTBOX (лимиты Telegram соблюдает он). Получателю — не чаще раза в
+# NOTIFY_COOLDOWN: накопившееся за это время уходит одним сообщением, от
+# NOTIFY_DIGEST_AFTER событий — сводкой. Очередь в памяти процесса: при рестарте
+# неотправленное теряется (заявки при этом в базе, подписчик увидит их в «Сообщить о решении»).
+NOTIFY_BATCH_WINDOW = float(os.getenv("NOTIFY_BATCH_WINDOW", "2"))
+NOTIFY_COOLDOWN = float(os.getenv("NOTIFY_COOLDOWN", "60"))
+NOTIFY_DIGEST_AFTER = int(os.getenv("NOTIFY_DIGEST_AFTER", "3"))
+
+@METRICS.timed("bot_db_seconds", "helper")
+def subscriptions_of(user_id: int) -> set[int]:
+    """id узлов каталога, на которые подписан пользователь (CATALOG_ROOT — на всё)."""
+    with get_conn() as conn:
+        rows = conn.execute("SELECT node_id FROM subscriptions WHERE user_id=?", (user_id,)).fetchall()
+    return {r[0] for r in rows}
+
+@METRICS.timed("bot_db_seconds", "helper")
+def subscription_toggle(user_id: int, node_id: int) -> bool:
+    """Включает/выключает подписку; True — подписка теперь есть."""
+    def _do(c: sqlite3.Cursor):
+        c.execute("DELETE FROM subscriptions WHERE node_id=? AND user_id=?", (node_id, user_id))
+        if c.rowcount:
+            return False
+        c.execute("INSERT INTO subscriptions (node_id, user_id) VALUES (?, ?)", (node_id, user_id))
+        return True
+    return db_write(_do)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def subscriptions_drop(user_id: int) -> None:
+    def _do(c: sqlite3.Cursor):
+        c.execute("DELETE FROM subscriptions WHERE user_id=?", (user_id,))
+    db_write(_do)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def subscribers_for(area: Optional[str], subarea: Optional[str], equipment: Optional[str]) -> list[int]:
+    """Подписчики заявки: на всё, на её область, подразделение или станок (первый узел equipment).
+    Названия из заявки переводятся в id узлов по текущему каталогу."""
+    index = catalog()
+    path = tuple(p for p in (area, subarea, (equipment or "").split(" > ", 1)[0]) if p)
+    node_ids = [CATALOG_ROOT]
+    for depth in range(1, len(path) + 1):
+        node = index.find(path[:depth])
+        if node is None:
+            break
+        node_ids.append(node.id)
+    marks = ",".join("?" * len(node_ids))
+    with get_conn() as conn:
+        rows = conn.execute(
+            f"SELECT DISTINCT user_id FROM subscriptions WHERE node_id IN ({marks})", node_ids
+        ).fetchall()
+    return [r[0] for r in rows]
+
+def _notification_text(event: dict) -> str:
+    place = html.escape(" / ".join(x for x in (event["area"], event["subarea"], event["equipment"]) if x) or "—")
+    description = html.escape(event["description"] or "")
+    if event["kind"] == "created":
+        return f"🆕 Новая заявка <b>#{event['id']}</b>\n📍 {place}\n📝 {description}"
+    return (f"✅ Ваша заявка <b>#{event['id']}</b> закрыта\n📍 {place}\n📝 {description}\n"
+            f"🔧 {html.escape(event['resolver_name'] or '—')}")
+
+def _digest_text(events: list[dict]) -> str:
+    lines = [f"🔔 Событий: {len(events)}"]
+    for event in events:
+        what = event["equipment"] or event["subarea"] or event["area"] or "—"
+        mark = "🆕" if event["kind"] == "created" else "✅"
+        line = f"{mark} <b>#{event['id']}</b> {html.escape(what)} — {html.escape((event['description'] or '')[:60])}"
+        if sum(len(x) + 1 for x in lines) + len(line) > TELEGRAM_TEXT_LIMIT - 50:
+            lines.append(f"… и ещё {len(events) - len(lines) + 1}")
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+class Notifier:
+    """Фан-аут уведомлений: один поток на процесс, события копятся по получателям."""
+
+    def __init__(self, batch_window: float = NOTIFY_BATCH_WINDOW, cooldown: float = NOTIFY_COOLDOWN,
+                 digest_after: int = NOTIFY_DIGEST_AFTER):
+        self.batch_window = batch_window
+        self.cooldown = cooldown
+        self.digest_after = digest_after
+        self._queue: queue.Queue = queue.Queue()
+        self._pending: dict[int, list[dict]] = {}
+        self._last_sent: dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._stats = {"events": 0, "messages": 0, "digests": 0, "unsubscribed": 0}
+
+    def publish(self, event: dict) -> None:
+        """Из хендлера: O(1), без запросов к базе и Telegram."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        self._queue.put(event)
+
+    def _run(self) -> None:
+        while True:
+            due = self._next_due()
+            try:
+                event = self._queue.get(timeout=None if due is None else max(0.0, due - time.monotonic()))
+            except queue.Empty:
+                event = False
+            if event is None:
+                self._deliver(force=True)
+                return
+            if event:
+                batch = [event]
+                deadline = time.monotonic() + self.batch_window
+                stop = False
+                while (remaining := deadline - time.monotonic()) > 0:
+                    try:
+                        event = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if event is None:
+                        stop = True
+                        break
+                    batch.append(event)
+                try:
+                    self._route(batch)
+                except Exception:
+                    log.exception("Notification routing failed")
+                if stop:
+                    self._deliver(force=True)
+                    return
+            self._deliver()
+
+    def _route(self, batch: list[dict]) -> None:
+        with self._lock:
+            self._stats["events"] += len(batch)
+        for event in batch:
+            if event["kind"] == "created":
+                recipients = [uid for uid in subscribers_for(event["area"], event["subarea"], event["equipment"])
+                              if uid != event["user_id"] and user_level(uid) >= 2]
+            else:
+                recipients = [event["user_id"]]
+            for uid in recipients:
+                self._pending.setdefault(uid, []).append(event)
 
-def export_to_excel(path: str, status: Optional[str] = None, by_user_id: Optional[int] = None, limit: Optional[int] = None):
-    try:
-        import pandas as pd  # pip install pandas openpyxl
-    except Exception as e:
-        raise RuntimeError("Для экспорта установите пакеты: pandas, openpyxl") from e
-    rows = issues_all(status=status, by_user_id=by_user_id, limit=limit)
-    cols = [
-        "id", "created_at", "user_name", "area", "subarea", "equipment", "description",
-        "status", "resolved_at", "resolver_name", "user_fio_snapshot", "user_role_snapshot",
-    ]
-    df = pd.DataFrame(rows, columns=cols)
-    for col in ("created_at", "resolved_at"):
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-    with pd.ExcelWriter(path, engine="openpyxl") as writer:
-        df.to_excel(writer, sheet_name="issues", index=False)
+    def _next_due(self) -> Optional[float]:
+        if not self._pending:
+            return None
+        return min(self._last_sent.get(uid, 0.0) + self.cooldown for uid in self._pending)
+
+    def _deliver(self, force: bool = False) -> None:
+        now = time.monotonic()
+        for uid in list(self._pending):
+            if not force and self._last_sent.get(uid, 0.0) + self.cooldown > now:
+                continue
+            events = self._pending.pop(uid)
+            self._last_sent[uid] = now
+            # за cooldown получателю уходит ровно одно сообщение: несколько событий — подряд
+            # в одном тексте, от digest_after (или не влезли в лимит Telegram) — сводкой
+            text = "\n\n".join(_notification_text(e) for e in events)
+            if len(events) >= self.digest_after or len(text) > TELEGRAM_TEXT_LIMIT:
+                text, key = _digest_text(events), "digests"
+            else:
+                key = "messages"
+            with self._lock:
+                self._stats[key] += 1
+            tg.send_message(uid, text).add_done_callback(functools.partial(self._delivered, uid))
+        # забываем тех, кому давно ничего не слали
+        for uid in [u for u, t in self._last_sent.items() if t + self.cooldown <= now and u not in self._pending]:
+            del self._last_sent[uid]
+
+    def _delivered(self, uid: int, fut: Future) -> None:
+        e = fut.exception()
+        if isinstance(e, ApiTelegramException) and e.error_code == 403:
+            # бот заблокирован/чат удалён — перестаём слать
+            subscriptions_drop(uid)
+            with self._lock:
+                self._stats["unsubscribed"] += 1
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Отправляет накопленное (без ожидания cooldown) и останавливает поток."""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queued": self._queue.qsize(), "pending_recipients": len(self._pending), **self._stats}
+
+NOTIFIER = Notifier()
+METRICS.gauge("bot_notify_queue_depth", "События в очереди уведомлений", lambda: NOTIFIER.stats()["queued"])
 
 # =====================
 # 🛡️ Безопасное редактирование
 # =====================
-def safe_edit_text(chat_id: int, message_id: int, text: str, reply_markup=None):
+# выполняются в потоке OUTBOX: хендлер не ждёт ответа Telegram
+def _edit_text_now(chat_id: int, message_id: int, text: str, reply_markup=None):
     try:
         bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
     except ApiTelegramException as e:
@@ -378,11 +2937,172 @@ def safe_edit_text(chat_id: int, message_id: int, text: str, reply_markup=None):
         else:
             raise
 
+def _edit_reply_markup_now(chat_id: int, message_id: int, reply_markup) -> None:
+    try:
+        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+    except ApiTelegramException as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+
+def safe_edit_text(chat_id: int, message_id: int, text: str, reply_markup=None) -> Future:
+    return OUTBOX.submit(chat_id, _edit_text_now, chat_id, message_id, text, reply_markup)
+
+def _edit_reply_markup(chat_id: int, message_id: int, reply_markup) -> Future:
+    return OUTBOX.submit(chat_id, _edit_reply_markup_now, chat_id, message_id, reply_markup)
+
+# =====================
+# 🔘 CALLBACK_DATA: КОДЕК И ДИСПЕТЧЕР
+# =====================
+# callback_data = <версия><код>[:аргумент...], например "1n:42" — узел каталога 42.
+# Аргументы — числа (id узла/заявки, курсор) или короткие значения из заданного набора,
+# поэтому данные ASCII и далеко от лимита Telegram в 64 байта. Обработчик регистрируется
+# @callback_handler(код, *типы аргументов); callback_dispatch находит его одним поиском в
+# CALLBACK_ROUTES. Неизвестная версия, код, число или значение аргумента — кнопка устарела:
+# отвечаем подсказкой и ничего не делаем. Меняется смысл аргументов — поднять CALLBACK_VERSION.
+_HANDLER_NAMES: dict[str, object] = {}
+
+def _claim_handler_name(fn) -> None:
+    """Второй обработчик с тем же именем — почти всегда копия, перекрывающая первую: падаем при импорте."""
+    owner = _HANDLER_NAMES.setdefault(fn.__name__, fn)
+    if owner is not fn:
+        raise RuntimeError(f"handler {fn.__name__} is defined twice")
+
+CALLBACK_VERSION = "1"
+CALLBACK_DATA_LIMIT = 64
+CALLBACK_ROUTES: dict[str, tuple] = {}  # код -> (обработчик, типы аргументов)
+
+def callback_handler(op: str, *arg_types):
+    """Регистрирует обработчик кнопки: fn(cq, *args). Тип аргумента — int или кортеж допустимых строк."""
+    def register(fn):
+        if op in CALLBACK_ROUTES:
+            raise RuntimeError(f"callback op {op!r} already handled by {CALLBACK_ROUTES[op][0].__name__}")
+        _claim_handler_name(fn)
+        CALLBACK_ROUTES[op] = (fn, arg_types)
+        return fn
+    return register
+
+def cb_data(op: str, *args) -> str:
+    data = ":".join((CALLBACK_VERSION + op, *map(str, args)))
+    if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data longer than {CALLBACK_DATA_LIMIT} bytes: {data!r}")
+    return data
+
+def cb_decode(data: Optional[str]) -> Optional[tuple]:
+    """(обработчик, аргументы) или None, если данные не от текущей версии бота."""
+    if not data or data[0] != CALLBACK_VERSION:
+        return None
+    op, *raw = data[1:].split(":")
+    route = CALLBACK_ROUTES.get(op)
+    if route is None or len(raw) != len(route[1]):
+        return None
+    args = []
+    for value, kind in zip(raw, route[1]):
+        if kind is int:
+            if not (value.isascii() and value.isdigit()):
+                return None
+            args.append(int(value))
+        elif value in kind:
+            args.append(value)
+        else:
+            return None
+    return route[0], args
+
+@bot.callback_query_handler(func=lambda c: True)
+def callback_dispatch(cq: types.CallbackQuery):
+    decoded = cb_decode(cq.data)
+    if decoded is None:
+        tg.answer_callback_query(cq.id, "Кнопка устарела — откройте меню заново.")
+        return
+    fn, args = decoded
+    fn(cq, *args)
+
+@callback_handler("_")
+def noop_callback(cq: types.CallbackQuery):
+    tg.answer_callback_query(cq.id)
+
+# =====================
+# 🧭 РОУТЕР СООБЩЕНИЙ
+# =====================
+# Все текстовые сообщения идут в один telebot-обработчик route_message. Обработчик
+# находится поиском в MESSAGE_ROUTES: сначала команда (/start@bot -> "start"), затем текст
+# кнопки меню, затем шаг сессии (сессию читаем, только если дошли до шага); не нашли —
+# route_default. Кнопка меню важнее шага: из любого сценария можно выйти через меню.
+# Цена разбора не зависит от числа пунктов меню. Ключ или имя функции занято дважды —
+# RuntimeError при импорте, а не тихое перекрытие одного обработчика другим.
+MESSAGE_ROUTES: dict[tuple[str, str], object] = {}  # ("command"|"text"|"step", ключ) -> обработчик
+_default_route = None
+
+def message_route(*, commands: tuple = (), texts: tuple = (), steps: tuple = ()):
+    """Регистрирует обработчик сообщения на команды, тексты кнопок меню и/или шаги сессии."""
+    keys = ([("command", c) for c in commands] + [("text", t) for t in texts]
+            + [("step", st) for st in steps])
+    def register(fn):
+        for key in keys:
+            if key in MESSAGE_ROUTES:
+                raise RuntimeError(f"{key[0]} {key[1]!r} already handled by {MESSAGE_ROUTES[key].__name__}")
+        _claim_handler_name(fn)
+        MESSAGE_ROUTES.update(dict.fromkeys(keys, fn))
+        return fn
+    return register
+
+def route_default(fn):
+    """Обработчик сообщений, для которых нет ни команды, ни кнопки, ни шага."""
+    global _default_route
+    if _default_route is not None:
+        raise RuntimeError(f"default message route already set: {_default_route.__name__}")
+    _claim_handler_name(fn)
+    _default_route = fn
+    return fn
+
+def resolve_message(message: types.Message):
+    text = message.text or ""
+    if text.startswith("/"):
+        fn = MESSAGE_ROUTES.get(("command", text.split(maxsplit=1)[0][1:].split("@", 1)[0]))
+        if fn is not None:
+            return fn
+    fn = MESSAGE_ROUTES.get(("text", text))
+    if fn is None:
+        fn = MESSAGE_ROUTES.get(("step", session_step(message.from_user.id)), _default_route)
+    return fn
+
+@bot.message_handler(func=lambda m: True)
+def route_message(message: types.Message):
+    fn = resolve_message(message)
+    if fn is not None:
+        fn(message)
+
+def wrap_routes(decorate) -> None:
+    """Оборачивает обработчики обоих роутеров (метрики, bench); сами таблицы не меняются по составу."""
+    global _default_route
+    wrapped: dict = {}  # один обработчик на нескольких ключах — одна обёртка
+
+    def once(fn):
+        if fn not in wrapped:
+            wrapped[fn] = decorate(fn)
+        return wrapped[fn]
+    for key, fn in MESSAGE_ROUTES.items():
+        MESSAGE_ROUTES[key] = once(fn)
+    if _default_route is not None:
+        _default_route = once(_default_route)
+    for op, (fn, arg_types) in CALLBACK_ROUTES.items():
+        CALLBACK_ROUTES[op] = (once(fn), arg_types)
+
 # =====================
 # 🧩 КЛАВИАТУРЫ
 # =====================
-def main_menu_for(user_id: int) -> types.ReplyKeyboardMarkup:
-    lvl = user_level(user_id)
+class FrozenMarkup(types.JsonSerializable):
+    """Готовая клавиатура: JSON сериализуется один раз при сборке,
+    to_json() отдаёт ту же строку без аллокаций."""
+    __slots__ = ("markup", "json")
+
+    def __init__(self, markup):
+        self.markup = markup
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+def _build_main_menu(lvl: int) -> types.ReplyKeyboardMarkup:
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row("📣 Сообщить о проблеме")
     if lvl >= 2:
@@ -395,102 +3115,288 @@ def main_menu_for(user_id: int) -> types.ReplyKeyboardMarkup:
     kb.row("👤 Профиль")
     return kb
 
-def roles_keyboard() -> types.InlineKeyboardMarkup:
+def _build_roles_keyboard() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup()
-    for r in ROLES:
-        kb.add(types.InlineKeyboardButton(r.title(), callback_data=f"profile|role|{r}"))
-    kb.add(types.InlineKeyboardButton("Отмена", callback_data="profile|cancel"))
+    for i, r in enumerate(ROLES):  # в кнопке — номер роли: ROLES только дополнять в конец
+        kb.add(types.InlineKeyboardButton(r.title(), callback_data=cb_data("pr", i)))
+    kb.add(types.InlineKeyboardButton("Отмена", callback_data=cb_data("pc")))
     return kb
 
-# --- report меню (инлайн) ---
-def menu_layer1() -> types.InlineKeyboardMarkup:
+def _build_profile_edit() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Цех", callback_data="report|area|Цех"))
-    kb.add(types.InlineKeyboardButton("Транспорт", callback_data="report|area|Транспорт"))
+    kb.add(types.InlineKeyboardButton("✏️ Изменить ФИО", callback_data=cb_data("pf")))
+    kb.add(types.InlineKeyboardButton("🔄 Сменить направление", callback_data=cb_data("pe")))
     return kb
 
-def menu_layer2_for_ceh() -> types.InlineKeyboardMarkup:
+def _build_export_menu() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Производство", callback_data="report|subarea|Производство"))
-    kb.add(types.InlineKeyboardButton("Фасовка", callback_data="report|subarea|Фасовка"))
-    kb.add(types.InlineKeyboardButton("Техническое оборудование", callback_data="report|subarea|Техническое оборудование"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|1"))
+    kb.add(types.InlineKeyboardButton("Все заявки", callback_data=cb_data("xf")))
+    kb.add(types.InlineKeyboardButton("С прошлой выгрузки", callback_data=cb_data("xd")))
+    kb.row(
+        types.InlineKeyboardButton("За 7 дней", callback_data=cb_data("xp", 7)),
+        types.InlineKeyboardButton("За 30 дней", callback_data=cb_data("xp", 30)),
+    )
     return kb
 
-def menu_layer2_transport() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for t in TRANSPORT_TYPES:
-        kb.add(types.InlineKeyboardButton(t, callback_data=f"report|transport|{t}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|1"))
+def build_keyboards() -> dict:
+    """Собирает все статичные клавиатуры. Главное меню — по уровню доступа."""
+    kb = {("main", lvl): FrozenMarkup(_build_main_menu(lvl)) for lvl in (1, 2, 3)}
+    kb["roles"] = FrozenMarkup(_build_roles_keyboard())
+    kb["profile_edit"] = FrozenMarkup(_build_profile_edit())
+    kb["remove"] = FrozenMarkup(types.ReplyKeyboardRemove())
+    kb["export"] = FrozenMarkup(_build_export_menu())
     return kb
 
-def menu_layer3_production() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for name in PRODUCTION_MACHINES:
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"report|equipment|{name}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|2_ceh"))
-    return kb
+KEYBOARDS = build_keyboards()
 
-def menu_layer3_packing() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for name in PACKING_LINES:
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"report|equipment|{name}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|2_ceh"))
-    return kb
+def main_menu_for(user_id: int) -> FrozenMarkup:
+    return KEYBOARDS[("main", user_level(user_id))]
 
-def menu_layer3_tech() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for name in TECH_EQUIPMENT:
-        kb.add(types.InlineKeyboardButton(name, callback_data=f"report|tech|{name}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|2_ceh"))
-    return kb
+def roles_keyboard() -> FrozenMarkup:
+    return KEYBOARDS["roles"]
 
-def menu_layer4_pack_components() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for comp in PACKING_COMPONENTS_DEFAULT:
-        kb.add(types.InlineKeyboardButton(comp, callback_data=f"report|packcomp|{comp}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|3_pack"))
-    return kb
+# =====================
+# 🗂 КАТАЛОГ ОБОРУДОВАНИЯ (дерево в catalog_nodes, индекс в памяти)
+# =====================
+# Мастер «Сообщить о проблеме» ходит по дереву: кнопка — код "n" с id узла, лист — описание.
+# CatalogIndex собирается целиком при загрузке и дальше не меняется: узел по id, дети,
+# путь, поля заявки и клавиатура каждого узла готовы заранее. Правки (/catalog или прямо
+# в базе) двигают счётчик 'catalog' (триггеры миграции 10); catalog() сверяет его не чаще
+# раза в CATALOG_CHECK_SECONDS и подменяет индекс одним присваиванием — обработчик,
+# уже взявший индекс, дорабатывает на своей версии. Так правку видят все воркеры без рестарта.
+CATALOG_CHECK_SECONDS = float(os.getenv("CATALOG_CHECK_SECONDS", "5"))
+CATALOG_NAME_LIMIT = 40  # длиннее Telegram обрезает подпись кнопки
+CATALOG_ROOT = 0
 
-def menu_layer4_prod_components(machine: str) -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for comp in PRODUCTION_COMPONENTS.get(machine, []):
-        kb.add(types.InlineKeyboardButton(comp, callback_data=f"report|prodcomp|{comp}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|3_prod"))
-    return kb
+class CatalogNode(NamedTuple):
+    id: int
+    parent_id: int
+    name: str
+    path: tuple      # названия от области до узла
+    children: tuple  # id детей в порядке position
+    text: str        # текст сообщения, пока пользователь стоит на узле
 
-def menu_layer5_groupcut_sub() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for sub in PROD_GROUP_CUT_SUB:
-        kb.add(types.InlineKeyboardButton(sub, callback_data=f"report|prodsubcomp|{sub}"))
-    kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="report|back|4_group"))
-    return kb
+class CatalogIndex:
+    """Неизменяемый снимок каталога версии version. Скрытые узлы и их поддеревья не попадают."""
+
+    def __init__(self, version: int, rows: list):
+        self.version = version
+        by_parent: dict[int, list] = {}
+        for node_id, parent_id, name, prompt in rows:
+            by_parent.setdefault(parent_id or CATALOG_ROOT, []).append((node_id, name, prompt))
+        self._nodes: dict[int, CatalogNode] = {}
+        stack = [(CATALOG_ROOT, CATALOG_ROOT, "", None, ())]
+        while stack:
+            node_id, parent_id, name, prompt, path = stack.pop()
+            kids = by_parent.get(node_id, [])
+            if node_id == CATALOG_ROOT:
+                text = "Выберите область:"
+            elif kids:
+                text = html.escape(f"{' → '.join(path)} → {prompt or 'выберите:'}")
+            else:
+                text = html.escape(f"{' / '.join(path)} → опишите проблему:")
+            self._nodes[node_id] = CatalogNode(node_id, parent_id, name, path, tuple(k[0] for k in kids), text)
+            stack.extend((k_id, node_id, k_name, k_prompt, path + (k_name,)) for k_id, k_name, k_prompt in kids)
+        self._paths = {node.path: node for node in self._nodes.values()}
+        self._keyboards = {
+            node.id: FrozenMarkup(self._build_keyboard(node))
+            for node in self._nodes.values() if node.children or node.id == CATALOG_ROOT
+        }
+
+    def _build_keyboard(self, node: CatalogNode) -> types.InlineKeyboardMarkup:
+        kb = types.InlineKeyboardMarkup()
+        for child_id in node.children:
+            kb.add(types.InlineKeyboardButton(self._nodes[child_id].name, callback_data=cb_data("n", child_id)))
+        if node.id != CATALOG_ROOT:
+            kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data=cb_data("n", node.parent_id)))
+        return kb
+
+    def __len__(self) -> int:
+        return len(self._nodes) - 1
 
-def open_issues_inline() -> types.InlineKeyboardMarkup:
-    data = issues_open(limit=20)
+    def node(self, node_id: int) -> Optional[CatalogNode]:
+        return self._nodes.get(node_id)
+
+    def children(self, node_id: int) -> list[CatalogNode]:
+        node = self._nodes.get(node_id)
+        return [self._nodes[i] for i in node.children] if node else []
+
+    def keyboard(self, node_id: int) -> Optional[FrozenMarkup]:
+        return self._keyboards.get(node_id)
+
+    def find(self, path: tuple) -> Optional[CatalogNode]:
+        return self._paths.get(tuple(path))
+
+    def walk(self):
+        """Все узлы в порядке показа (в глубину)."""
+        stack = list(reversed(self._nodes[CATALOG_ROOT].children))
+        while stack:
+            node = self._nodes[stack.pop()]
+            yield node
+            stack.extend(reversed(node.children))
+
+    @staticmethod
+    def issue_fields(node: CatalogNode) -> tuple[Optional[str], Optional[str], Optional[str]]:
+        """(area, subarea, equipment) заявки для узла: как в issues и путях статистики."""
+        path = node.path
+        return (path[0] if path else None, path[1] if len(path) > 1 else None,
+                " > ".join(path[2:]) or None)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def catalog_version() -> int:
+    with get_conn() as conn:
+        row = conn.execute("SELECT value FROM counters WHERE name='catalog'").fetchone()
+        return row[0] if row else 0
+
+@METRICS.timed("bot_db_seconds", "helper")
+def catalog_load(include_hidden: bool = False) -> CatalogIndex:
+    """include_hidden — вместе со скрытыми узлами (проверка старых заявок при импорте)."""
+    # версию читаем до строк: правка между запросами даст индекс новее версии,
+    # и следующая проверка просто перечитает его ещё раз
+    version = catalog_version()
+    where = "" if include_hidden else "WHERE hidden=0 "
+    with get_conn() as conn:
+        rows = conn.execute(
+            f"SELECT id, parent_id, name, prompt FROM catalog_nodes {where}ORDER BY position, id"
+        ).fetchall()
+    return CatalogIndex(version, rows)
+
+CATALOG: Optional[CatalogIndex] = None
+_catalog_lock = threading.Lock()
+_catalog_checked = 0.0
+
+def catalog(force: bool = False) -> CatalogIndex:
+    """Текущий индекс каталога; версию в базе сверяет не чаще раза в CATALOG_CHECK_SECONDS."""
+    global CATALOG, _catalog_checked
+    if CATALOG is not None and not force and time.monotonic() - _catalog_checked < CATALOG_CHECK_SECONDS:
+        return CATALOG
+    with _catalog_lock:
+        if CATALOG is None or force or time.monotonic() - _catalog_checked >= CATALOG_CHECK_SECONDS:
+            if CATALOG is None or catalog_version() != CATALOG.version:
+                CATALOG = catalog_load()
+                log.info("Catalog v%s loaded: %s nodes", CATALOG.version, len(CATALOG))
+            _catalog_checked = time.monotonic()
+        return CATALOG
+
+@METRICS.timed("bot_db_seconds", "helper")
+def catalog_add(parent_id: int, name: str) -> int:
+    def _do(c: sqlite3.Cursor):
+        c.execute(
+            """
+            INSERT INTO catalog_nodes (parent_id, name, position)
+            SELECT ?1, ?2, COALESCE(MAX(position) + 1, 0) FROM catalog_nodes WHERE ifnull(parent_id, 0) = ifnull(?1, 0)
+            """,
+            (parent_id or None, name),
+        )
+        return c.lastrowid
+    return db_write(_do)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def catalog_update(node_id: int, **fields) -> bool:
+    """Меняет name / prompt / hidden узла; False — такого узла нет."""
+    unknown = set(fields) - {"name", "prompt", "hidden"}
+    if unknown:
+        raise ValueError(f"unknown catalog fields: {sorted(unknown)}")
+    assignments = ", ".join(f"{column}=?" for column in fields)
+    def _do(c: sqlite3.Cursor):
+        c.execute(f"UPDATE catalog_nodes SET {assignments} WHERE id=?", (*fields.values(), node_id))
+        return c.rowcount > 0
+    return db_write(_do)
+
+@METRICS.timed("bot_db_seconds", "helper")
+def catalog_hidden() -> list[tuple[int, str]]:
+    with get_conn() as conn:
+        return conn.execute("SELECT id, name FROM catalog_nodes WHERE hidden=1 ORDER BY id").fetchall()
+
+OPEN_PICKER_PAGE = 20
+
+class OpenIssuesCache:
+    """Готовые страницы выбора открытых заявок для текущей версии данных.
+    Версия (issues_version) сменилась — старые страницы выбрасываются целиком."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._pages: dict[tuple, FrozenMarkup] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, cursor: tuple) -> Optional[FrozenMarkup]:
+        with self._lock:
+            kb = self._pages.get(cursor) if version == self._version else None
+            if kb is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return kb
+
+    def put(self, version: int, cursor: tuple, kb: FrozenMarkup) -> None:
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._pages = {}
+            self._pages[cursor] = kb
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"version": self._version, "pages": len(self._pages), "hits": self.hits, "misses": self.misses}
+
+OPEN_ISSUES_CACHE = OpenIssuesCache()
+
+def _build_open_issues(version: int, cursor: tuple) -> types.InlineKeyboardMarkup:
+    direction, cursor_id = cursor
+    data = issues_open(
+        limit=OPEN_PICKER_PAGE + 1,
+        before_id=cursor_id if direction == "o" else None,
+        after_id=cursor_id if direction == "n" else None,
+    )
+    if direction == "n":
+        has_newer, has_older = len(data) > OPEN_PICKER_PAGE, True
+        data = data[-OPEN_PICKER_PAGE:]
+    else:
+        has_newer, has_older = direction == "o", len(data) > OPEN_PICKER_PAGE
+        data = data[:OPEN_PICKER_PAGE]
     kb = types.InlineKeyboardMarkup()
     if not data:
-        kb.add(types.InlineKeyboardButton("Нет открытых заявок", callback_data="noop"))
+        kb.add(types.InlineKeyboardButton("Нет открытых заявок", callback_data=cb_data("_")))
+        has_newer = has_older = False
     else:
         for row in data:
             _id, created_at, user_name, area, subarea, equipment, desc = row
             label_parts = [p for p in [str(_id), area, subarea, equipment] if p]
             label = "#" + label_parts[0] + " " + "/".join(label_parts[1:]) if len(label_parts) > 1 else f"#{_id}"
-            kb.add(types.InlineKeyboardButton(label[:64], callback_data=f"fix|pick|{_id}"))
-    kb.add(types.InlineKeyboardButton("Обновить", callback_data="fix|refresh"))
+            kb.add(types.InlineKeyboardButton(label[:64], callback_data=cb_data("fp", _id)))
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton("◀ Новее", callback_data=cb_data("fg", "n", data[0][0])))
+    if has_older:
+        nav.append(types.InlineKeyboardButton("Старше ▶", callback_data=cb_data("fg", "o", data[-1][0])))
+    if nav:
+        kb.row(*nav)
+    # версия в кнопке: если данные не менялись, «Обновить» не трогает Telegram
+    kb.add(types.InlineKeyboardButton("Обновить", callback_data=cb_data("fr", version, cursor[0] or "-", cursor[1])))
+    return kb
+
+def open_issues_inline(cursor: tuple = (None, 0), version: Optional[int] = None) -> FrozenMarkup:
+    """Страница выбора открытой заявки. cursor: (None, 0) — первая, ("o", id) — старше id,
+    ("n", id) — новее id."""
+    if version is None:
+        version = issues_version()
+    kb = OPEN_ISSUES_CACHE.get(version, cursor)
+    if kb is None:
+        kb = FrozenMarkup(_build_open_issues(version, cursor))
+        OPEN_ISSUES_CACHE.put(version, cursor, kb)
     return kb
 
 # =====================
 # =====================
 # 👤 ПРОФИЛЬ
 # =====================
-import re  # убедись, что импорт есть в шапке файла
-
 FIO_RE = re.compile(
     r"^[А-ЯЁA-Z][а-яёa-z]+(?:[- ][А-ЯЁA-Z][а-яёa-z]+)?\s+[А-ЯЁA-Z]\.?\s*[А-ЯЁA-Z]\.?$"
 )
 
-@bot.message_handler(commands=["start"])
+@message_route(commands=("start",))
 def cmd_start(message: types.Message):
     user = message.from_user
     payload = None
@@ -502,7 +3408,7 @@ def cmd_start(message: types.Message):
     if not u:
         s = ensure_session(user.id)
         s["step"] = "profile_wait_fio"
-        bot.send_message(
+        tg.send_message(
             message.chat.id,
             "Добро пожаловать! Укажите <b>Фамилию и инициалы</b> в формате: <code>Иванов И.И.</code>\n"
             "Можно пробел после точек: <code>Иванов И. И.</code>"
@@ -516,56 +3422,55 @@ def cmd_start(message: types.Message):
         s = ensure_session(user.id)
         s["step"] = "report_description"
         s["data"] = {"area": None, "subarea": None, "equipment": equipment_from_payload}
-        bot.send_message(message.chat.id, f"Оборудование: <b>{equipment_from_payload}</b>\nОпишите поломку:")
+        tg.send_message(message.chat.id, f"Оборудование: <b>{equipment_from_payload}</b>\nОпишите поломку:")
         return
 
-    bot.send_message(
+    tg.send_message(
         message.chat.id,
         f"Привет, <b>{u[1]}</b> ({u[2]}). Выберите действие:",
         reply_markup=main_menu_for(user.id),
     )
 
-@bot.message_handler(func=lambda m: m.text == "👤 Профиль")
+@message_route(texts=("👤 Профиль",))
 def on_profile_view(message: types.Message):
     """Показ текущего профиля с кнопками редактирования."""
     u = user_get(message.from_user.id)
     if not u:
+        # профиля нет — попросим ФИО и запустим настройку
         s = ensure_session(message.from_user.id)
         s["step"] = "profile_wait_fio"
-        bot.reply_to(
+        tg.reply_to(
             message,
             "Профиль не настроен. Введите ФИО (например, <code>Иванов И.И.</code>)."
         )
         return
 
     _, fio, role, created_at = u
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("✏️ Изменить ФИО", callback_data="profile|edit_fio"))
-    kb.add(types.InlineKeyboardButton("🔄 Сменить направление", callback_data="profile|edit_role"))
-    bot.reply_to(
+    kb = KEYBOARDS["profile_edit"]
+    tg.reply_to(
         message,
         f"Ваш профиль:\n<b>{fio}</b>\n{role}\nСоздан: {created_at}",
         reply_markup=kb
     )
 
-@bot.message_handler(func=lambda m: ensure_session(m.from_user.id).get("step") == "profile_wait_fio")
+@message_route(steps=("profile_wait_fio",))
 def on_profile_fio(message: types.Message):
     """Первичная настройка: принимаем ФИО и предлагаем выбрать роль."""
     fio = message.text.strip()
     if not FIO_RE.match(fio):
-        bot.reply_to(message, "Формат неверный. Пример: <code>Иванов И.И.</code>")
+        tg.reply_to(message, "Формат неверный. Пример: <code>Иванов И.И.</code>")
         return
     s = ensure_session(message.from_user.id)
     s["data"]["fio"] = fio
     s["step"] = "profile_wait_role"
-    bot.send_message(message.chat.id, "Выберите ваше направление:", reply_markup=roles_keyboard())
+    tg.send_message(message.chat.id, "Выберите ваше направление:", reply_markup=roles_keyboard())
 
-@bot.message_handler(func=lambda m: ensure_session(m.from_user.id).get("step") == "profile_edit_fio")
+@message_route(steps=("profile_edit_fio",))
 def on_profile_edit_fio(message: types.Message):
     """Редактирование ФИО из меню профиля."""
     fio = message.text.strip()
     if not FIO_RE.match(fio):
-        bot.reply_to(
+        tg.reply_to(
             message,
             "Формат неверный. Пример: <code>Иванов И.И.</code>\n"
             "Допустимо и с пробелами: <code>Иванов И. И.</code>"
@@ -575,390 +3480,634 @@ def on_profile_edit_fio(message: types.Message):
     role = u[2] if u else "инженер"
     user_upsert(message.from_user.id, fio, role)
     reset_session(message.from_user.id)
-    bot.reply_to(
+    tg.reply_to(
         message,
         f"ФИО обновлено: <b>{fio}</b>",
         reply_markup=main_menu_for(message.from_user.id)
     )
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("profile|"))
-def profile_callbacks(cq: types.CallbackQuery):
-    """Единый обработчик всех inline-кнопок профиля."""
-    parts = cq.data.split("|")
-    action = parts[1]
+@callback_handler("pc")
+def profile_cancel(cq: types.CallbackQuery):
+    reset_session(cq.from_user.id)
+    tg.edit_message_text(
+        "Настройка профиля отменена. Запустите /start для начала.",
+        cq.message.chat.id, cq.message.message_id
+    )
 
-    if action == "cancel":
-        reset_session(cq.from_user.id)
-        bot.edit_message_text(
-            "Настройка профиля отменена. Запустите /start для начала.",
-            cq.message.chat.id, cq.message.message_id
-        )
-        return
+@callback_handler("pf")
+def profile_edit_fio(cq: types.CallbackQuery):
+    s = ensure_session(cq.from_user.id)
+    s["step"] = "profile_edit_fio"
+    tg.edit_message_text(
+        "Введите новое ФИО (формат: <code>Иванов И.И.</code>):",
+        cq.message.chat.id, cq.message.message_id
+    )
 
-    if action == "edit_fio":
-        s = ensure_session(cq.from_user.id)
-        s["step"] = "profile_edit_fio"
-        bot.edit_message_text(
-            "Введите новое ФИО (формат: <code>Иванов И.И.</code>):",
-            cq.message.chat.id, cq.message.message_id
-        )
-        return
+@callback_handler("pe")
+def profile_edit_role(cq: types.CallbackQuery):
+    # показываем клавиатуру выбора роли
+    tg.edit_message_text(
+        "Выберите новое направление:",
+        cq.message.chat.id, cq.message.message_id,
+        reply_markup=roles_keyboard()
+    )
 
-    if action == "edit_role":
-        # показываем клавиатуру выбора роли
-        bot.edit_message_text(
-            "Выберите новое направление:",
-            cq.message.chat.id, cq.message.message_id,
-            reply_markup=roles_keyboard()
-        )
+@callback_handler("pr", int)
+def profile_role(cq: types.CallbackQuery, role_index: int):
+    # сохраняем выбранную роль
+    if role_index >= len(ROLES):
+        tg.answer_callback_query(cq.id, "Неизвестная роль. Выберите из списка.", show_alert=True)
         return
-
-    if action == "role":
-        # сохраняем выбранную роль
-        role = parts[2]
-        if role not in ROLES:
-            bot.answer_callback_query(cq.id, "Неизвестная роль. Выберите из списка.", show_alert=True)
+    role = ROLES[role_index]
+    s = ensure_session(cq.from_user.id)
+    fio = s.get("data", {}).get("fio")
+    if not fio:
+        u = user_get(cq.from_user.id)
+        if u:
+            fio = u[1]
+        else:
+            tg.answer_callback_query(cq.id, "Сначала введите ФИО.", show_alert=True)
             return
-        s = ensure_session(cq.from_user.id)
-        fio = s.get("data", {}).get("fio")
-        if not fio:
-            u = user_get(cq.from_user.id)
-            if u:
-                fio = u[1]
-            else:
-                bot.answer_callback_query(cq.id, "Сначала введите ФИО.", show_alert=True)
-                return
-        user_upsert(cq.from_user.id, fio, role)
-        # очищаем сценарий и показываем главное меню
-        reset_session(cq.from_user.id)
-        bot.edit_message_text(
-            f"Профиль сохранён: <b>{fio}</b> ({role}).",
-            cq.message.chat.id, cq.message.message_id
-        )
-        bot.send_message(
-            cq.message.chat.id, "Выберите действие:",
-            reply_markup=main_menu_for(cq.from_user.id)
-        )
-        return
+    user_upsert(cq.from_user.id, fio, role)
+    # очищаем сценарий и показываем главное меню
+    reset_session(cq.from_user.id)
+    tg.edit_message_text(
+        f"Профиль сохранён: <b>{fio}</b> ({role}).",
+        cq.message.chat.id, cq.message.message_id
+    )
+    tg.send_message(
+        cq.message.chat.id, "Выберите действие:",
+        reply_markup=main_menu_for(cq.from_user.id)
+    )
 
 # =====================
 # 🧾 РЕПОРТ / ФИКС / ИСТОРИЯ / ЭКСПОРТ
 # =====================
-@bot.message_handler(func=lambda m: m.text == "📣 Сообщить о проблеме")
+@message_route(texts=("📣 Сообщить о проблеме",))
 def on_report_entry(message: types.Message):
     u = user_get(message.from_user.id)
     if not u:
-        bot.reply_to(message, "Сначала настроим профиль. Введите ФИО (например, <code>Иванов И.И.</code>).")
+        tg.reply_to(message, "Сначала настроим профиль. Введите ФИО (например, <code>Иванов И.И.</code>).")
         s = ensure_session(message.from_user.id)
         s["step"] = "profile_wait_fio"
         return
     s = ensure_session(message.from_user.id)
-    s["step"] = "report_layer1"
-    s["data"] = {"area": None, "subarea": None, "equipment": None, "component": None, "_machine_raw": None}
-    bot.send_message(message.chat.id, "Поломка в:", reply_markup=types.ReplyKeyboardRemove())
-    bot.send_message(message.chat.id, "Выберите область:", reply_markup=menu_layer1())
+    index = catalog()
+    root = index.node(CATALOG_ROOT)
+    s["step"] = "report_catalog"
+    s["data"] = {"node": CATALOG_ROOT}
+    tg.send_message(message.chat.id, "Поломка в:", reply_markup=KEYBOARDS["remove"])
+    tg.send_message(message.chat.id, root.text, reply_markup=index.keyboard(CATALOG_ROOT))
 
-@bot.message_handler(func=lambda m: m.text == "✅ Сообщить о решении")
+@message_route(texts=("✅ Сообщить о решении",))
 def on_fix_entry(message: types.Message):
     if user_level(message.from_user.id) < 2:
-        bot.reply_to(message, "Недостаточно прав: закрывать заявки могут мастера и администраторы.")
+        tg.reply_to(message, "Недостаточно прав: закрывать заявки могут мастера и администраторы.")
         return
     u = user_get(message.from_user.id)
     if not u:
-        bot.reply_to(message, "Сначала настроим профиль. Введите ФИО (например, <code>Иванов И.И.</code>).")
+        tg.reply_to(message, "Сначала настроим профиль. Введите ФИО (например, <code>Иванов И.И.</code>).")
         s = ensure_session(message.from_user.id)
         s["step"] = "profile_wait_fio"
         return
     s = ensure_session(message.from_user.id)
     s["step"] = "fix_pick_issue"
-    bot.send_message(message.chat.id, "Выберите заявку для закрытия:", reply_markup=open_issues_inline())
+    tg.send_message(message.chat.id, "Выберите заявку для закрытия:", reply_markup=open_issues_inline())
 
-@bot.message_handler(func=lambda m: m.text == "👤 Профиль")
-def on_profile_view(message: types.Message):
-    u = user_get(message.from_user.id)
-    if not u:
-        # профиля нет — попросим ФИО и запустим настройку
-        s = ensure_session(message.from_user.id)
-        s["step"] = "profile_wait_fio"
-        bot.reply_to(
-            message,
-            "Профиль не настроен. Введите ФИО (например, <code>Иванов И.И.</code>)."
-        )
-        return
+HISTORY_PAGE_SIZE = 10
+TELEGRAM_TEXT_LIMIT = 4096
 
-    _, fio, role, created_at = u
+def _history_line(row, scope: str) -> str:
+    _id, created_at, user_name, area, subarea, equipment, desc, status, resolved_at, resolver_name, fio_snap, role_snap = row
+    tag = "🟩" if status == "closed" else "🟥"
+    place = " / ".join([x for x in [area, subarea, equipment] if x])
+    if scope == "all":
+        who = f"{fio_snap or user_name or '—'} ({role_snap or '—'})"
+        res = f" → закрыта {resolved_at} (закрыл: {resolver_name})" if (resolved_at and status == "closed") else ""
+    else:
+        who = f"{fio_snap or '—'} ({role_snap or '—'})"
+        res = f" → закрыта {resolved_at}" if (resolved_at and status == "closed") else ""
+    line = f"{tag} #{_id} [{created_at}] — {place}\n   👤 {who}\n   📝 {desc}{res}"
+    if len(line) > TELEGRAM_TEXT_LIMIT - 100:
+        line = line[:TELEGRAM_TEXT_LIMIT - 101] + "…"
+    return line
+
+def history_page(scope: str, user_id: int, before_id: Optional[int] = None,
+                 after_id: Optional[int] = None):
+    """Текст страницы истории и клавиатура ◀/▶. scope: "me" — свои заявки, "all" — все.
+    Строки, не влезающие в лимит сообщения, уходят на соседнюю страницу."""
+    by_user_id = user_id if scope == "me" else None
+    rows = issues_page(by_user_id, before_id, after_id, limit=HISTORY_PAGE_SIZE + 1)
+    if after_id is not None:
+        has_newer, has_older = len(rows) > HISTORY_PAGE_SIZE, True
+        rows = rows[-HISTORY_PAGE_SIZE:]
+    else:
+        has_newer, has_older = before_id is not None, len(rows) > HISTORY_PAGE_SIZE
+        rows = rows[:HISTORY_PAGE_SIZE]
+    if not rows:
+        return None, None
+    lines, size = [], 0
+    for row in rows:
+        line = _history_line(row, scope)
+        if lines and size + len(line) + 2 > TELEGRAM_TEXT_LIMIT:
+            # отрезаются самые старые строки страницы — они доступны по «Старше ▶»
+            has_older = True
+            break
+        lines.append(line)
+        size += len(line) + 2
+    shown = rows[:len(lines)]
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("✏️ Изменить ФИО", callback_data="profile|edit_fio"))
-    kb.add(types.InlineKeyboardButton("🔄 Сменить направление", callback_data="profile|edit_role"))
-    bot.reply_to(
-        message,
-        f"Ваш профиль:\n<b>{fio}</b>\n{role}\nСоздан: {created_at}",
-        reply_markup=kb
-    )
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton("◀ Новее", callback_data=cb_data("h", scope, "n", shown[0][0])))
+    if has_older:
+        nav.append(types.InlineKeyboardButton("Старше ▶", callback_data=cb_data("h", scope, "o", shown[-1][0])))
+    if nav:
+        kb.row(*nav)
+    return "\n\n".join(lines), (kb if nav else None)
 
-@bot.message_handler(func=lambda m: m.text == "📜 История (мои)")
+@message_route(texts=("📜 История (мои)",))
 def on_history(message: types.Message):
-    rows = issues_by_user(message.from_user.id, limit=15)
-    if not rows:
-        bot.reply_to(message, "История пуста.", reply_markup=main_menu_for(message.from_user.id))
+    text, kb = history_page("me", message.from_user.id)
+    if text is None:
+        tg.reply_to(message, "История пуста.", reply_markup=main_menu_for(message.from_user.id))
         return
-    lines = []
-    for row in rows:
-        _id, created_at, status, area, subarea, equipment, desc, resolved_at, fio_snap, role_snap = row
-        tag = "🟩" if status == "closed" else "🟥"
-        place = " / ".join([x for x in [area, subarea, equipment] if x])
-        who = f"{fio_snap or '—'} ({role_snap or '—'})"
-        res = f" → закрыта {resolved_at}" if (resolved_at and status == "closed") else ""
-        lines.append(f"{tag} #{_id} [{created_at}] — {place}\n   👤 {who}\n   📝 {desc}{res}")
-    bot.reply_to(message, "\n\n".join(lines[:10]), reply_markup=main_menu_for(message.from_user.id))
+    tg.reply_to(message, text, reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text == "📚 История (все)")
+@message_route(texts=("📚 История (все)",))
 def on_history_all(message: types.Message):
     if user_level(message.from_user.id) < 2:
-        bot.reply_to(message, "Недостаточно прав: общую историю видят мастера и администраторы.")
+        tg.reply_to(message, "Недостаточно прав: общую историю видят мастера и администраторы.")
         return
-    rows = issues_all(limit=30)
-    if not rows:
-        bot.reply_to(message, "Заявок нет.", reply_markup=main_menu_for(message.from_user.id))
+    text, kb = history_page("all", message.from_user.id)
+    if text is None:
+        tg.reply_to(message, "Заявок нет.", reply_markup=main_menu_for(message.from_user.id))
         return
+    tg.reply_to(message, text, reply_markup=kb)
+
+SEARCH_PAGE_SIZE = 10
+
+def search_page(query: str, user_id: int, page: int = 0):
+    """Текст страницы результатов /search и клавиатура ◀/▶ (запрос хранится в сессии).
+    Мастера и администраторы ищут по всем заявкам, остальные — по своим."""
+    by_user_id = None if user_level(user_id) >= 2 else user_id
+    rows = issues_search(query, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE, by_user_id=by_user_id)
+    if not rows:
+        return None, None
     lines = []
-    for row in rows[:15]:
-        _id, created_at, user_name, area, subarea, equipment, desc, status, resolved_at, resolver_name, fio_snap, role_snap = row
+    for row in rows[:SEARCH_PAGE_SIZE]:
+        _id, created_at, status, snippet = row[0], row[1], row[7], row[12]
         tag = "🟩" if status == "closed" else "🟥"
-        place = " / ".join([x for x in [area, subarea, equipment] if x])
-        who = f"{fio_snap or user_name or '—'} ({role_snap or '—'})"
-        res = f" → закрыта {resolved_at} (закрыл: {resolver_name})" if (resolved_at and status == "closed") else ""
-        lines.append(f"{tag} #{_id} [{created_at}] — {place}\n   👤 {who}\n   📝 {desc}{res}")
-    bot.reply_to(message, "\n\n".join(lines), reply_markup=main_menu_for(message.from_user.id))
+        place = " / ".join([x for x in row[3:6] if x])
+        snippet = html.escape(snippet or "").replace("\x02", "<b>").replace("\x03", "</b>")
+        lines.append(f"{tag} #{_id} [{created_at}] — {place}\n   📝 {snippet}")
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀", callback_data=cb_data("s", page - 1)))
+    if len(rows) > SEARCH_PAGE_SIZE:
+        nav.append(types.InlineKeyboardButton("▶", callback_data=cb_data("s", page + 1)))
+    kb = None
+    if nav:
+        kb = types.InlineKeyboardMarkup()
+        kb.row(*nav)
+    text = f"🔎 «{html.escape(query)}», стр. {page + 1}:\n\n" + "\n\n".join(lines)
+    return text[:TELEGRAM_TEXT_LIMIT], kb
 
-@bot.message_handler(func=lambda m: m.text == "📤 Экспорт Excel")
-def on_export_excel(message: types.Message):
+@message_route(commands=("search",))
+def cmd_search(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    query = parts[1].strip() if len(parts) == 2 else ""
+    if not fts_match_query(query):
+        tg.reply_to(message, "Что ищем? Пример: <code>/search ванна течёт</code>")
+        return
+    text, kb = search_page(query, message.from_user.id)
+    if text is None:
+        tg.reply_to(message, "Ничего не найдено.")
+        return
+    s = ensure_session(message.from_user.id)
+    s["data"]["search_query"] = query
+    tg.reply_to(message, text, reply_markup=kb)
+
+def _fmt_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} д {hours} ч"
+
+@message_route(commands=("stats",))
+def cmd_stats(message: types.Message):
+    """/stats [дней] — отказы и MTTR по станкам и узлам; /stats rebuild — пересчёт (админ)."""
+    lvl = user_level(message.from_user.id)
+    if lvl < 2:
+        tg.reply_to(message, "Недостаточно прав: статистику видят мастера и администраторы.")
+        return
+    args = message.text.split()[1:]
+    if args and args[0] == "rebuild":
+        if lvl < 3:
+            tg.reply_to(message, "Пересчёт статистики — только для администраторов.")
+            return
+        rollups_rebuild()
+        tg.reply_to(message, "Статистика пересчитана.")
+        return
+    days = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 30
+    rows = reliability_stats(days)
+    if not rows:
+        tg.reply_to(message, f"За {days} дн. отказов нет.")
+        return
+    # группируем узлы под станком/линией: «Станок №8 > нож» -> «Станок №8»
+    machines: dict[str, list] = {}
+    for path, failures, closed, repair in rows:
+        machine, _, component = path.partition(" > ")
+        entry = machines.setdefault(machine, [0, 0, 0, []])
+        entry[0] += failures
+        entry[1] += closed
+        entry[2] += repair
+        if component:
+            entry[3].append((component, failures, closed, repair))
+    lines = [f"📊 Отказы и среднее время ремонта за {days} дн.:"]
+    for machine, (failures, closed, repair, comps) in sorted(machines.items(), key=lambda kv: -kv[1][0]):
+        mttr = f", MTTR {_fmt_duration(repair / closed)}" if closed else ""
+        lines.append(f"\n<b>{html.escape(machine)}</b> — отказов {failures}, закрыто {closed}{mttr}")
+        for component, c_failures, c_closed, c_repair in comps:
+            c_mttr = f", MTTR {_fmt_duration(c_repair / c_closed)}" if c_closed else ""
+            lines.append(f"   • {html.escape(component)} — {c_failures}{c_mttr}")
+    text = "\n".join(lines)
+    if len(text) > TELEGRAM_TEXT_LIMIT:
+        text = text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+    tg.reply_to(message, text)
+
+def subscription_options() -> dict[int, str]:
+    """Узел каталога (0 — всё) -> подпись: области, подразделения и станки.
+    Подписка хранится по id узла, название берётся из каталога только для кнопки."""
+    opts = {CATALOG_ROOT: "Все заявки"}
+    for node in catalog().walk():
+        depth = len(node.path)
+        if depth == 1:
+            opts[node.id] = f"{node.name} целиком"
+        elif depth == 2:
+            opts[node.id] = node.name
+        elif depth == 3:
+            opts[node.id] = f"{node.name} ({node.path[1]})"
+    return opts
+
+def subscriptions_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
+    active = subscriptions_of(user_id)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(*[
+        types.InlineKeyboardButton(("✅ " if node_id in active else "") + label, callback_data=cb_data("u", node_id))
+        for node_id, label in subscription_options().items()
+    ])
+    return kb
+
+@message_route(commands=("subscribe",))
+def cmd_subscribe(message: types.Message):
+    """/subscribe — уведомления о новых заявках по областям и станкам (мастера и админы)."""
+    if user_level(message.from_user.id) < 2:
+        tg.reply_to(message, "Уведомления о новых заявках доступны мастерам и администраторам.")
+        return
+    tg.reply_to(message, "🔔 О каких новых заявках сообщать? Нажмите, чтобы включить или выключить:",
+                reply_markup=subscriptions_keyboard(message.from_user.id))
+
+@callback_handler("u", int)
+def subscription_callbacks(cq: types.CallbackQuery, node_id: int):
+    if node_id not in subscription_options():
+        tg.answer_callback_query(cq.id, "Кнопка устарела, откройте /subscribe заново.")
+        return
+    if user_level(cq.from_user.id) < 2:
+        tg.answer_callback_query(cq.id, "Недостаточно прав.", show_alert=True)
+        return
+    on = subscription_toggle(cq.from_user.id, node_id)
+    _edit_reply_markup(cq.message.chat.id, cq.message.message_id, subscriptions_keyboard(cq.from_user.id))
+    tg.answer_callback_query(cq.id, "Подписка включена" if on else "Подписка выключена")
+
+CATALOG_USAGE = (
+    "/catalog — дерево с номерами узлов\n"
+    "/catalog add &lt;номер родителя, 0 — корень&gt; &lt;название&gt;\n"
+    "/catalog rename &lt;номер&gt; &lt;название&gt;\n"
+    "/catalog prompt &lt;номер&gt; &lt;подсказка, например «выберите узел:»&gt;\n"
+    "/catalog hide &lt;номер&gt; | show &lt;номер&gt;"
+)
+
+@message_route(commands=("catalog",))
+def cmd_catalog(message: types.Message):
+    """/catalog — просмотр и правка каталога оборудования (администраторы). Воркеры
+    подхватывают правку сами, в течение CATALOG_CHECK_SECONDS."""
     if user_level(message.from_user.id) < 3:
-        bot.reply_to(message, "Доступ к экспорту только для администраторов.")
+        tg.reply_to(message, "Команда только для администраторов.")
+        return
+    args = message.text.split(maxsplit=3)[1:]
+    index = catalog()
+    if not args:
+        lines = [f"🗂 Каталог v{index.version}, узлов: {len(index)}"]
+        lines += [f"{'   ' * (len(node.path) - 1)}{node.id}. {html.escape(node.name)}" for node in index.walk()]
+        hidden = catalog_hidden()
+        if hidden:
+            lines.append("\nСкрыты: " + ", ".join(f"{node_id}. {html.escape(name)}" for node_id, name in hidden))
+        lines.append("\n" + CATALOG_USAGE)
+        text = lines[0]
+        for line in lines[1:]:
+            if len(text) + len(line) + 1 > TELEGRAM_TEXT_LIMIT:
+                break
+            text += "\n" + line
+        tg.reply_to(message, text)
+        return
+    action = args[0]
+    if action not in ("add", "rename", "prompt", "hide", "show") or len(args) < 2 or not args[1].isdigit():
+        tg.reply_to(message, CATALOG_USAGE)
+        return
+    node_id = int(args[1])
+    value = args[2].strip() if len(args) > 2 else ""
+    if action in ("add", "rename"):
+        if not value or len(value) > CATALOG_NAME_LIMIT or ">" in value:
+            tg.reply_to(message, f"Название — от 1 до {CATALOG_NAME_LIMIT} символов, без «&gt;».")
+            return
+        if action == "add" and index.node(node_id) is None:
+            tg.reply_to(message, f"Узла {node_id} нет (или он скрыт).")
+            return
+    if action == "prompt" and not value:
+        tg.reply_to(message, CATALOG_USAGE)
         return
-    export_file = "issues_export.xlsx"
     try:
-        export_to_excel(export_file, status=None, by_user_id=None, limit=None)
-        if os.path.exists(export_file):
-            with open(export_file, "rb") as f:
-                bot.send_document(message.chat.id, f, caption="Экспорт заявок в Excel")
+        if action == "add":
+            node_id = catalog_add(node_id, value)
+            done = True
+        elif action == "rename":
+            done = catalog_update(node_id, name=value)
+        elif action == "prompt":
+            done = catalog_update(node_id, prompt=value)
         else:
-            bot.reply_to(message, "Файл экспорта не найден.")
+            done = catalog_update(node_id, hidden=int(action == "hide"))
+    except sqlite3.IntegrityError:
+        tg.reply_to(message, f"У этого родителя уже есть «{html.escape(value)}».")
+        return
+    if not done:
+        tg.reply_to(message, f"Узла {node_id} нет.")
+        return
+    index = catalog(force=True)
+    node = index.node(node_id)
+    where = " / ".join(node.path) if node else "скрыт"
+    tg.reply_to(message, f"Готово: узел {node_id} ({html.escape(where)}), каталог v{index.version}.")
+
+@message_route(commands=("dbstats",))
+def cmd_dbstats(message: types.Message):
+    """/dbstats [total|count|max|rows|statements] — самые дорогие запросы; /dbstats slow; /dbstats reset."""
+    if user_level(message.from_user.id) < 3:
+        tg.reply_to(message, "Команда только для администраторов.")
+        return
+    if not DB_TRACE:
+        tg.reply_to(message, "Трассировка SQL выключена (запустите с DB_TRACE=1).")
+        return
+    arg = (message.text.split()[1:] or ["total"])[0]
+    if arg == "reset":
+        QUERY_STATS.reset()
+        tg.reply_to(message, "Статистика запросов сброшена.")
+        return
+    if arg == "slow":
+        entries = list(QUERY_STATS.slow)[-10:]
+        if not entries:
+            tg.reply_to(message, f"Запросов дольше {DB_SLOW_QUERY_MS:g} мс не было.")
+            return
+        lines = [f"🐢 Медленные запросы (порог {DB_SLOW_QUERY_MS:g} мс):"]
+        for e in reversed(entries):
+            plan = "\n" + html.escape(" | ".join(e["plan"])) if e["plan"] else ""
+            lines.append(f"\n<b>{e['ms']} мс</b> {e['at']} {html.escape(e['params'])}\n"
+                         f"<code>{html.escape(e['sql'][:300])}</code>{plan}")
+    else:
+        if arg not in QueryStats.FIELDS:
+            arg = "total"
+        lines = [f"🗄 Запросы по {arg} (неявных BEGIN: {QUERY_STATS.implicit_begins}):"]
+        for e in QUERY_STATS.top(10, by=arg):
+            lines.append(f"\n<b>{e['total_ms']} мс</b> ×{e['count']}, ср. {e['avg_ms']}, макс. {e['max_ms']}, "
+                         f"строк {e['rows']}, операторов {e['statements']}\n<code>{html.escape(e['sql'][:300])}</code>")
+    # целыми записями: обрезка посреди <code> ломает HTML-разметку
+    text = lines[0]
+    for line in lines[1:]:
+        if len(text) + len(line) + 1 > TELEGRAM_TEXT_LIMIT:
+            break
+        text += "\n" + line
+    tg.reply_to(message, text)
+
+@message_route(texts=("📤 Экспорт Excel",))
+def on_export_excel(message: types.Message):
+    if user_level(message.from_user.id) < 3:
+        tg.reply_to(message, "Доступ к экспорту только для администраторов.")
+        return
+    tg.send_message(
+        message.chat.id,
+        "Что выгрузить?\nПроизвольный период: <code>/export 2024-01-01 2024-01-31</code>",
+        reply_markup=KEYBOARDS["export"],
+    )
+
+@message_route(commands=("export",))
+def cmd_export(message: types.Message):
+    if user_level(message.from_user.id) < 3:
+        tg.reply_to(message, "Доступ к экспорту только для администраторов.")
+        return
+    args = message.text.split()[1:]
+    try:
+        days = [datetime.strptime(a, "%Y-%m-%d") for a in args[:2]]
+    except ValueError:
+        days = []
+    if not days:
+        tg.reply_to(message, "Формат: <code>/export 2024-01-01 2024-01-31</code> (дата окончания необязательна)")
+        return
+    date_to = (days[1] + timedelta(days=1)).isoformat() if len(days) > 1 else None
+    export_send(message.chat.id, message.from_user.id, date_from=days[0].isoformat(), date_to=date_to)
+
+def export_send(chat_id: int, user_id: int, mode: str = "range", **filters) -> None:
+    """mode: full — весь журнал из кэша по версии данных; delta — с прошлой выгрузки
+    этого админа; range — по фильтрам (даты). full и delta двигают водяную метку."""
+    caption = "Экспорт заявок в Excel"
+    file_name = f"issues_export_{datetime.now():%Y%m%d_%H%M%S}.xlsx"
+    try:
+        if mode == "full":
+            version, path, stats = export_full_cached()
+            file_id = _export_file_ids.get(version)
+            if file_id is not None:
+                try:
+                    tg.send_document(chat_id, file_id, caption=caption).result()
+                except ApiTelegramException:
+                    file_id = None
+            if file_id is None:
+                with open(path, "rb") as f:
+                    # ждём внутри with: файл читается потоком OUTBOX
+                    sent = tg.send_document(chat_id, f, caption=caption, visible_file_name=file_name).result()
+                if sent.document is not None:
+                    _export_file_ids.clear()
+                    _export_file_ids[version] = sent.document.file_id
+            export_watermark_advance(user_id, stats)
+            return
+        if mode == "delta":
+            filters["changed_since"] = export_watermark_get(user_id) or (0, None)
+            caption = "Изменения с прошлой выгрузки"
+        # у каждого экспорта свой буфер: одновременные выгрузки не пересекаются,
+        # маленькие файлы остаются в памяти, большие уходят во временный файл
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX) as buf:
+            with REPORT_SNAPSHOT.connection() as snap:
+                stats = export_to_excel(buf, conn=snap, as_of=REPORT_SNAPSHOT.taken_at(snap), **filters)
+            if not stats["rows"]:
+                tg.send_message(chat_id, "Новых заявок и изменений нет.")
+                return
+            buf.seek(0)
+            tg.send_document(chat_id, buf, caption=caption, visible_file_name=file_name).result()
+        if mode == "delta":
+            export_watermark_advance(user_id, stats)
     except Exception as e:
-        bot.reply_to(message, f"Не удалось сделать экспорт: {e}")
-    finally:
-        try:
-            os.remove(export_file)
-        except Exception:
-            pass
+        tg.send_message(chat_id, f"Не удалось сделать экспорт: {e}")
 
 # =====================
 # 🔁 CALLBACKS: REPORT / FIX
 # =====================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("report|"))
-def report_callbacks(cq: types.CallbackQuery):
-    user_id = cq.from_user.id
-    s = ensure_session(user_id)
-    parts = cq.data.split("|")  # [report, action, value]
-    action = parts[1]
-    value = parts[2] if len(parts) > 2 else None
-
-    # Назад
-    if action == "back":
-        where = value
-        if where == "1":
-            s["step"] = "report_layer1"
-            s["data"].update({"area": None, "subarea": None, "equipment": None, "component": None, "_machine_raw": None})
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Выберите область:", reply_markup=menu_layer1())
-        elif where == "2_ceh":
-            s["step"] = "report_layer2_ceh"
-            s["data"].update({"subarea": None, "equipment": None, "component": None})
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Цех → выберите подразделение:", reply_markup=menu_layer2_for_ceh())
-        elif where == "2_transport":
-            s["step"] = "report_layer2_transport"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Транспорт → выберите тип:", reply_markup=menu_layer2_transport())
-        elif where == "3_pack":
-            s["step"] = "report_layer3_pack"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Фасовка → выберите линию:", reply_markup=menu_layer3_packing())
-        elif where == "3_prod":
-            s["step"] = "report_layer3_prod"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Производство → выберите станок:", reply_markup=menu_layer3_production())
-        elif where == "4_group":
-            machine = s["data"].get("_machine_raw") or s["data"].get("equipment")
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{machine} → выберите узел:", reply_markup=menu_layer4_prod_components(machine))
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Область
-    if action == "area":
-        s["data"].update({"area": value, "subarea": None, "equipment": None, "component": None, "_machine_raw": None})
-        if value == "Цех":
-            s["step"] = "report_layer2_ceh"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Цех → выберите подразделение:", reply_markup=menu_layer2_for_ceh())
-        elif value == "Транспорт":
-            s["step"] = "report_layer2_transport"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Транспорт → выберите тип:", reply_markup=menu_layer2_transport())
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Транспорт → сразу описание
-    if action == "transport":
-        s["data"]["subarea"] = value
-        s["step"] = "report_description"
-        safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{value} → опишите проблему:")
-        bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Цех → подразделение
-    if action == "subarea":
-        s["data"]["subarea"] = value
-        s["data"].update({"equipment": None, "component": None, "_machine_raw": None})
-        if value == "Производство":
-            s["step"] = "report_layer3_prod"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Производство → выберите станок:", reply_markup=menu_layer3_production())
-        elif value == "Фасовка":
-            s["step"] = "report_layer3_pack"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Фасовка → выберите линию:", reply_markup=menu_layer3_packing())
-        elif value == "Техническое оборудование":
-            s["step"] = "report_layer3_tech"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, "Техническое оборудование → выберите:", reply_markup=menu_layer3_tech())
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Тех.оборудование → описание
-    if action == "tech":
-        s["data"]["equipment"] = value
-        s["step"] = "report_description"
-        safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{value} → опишите проблему:")
-        bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Выбор оборудования/линии
-    if action == "equipment":
-        chosen = value
-        s["data"]["equipment"] = chosen
-        s["data"]["_machine_raw"] = chosen
-        s["data"]["component"] = None
-        if s["data"].get("subarea") == "Фасовка":
-            if chosen == "2.5":
-                s["step"] = "report_description"
-                safe_edit_text(cq.message.chat.id, cq.message.message_id, f"Фасовка {chosen} → опишите проблему:")
-                bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-            else:
-                s["step"] = "report_layer4_pack_component"
-                safe_edit_text(cq.message.chat.id, cq.message.message_id, f"Фасовка {chosen} → выберите узел:", reply_markup=menu_layer4_pack_components())
-        elif s["data"].get("subarea") == "Производство":
-            s["step"] = "report_layer4_prod_component"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{chosen} → выберите узел:", reply_markup=menu_layer4_prod_components(chosen))
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Фасовка: узел
-    if action == "packcomp":
-        comp = value
-        equip = s["data"].get("equipment")
-        s["data"]["component"] = comp
-        s["data"]["equipment"] = f"{equip} > {comp}"
-        s["step"] = "report_description"
-        safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{equip} / {comp} → опишите проблему:")
-        bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Производство: узел
-    if action == "prodcomp":
-        comp = value
-        machine = s["data"].get("_machine_raw") or s["data"].get("equipment")
-        if machine == "Станок №8" and comp == "группорезка":
-            s["step"] = "report_layer5_groupcut"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{machine} → группорезка → выберите подузел:", reply_markup=menu_layer5_groupcut_sub())
-        else:
-            s["data"]["component"] = comp
-            s["data"]["equipment"] = f"{machine} > {comp}"
-            s["step"] = "report_description"
-            safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{machine} / {comp} → опишите проблему:")
-            bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-        bot.answer_callback_query(cq.id)
-        return
-
-    # Производство: подузлы для группорезки
-    if action == "prodsubcomp":
-        sub = value
-        machine = s["data"].get("_machine_raw") or s["data"].get("equipment")
-        s["data"]["component"] = f"группорезка > {sub}"
-        s["data"]["equipment"] = f"{machine} > группорезка > {sub}"
-        s["step"] = "report_description"
-        safe_edit_text(cq.message.chat.id, cq.message.message_id, f"{machine} / группорезка / {sub} → опишите проблему:")
-        bot.send_message(cq.message.chat.id, "Введите описание поломки:")
-        bot.answer_callback_query(cq.id)
+@callback_handler("n", int)
+def report_callbacks(cq: types.CallbackQuery, node_id: int):
+    s = ensure_session(cq.from_user.id)
+    index = catalog()
+    node = index.node(node_id)
+    if node is None:
+        # кнопка из старого сообщения: узел скрыт или удалён
+        node = index.node(CATALOG_ROOT)
+        tg.answer_callback_query(cq.id, "Каталог изменился — выберите заново.")
+    else:
+        tg.answer_callback_query(cq.id)
+
+    kb = index.keyboard(node.id)
+    if kb is not None:
+        s["step"] = "report_catalog"
+        s["data"] = {"node": node.id}
+        safe_edit_text(cq.message.chat.id, cq.message.message_id, node.text, reply_markup=kb)
+        return
+
+    area, subarea, equipment = index.issue_fields(node)
+    s["step"] = "report_description"
+    s["data"] = {"node": node.id, "area": area, "subarea": subarea, "equipment": equipment}
+    safe_edit_text(cq.message.chat.id, cq.message.message_id, node.text)
+    tg.send_message(cq.message.chat.id, "Введите описание поломки:")
+
+@callback_handler("h", ("me", "all"), ("o", "n"), int)
+def history_callbacks(cq: types.CallbackQuery, scope: str, direction: str, cursor: int):
+    if scope == "all" and user_level(cq.from_user.id) < 2:
+        tg.answer_callback_query(cq.id, "Недостаточно прав", show_alert=True)
+        return
+    if direction == "n":
+        text, kb = history_page(scope, cq.from_user.id, after_id=cursor)
+    else:
+        text, kb = history_page(scope, cq.from_user.id, before_id=cursor)
+    if text is None:
+        tg.answer_callback_query(cq.id, "Больше заявок нет")
+        return
+    safe_edit_text(cq.message.chat.id, cq.message.message_id, text, reply_markup=kb)
+    tg.answer_callback_query(cq.id)
+
+@callback_handler("s", int)
+def search_callbacks(cq: types.CallbackQuery, page: int):
+    query = ensure_session(cq.from_user.id)["data"].get("search_query")
+    if not query:
+        tg.answer_callback_query(cq.id, "Поиск устарел — повторите /search", show_alert=True)
+        return
+    text, kb = search_page(query, cq.from_user.id, page)
+    if text is None:
+        tg.answer_callback_query(cq.id, "Больше результатов нет")
         return
+    safe_edit_text(cq.message.chat.id, cq.message.message_id, text, reply_markup=kb)
+    tg.answer_callback_query(cq.id)
+
+def _export_allowed(cq: types.CallbackQuery) -> bool:
+    if user_level(cq.from_user.id) < 3:
+        tg.answer_callback_query(cq.id, "Доступ к экспорту только для администраторов.", show_alert=True)
+        return False
+    tg.answer_callback_query(cq.id, "Готовлю файл…")
+    return True
+
+@callback_handler("xf")
+def export_full_callback(cq: types.CallbackQuery):
+    if _export_allowed(cq):
+        export_send(cq.message.chat.id, cq.from_user.id, mode="full")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("fix|"))
-def fix_callbacks(cq: types.CallbackQuery):
+@callback_handler("xd")
+def export_delta_callback(cq: types.CallbackQuery):
+    if _export_allowed(cq):
+        export_send(cq.message.chat.id, cq.from_user.id, mode="delta")
+
+@callback_handler("xp", int)
+def export_days_callback(cq: types.CallbackQuery, days: int):
+    if _export_allowed(cq):
+        date_from = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+        export_send(cq.message.chat.id, cq.from_user.id, date_from=date_from)
+
+def _fix_allowed(cq: types.CallbackQuery) -> bool:
     if user_level(cq.from_user.id) < 2:
-        bot.answer_callback_query(cq.id, "Недостаточно прав для закрытия заявок", show_alert=True)
-        return
-    parts = cq.data.split("|")
-    action = parts[1]
-    if action == "refresh":
-        bot.edit_message_reply_markup(cq.message.chat.id, cq.message.message_id, reply_markup=open_issues_inline())
-        bot.answer_callback_query(cq.id, "Обновлено")
-        return
-    if action == "pick":
-        issue_id = int(parts[2])
-        ok = issue_close(issue_id, cq.from_user.id, cq.from_user.username or cq.from_user.first_name or "")
-        if ok:
-            bot.edit_message_text(f"Заявка #{issue_id} закрыта ✅", cq.message.chat.id, cq.message.message_id)
-        else:
-            bot.answer_callback_query(cq.id, "Не удалось закрыть (возможно, уже закрыта)", show_alert=True)
-        bot.send_message(cq.message.chat.id, "Готово. Что дальше?", reply_markup=main_menu_for(cq.from_user.id))
+        tg.answer_callback_query(cq.id, "Недостаточно прав для закрытия заявок", show_alert=True)
+        return False
+    return True
+
+@callback_handler("fr", int, ("o", "n", "-"), int)
+def fix_refresh(cq: types.CallbackQuery, shown: int, direction: str, cursor_id: int):
+    if not _fix_allowed(cq):
         return
+    # shown — версия данных на экране: не менялась — Telegram не трогаем
+    version = issues_version()
+    if version == shown:
+        tg.answer_callback_query(cq.id, "Новых изменений нет")
+        return
+    cursor = (direction, cursor_id) if direction != "-" else (None, 0)
+    _edit_reply_markup(cq.message.chat.id, cq.message.message_id, open_issues_inline(cursor, version))
+    tg.answer_callback_query(cq.id, "Обновлено")
+
+@callback_handler("fg", ("o", "n"), int)
+def fix_page(cq: types.CallbackQuery, direction: str, cursor_id: int):
+    if not _fix_allowed(cq):
+        return
+    _edit_reply_markup(cq.message.chat.id, cq.message.message_id, open_issues_inline((direction, cursor_id)))
+    tg.answer_callback_query(cq.id)
+
+@callback_handler("fp", int)
+def fix_pick(cq: types.CallbackQuery, issue_id: int):
+    if not _fix_allowed(cq):
+        return
+    ok = issue_close(issue_id, cq.from_user.id, cq.from_user.username or cq.from_user.first_name or "")
+    if ok:
+        tg.edit_message_text(f"Заявка #{issue_id} закрыта ✅", cq.message.chat.id, cq.message.message_id)
+    else:
+        tg.answer_callback_query(cq.id, "Не удалось закрыть (возможно, уже закрыта)", show_alert=True)
+    tg.send_message(cq.message.chat.id, "Готово. Что дальше?", reply_markup=main_menu_for(cq.from_user.id))
 
 # =====================
-# 📨 РОУТЕР ТЕКСТОВ (описание поломки)
+# 📨 ТЕКСТ: ОПИСАНИЕ ПОЛОМКИ И ПОДСКАЗКА
 # =====================
-@bot.message_handler(func=lambda m: True)
-def text_router(message: types.Message):
+@message_route(steps=("report_description",))
+def on_report_description(message: types.Message):
     user_id = message.from_user.id
-    s = ensure_session(user_id)
-
-    if s.get("step") == "report_description":
-        description = message.text.strip()
-        data = s["data"]
-        area = data.get("area")
-        subarea = data.get("subarea")
-        equipment = data.get("equipment")
-        issue_id = issue_create(
-            user_id=user_id,
-            user_name=message.from_user.username or message.from_user.first_name or "",
-            area=area,
-            subarea=subarea,
-            equipment=equipment,
-            description=description,
-        )
-        place = " / ".join([x for x in [area, subarea, equipment] if x])
-        bot.reply_to(
-            message,
-            f"✅ Заявка создана: <b>#{issue_id}</b>\n"
-            f"📍 {place or '—'}\n"
-            f"📝 {description}",
-            reply_markup=main_menu_for(message.from_user.id),
-        )
-        reset_session(user_id)
-        return
+    description = message.text.strip()
+    data = ensure_session(user_id)["data"]
+    area = data.get("area")
+    subarea = data.get("subarea")
+    equipment = data.get("equipment")
+    issue_id = issue_create(
+        user_id=user_id,
+        user_name=message.from_user.username or message.from_user.first_name or "",
+        area=area,
+        subarea=subarea,
+        equipment=equipment,
+        description=description,
+    )
+    place = " / ".join([x for x in [area, subarea, equipment] if x])
+    tg.reply_to(
+        message,
+        f"✅ Заявка создана: <b>#{issue_id}</b>\n"
+        f"📍 {place or '—'}\n"
+        f"📝 {description}",
+        reply_markup=main_menu_for(message.from_user.id),
+    )
+    reset_session(user_id)
 
+@route_default
+def text_router(message: types.Message):
     # Любой иной текст — подсказываем меню
-    if message.text not in [
-        "📣 Сообщить о проблеме",
-        "✅ Сообщить о решении",
-        "📜 История (мои)",
-        "📚 История (все)",
-        "📤 Экспорт Excel",
-        "👤 Профиль",
-    ]:
-        bot.send_message(message.chat.id, "Выберите действие из меню ниже:", reply_markup=main_menu_for(message.from_user.id))
+    tg.send_message(message.chat.id, "Выберите действие из меню ниже:", reply_markup=main_menu_for(message.from_user.id))
 
 # =====================
 # 🔗 DEEPLINK / QR helper
@@ -977,11 +4126,27 @@ def decode_equipment_from_payload(payload: str) -> Optional[str]:
     except Exception:
         return None
 
+# все обработчики зарегистрированы выше — навешиваем метрики один раз
+instrument_handlers(bot)
+
+def shutdown() -> None:
+    """Останавливает фоновые потоки по зависимостям: входящие апдейты порождают уведомления
+    и записи, уведомления — записи и сообщения; последним уходит OUTBOX."""
+    UPDATES.stop()
+    NOTIFIER.stop()
+    WRITER.stop()
+    OUTBOX.stop()
+
+atexit.register(shutdown)
+
 # =====================
 # 🚀 ЗАПУСК
 # =====================
 if __name__ == "__main__":
-    db_init()
-    db_init_users_and_migration()
-    print("🤖 Бот запущен. Меню готово.")
-    bot.infinity_polling(timeout=60, long_polling_timeout=60, skip_pending=True)
+    # локально — polling; TELEGRAM_MODE=webhook поднимает Flask (в проде — gunicorn main:app)
+    if os.getenv("TELEGRAM_MODE", "polling") == "webhook":
+        print("🌐 Webhook режим. Flask-приложение запущено.")
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+    else:
+        print("🤖 Бот запущен. Меню готово.")
+        bot.infinity_polling(timeout=60, long_polling_timeout=60, skip_pending=True)
@@ -0,0 +1,66 @@
+"""Обслуживание базы бота (вместо clear_issues.py — заявки не удаляются, а уходят в архив).
+
+    python maintenance.py archive --days 90     # закрытые старше 90 дней -> issues_archive, затем compact
+    python maintenance.py compact               # wal_checkpoint(TRUNCATE) + incremental_vacuum
+    python maintenance.py compact --enable-incremental-vacuum   # однократно, файл блокируется
+    python maintenance.py rollups-rebuild       # пересчёт статистики /stats с нуля
+    python maintenance.py import history.xlsx   # заявки из .xlsx/.csv в раскладке выгрузки
+
+Путь к базе: --db, переменная DB_PATH или issues.db рядом с main.py.
+"""
+import argparse
+import os
+import time
+
+
+def run(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Обслуживание базы заявок")
+    parser.add_argument("--db", help="путь к issues.db")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_archive = sub.add_parser("archive", help="перенести старые закрытые заявки в архив")
+    p_archive.add_argument("--days", type=int, default=90, help="закрытые больше N дней назад (90)")
+    p_archive.add_argument("--batch", type=int, default=500, help="заявок в одной транзакции (500)")
+    p_archive.add_argument("--no-compact", action="store_true", help="не делать checkpoint/vacuum")
+    p_compact = sub.add_parser("compact", help="checkpoint WAL и incremental vacuum")
+    p_compact.add_argument("--enable-incremental-vacuum", action="store_true",
+                           help="перевести файл в auto_vacuum=INCREMENTAL (полный VACUUM)")
+    sub.add_parser("rollups-rebuild", help="пересчитать статистику надёжности")
+    p_import = sub.add_parser("import", help="загрузить старые заявки из .xlsx/.csv")
+    p_import.add_argument("file", help="файл в раскладке выгрузки (столбцы EXPORT_COLUMNS, "
+                          "необязательный user_id — Telegram id автора)")
+    p_import.add_argument("--batch", type=int, help="строк в одной транзакции (IMPORT_BATCH, 2000)")
+    p_import.add_argument("--dry-run", action="store_true", help="только проверить строки, не записывать")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        os.environ["DB_PATH"] = os.path.abspath(args.db)
+    # импорт после DB_PATH: пул соединений и миграции берут путь при импорте
+    import main as bot_app
+
+    if args.cmd == "archive":
+        started = time.monotonic()
+        moved = bot_app.archive_closed_issues(args.days, batch=args.batch)
+        print(f"📦 В архив перенесено заявок: {moved} ({time.monotonic() - started:.1f} с)")
+        if not args.no_compact:
+            print(f"🧹 {bot_app.db_compact()}")
+    elif args.cmd == "compact":
+        if args.enable_incremental_vacuum:
+            bot_app.db_enable_incremental_vacuum()
+            print("auto_vacuum=INCREMENTAL включён")
+        print(f"🧹 {bot_app.db_compact()}")
+    elif args.cmd == "rollups-rebuild":
+        bot_app.rollups_rebuild()
+        print("📊 Статистика пересчитана")
+    elif args.cmd == "import":
+        stats = bot_app.import_issues(args.file, batch=args.batch or bot_app.IMPORT_BATCH, dry_run=args.dry_run)
+        for line, reason in stats["errors"]:
+            print(f"  строка {line}: {reason}")
+        print(f"📥 Прочитано строк: {stats['read']}, записано: {stats['inserted']}, "
+              f"уже были: {stats['skipped']}, отклонено: {stats['rejected']} "
+              f"({stats['seconds']:.1f} с; строк/с: прочитано {stats['read_per_second']}, "
+              f"записано {stats['inserted_per_second']})")
+    bot_app.WRITER.stop()
+
+
+if __name__ == "__main__":
+    run()
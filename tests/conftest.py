@@ -0,0 +1,22 @@
+"""Окружение для тестов: main импортируется с временной БД и фиктивным токеном,
+как в bench.py — без сети и без issues.db рядом с кодом."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["DB_PATH"] = os.path.join(_workdir, "tests.db")
+os.environ["EXPORT_CACHE_DIR"] = os.path.join(_workdir, "exports")
+os.environ.setdefault("BOT_TOKEN", "0:tests")
+os.environ.setdefault("ADMINS", "1")
+
+
+@pytest.fixture(scope="session")
+def bot_app():
+    import main
+    return main
@@ -0,0 +1,113 @@
+"""import_issues: разбор .csv/.xlsx, проверка по каталогу, повторные id."""
+import csv
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def leaf(bot_app):
+    """(area, subarea, equipment) листа каталога — так его пишет выгрузка."""
+    node = next(n for n in bot_app.catalog().walk() if not n.children)
+    return bot_app.CatalogIndex.issue_fields(node)
+
+
+def _write_csv(path, header, rows, delimiter=","):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+def _issue(bot_app, issue_id):
+    with bot_app.get_conn() as conn:
+        return conn.execute("SELECT created_at, user_id, area, subarea, equipment, description, status, "
+                            "resolved_at, resolver_name FROM issues WHERE id=?", (issue_id,)).fetchone()
+
+
+def test_csv_any_column_order_and_delimiter(bot_app, leaf, tmp_path):
+    area, subarea, equipment = leaf
+    path = _write_csv(tmp_path / "history.csv",
+                      ["description", "лишний", "id", "area", "subarea", "equipment", "created_at",
+                       "resolved_at", "resolver_name", "user_id"],
+                      [["течь", "x", 1001, area, subarea, equipment, "2021-03-04T10:39:00",
+                        "2021-03-05 10:00:00", "Иванов", 42],
+                       ["шум", "y", 1002, area, subarea, equipment, "2021-03-06T08:00:00", "", "", ""],
+                       ["", "", "", "", "", "", "", "", "", ""]],
+                      delimiter=";")
+
+    stats = bot_app.import_issues(path)
+
+    assert (stats["read"], stats["inserted"], stats["skipped"], stats["rejected"]) == (2, 2, 0, 0)
+    assert stats["inserted_per_second"] > 0
+    assert _issue(bot_app, 1001) == ("2021-03-04T10:39:00", 42, area, subarea, equipment, "течь",
+                                     "closed", "2021-03-05T10:00:00", "Иванов")
+    # без user_id автор неизвестен, без resolved_at заявка открыта
+    assert _issue(bot_app, 1002)[1] == 0
+    assert _issue(bot_app, 1002)[6:8] == ("open", None)
+
+
+def test_xlsx(bot_app, leaf, tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    area, subarea, equipment = leaf
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(list(bot_app.EXPORT_COLUMNS))
+    values = {"id": 1101, "created_at": datetime(2022, 1, 2, 3, 4, 5), "user_name": "Петров",
+              "area": area, "subarea": subarea, "equipment": equipment, "description": "не включается",
+              "status": "open"}
+    ws.append([values.get(c) for c in bot_app.EXPORT_COLUMNS])
+    path = str(tmp_path / "history.xlsx")
+    wb.save(path)
+
+    stats = bot_app.import_issues(path)
+
+    assert (stats["read"], stats["inserted"], stats["rejected"]) == (1, 1, 0)
+    assert _issue(bot_app, 1101)[:3] == ("2022-01-02T03:04:05", 0, area)
+
+
+def test_rows_outside_catalog_are_rejected(bot_app, leaf, tmp_path):
+    area, subarea, equipment = leaf
+    path = _write_csv(tmp_path / "history.csv", ["id", "created_at", "area", "subarea", "equipment", "description"],
+                      [[1201, "2023-05-01T09:00:00", area, subarea, "Несуществующий станок", "сломан"],
+                       [1202, "2023-05-01T09:00:00", area, subarea, equipment, "сломан"],
+                       [1203, "2023-05-01T09:00:00", "", "", "Насос QR-7", "по QR"],
+                       [1204, "не дата", area, subarea, equipment, "сломан"]])
+
+    stats = bot_app.import_issues(path)
+
+    assert (stats["read"], stats["inserted"], stats["rejected"]) == (4, 2, 2)
+    (line, reason), (line_date, reason_date) = stats["errors"]
+    assert line == 2 and reason.startswith("нет в каталоге")
+    assert line_date == 5
+    assert _issue(bot_app, 1201) is None
+    # заявка без области (QR) каталогом не проверяется
+    assert _issue(bot_app, 1203)[2:5] == (None, None, "Насос QR-7")
+
+
+def test_existing_ids_are_skipped(bot_app, leaf, tmp_path):
+    area, subarea, equipment = leaf
+    header = ["id", "created_at", "area", "subarea", "equipment", "description"]
+    path = _write_csv(tmp_path / "history.csv", header,
+                      [[1301, "2023-06-01T09:00:00", area, subarea, equipment, "первая"],
+                       [1302, "2023-06-01T09:00:00", area, subarea, equipment, "вторая"],
+                       [1301, "2023-06-02T09:00:00", area, subarea, equipment, "дубль в файле"]])
+
+    first = bot_app.import_issues(path, batch=2)
+    again = bot_app.import_issues(path)
+
+    assert (first["inserted"], first["skipped"]) == (2, 1)
+    assert (again["inserted"], again["skipped"]) == (0, 3)
+    assert _issue(bot_app, 1301)[5] == "первая"
+
+
+def test_dry_run_writes_nothing(bot_app, leaf, tmp_path):
+    area, subarea, equipment = leaf
+    path = _write_csv(tmp_path / "history.csv", ["id", "created_at", "area", "subarea", "equipment", "description"],
+                      [[1401, "2023-07-01T09:00:00", area, subarea, equipment, "проверка"]])
+
+    stats = bot_app.import_issues(path, dry_run=True)
+
+    assert (stats["read"], stats["inserted"], stats["rejected"]) == (1, 0, 0)
+    assert _issue(bot_app, 1401) is None
@@ -0,0 +1,86 @@
+"""TelegramDispatcher против tg_stub.StubTelegramServer: порядок в чате, 429 и отложенные задания."""
+import pytest
+from telebot import apihelper
+
+from tg_stub import StubTelegramServer
+
+
+@pytest.fixture
+def outbox(bot_app):
+    """Свой диспетчер на каждый тест: лимиты задаёт тест, общий OUTBOX не трогаем."""
+    created = []
+
+    def make(server: StubTelegramServer, **limits):
+        dispatcher = bot_app.TelegramDispatcher(workers=2, **limits)
+        apihelper.API_URL = server.api_url
+        apihelper.CUSTOM_REQUEST_SENDER = dispatcher.request
+        created.append(dispatcher)
+        return dispatcher, bot_app.QueuedBot(bot_app.bot, dispatcher)
+
+    api_url, sender = apihelper.API_URL, apihelper.CUSTOM_REQUEST_SENDER
+    yield make
+    for dispatcher in created:
+        dispatcher.stop()
+    apihelper.API_URL, apihelper.CUSTOM_REQUEST_SENDER = api_url, sender
+
+
+def _texts(server: StubTelegramServer, chat_id: int) -> list:
+    return [text for chat, text, _ in server.delivered if chat == chat_id]
+
+
+def test_chat_order_survives_flood_control(outbox):
+    # заглушка пускает 3 сообщения в секунду на чат, остальное — 429 с retry_after
+    with StubTelegramServer(chat_limit=3, retry_after=1) as server:
+        dispatcher, tg = outbox(server, global_rate=100, chat_rate=100, chat_burst=100)
+        chats = (101, 102, 103)
+        for i in range(6):
+            for chat_id in chats:
+                tg.send_message(chat_id, f"{chat_id}:{i}")
+        dispatcher.join(timeout=15)
+
+        for chat_id in chats:
+            assert _texts(server, chat_id) == [f"{chat_id}:{i}" for i in range(6)]
+        assert server.stats()["flood_429"]
+        assert dispatcher.stats()["failed"] == 0
+
+
+def test_retry_after_is_honoured(outbox):
+    with StubTelegramServer(chat_limit=1, retry_after=1) as server:
+        dispatcher, tg = outbox(server, global_rate=100, chat_rate=100, chat_burst=100)
+        first = tg.send_message(201, "first")
+        second = tg.send_message(201, "second")
+        assert second.result(timeout=10).text == "second"
+        assert first.result(timeout=0).text == "first"
+
+        (_, _, sent_first), (_, _, sent_second) = server.delivered
+        # повтор ушёл не раньше, чем через retry_after после отказа
+        assert sent_second - sent_first >= 0.9
+        assert server.stats()["flood_429"] == {"sendMessage": 1}
+        assert dispatcher.stats()["retry_after"] == 1
+
+
+def test_deferred_sends_are_flushed(outbox):
+    with StubTelegramServer() as server:
+        # одно сообщение сразу, дальше — по 5 в секунду: остальные задания откладываются
+        dispatcher, tg = outbox(server, global_rate=100, chat_rate=5, chat_burst=1)
+        for i in range(4):
+            tg.send_message(301, f"slow:{i}")
+        other = tg.send_message(302, "other")
+
+        dispatcher.flush(301, timeout=10)
+        assert _texts(server, 301) == [f"slow:{i}" for i in range(4)]
+        assert dispatcher.stats()["deferred"] > 0
+        # отложенный чат не держал шард: сообщение другого чата ушло раньше хвоста
+        assert other.done()
+        order = [chat for chat, _, _ in server.delivered]
+        assert order.index(302) < len(order) - 1
+
+
+def test_stop_sends_deferred_jobs(outbox):
+    with StubTelegramServer() as server:
+        dispatcher, tg = outbox(server, global_rate=100, chat_rate=5, chat_burst=1)
+        futures = [tg.send_message(401, f"tail:{i}") for i in range(3)]
+        dispatcher.stop(timeout=10)
+
+        assert all(f.done() and f.exception() is None for f in futures)
+        assert _texts(server, 401) == [f"tail:{i}" for i in range(3)]
@@ -0,0 +1,169 @@
+"""Локальная заглушка Telegram Bot API для проверки исходящего трафика без сети.
+
+    python tg_stub.py --port 8081 --latency-ms 50 --chat-limit 1
+    BOT_API_URL=http://127.0.0.1:8081/bot{0}/{1} python main.py
+
+Отвечает на любые методы как Telegram (sendMessage, editMessageText, sendDocument, …),
+считает вызовы, запоминает принятые сообщения (delivered) и, как настоящий flood control,
+отдаёт 429 с retry_after, если чат или бот превышают лимит сообщений в секунду. Из кода (bench.py, проверки):
+
+    with StubTelegramServer(chat_limit=1) as stub:
+        apihelper.API_URL = stub.api_url
+        ...
+        print(stub.stats())
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MESSAGE_METHODS = ("send", "edit", "copyMessage", "forwardMessage")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у api.telegram.org
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode("utf-8")))
+        status, payload = self.server.stub.respond(url.path.rsplit("/", 1)[-1], params)
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTelegramServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 chat_limit: float = 0, global_limit: float = 0, retry_after: int = 1):
+        """chat_limit/global_limit — сообщений в секунду до 429 (0 — без ограничения)."""
+        self.latency = latency
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.flood: Counter = Counter()
+        self.connections = 0
+        self.delivered: list[tuple[int, str, float]] = []  # (chat_id, text, monotonic) принятых сообщений
+        self._sent: dict[int, deque] = {}
+        self._sent_all: deque = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+        self._count_connections()
+
+    def _count_connections(self):
+        server, stub = self._server, self
+        original = server.process_request
+
+        def process_request(request, client_address):
+            with stub._lock:
+                stub.connections += 1
+            original(request, client_address)
+        server.process_request = process_request
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    @staticmethod
+    def _over_limit(window: deque, now: float, limit: float) -> bool:
+        while window and window[0] <= now - 1.0:
+            window.popleft()
+        if limit and len(window) >= limit:
+            return True
+        window.append(now)
+        return False
+
+    def respond(self, method: str, params: dict) -> tuple[int, dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = int(params.get("chat_id", 0) or 0)
+        now = time.monotonic()
+        with self._lock:
+            self.calls[method] += 1
+            if method.startswith(MESSAGE_METHODS):
+                chat_window = self._sent.setdefault(chat_id, deque())
+                if (self._over_limit(self._sent_all, now, self.global_limit)
+                        or self._over_limit(chat_window, now, self.chat_limit)):
+                    self.flood[method] += 1
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {self.retry_after}",
+                                 "parameters": {"retry_after": self.retry_after}}
+                self.delivered.append((chat_id, params.get("text", ""), now))
+            message_id = next(self._ids)
+        if method in ("answerCallbackQuery", "editMessageReplyMarkup", "setWebhook", "deleteWebhook"):
+            return 200, {"ok": True, "result": True}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}}
+        result = {"message_id": message_id, "date": int(time.time()),
+                  "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        if method == "sendDocument":
+            result["document"] = {"file_id": f"stub-{message_id}", "file_unique_id": f"u{message_id}"}
+        return 200, {"ok": True, "result": result}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "flood_429": dict(self.flood), "connections": self.connections}
+
+    def start(self) -> "StubTelegramServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="tg-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def run(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--chat-limit", type=float, default=0, help="сообщений/с в чат до 429 (0 — без лимита)")
+    parser.add_argument("--global-limit", type=float, default=0, help="сообщений/с на бота до 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args(argv)
+    stub = StubTelegramServer(args.host, args.port, args.latency_ms / 1000, args.chat_limit,
+                              args.global_limit, args.retry_after)
+    print(f"Заглушка Bot API: {stub.api_url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(stub.stats(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    run()